@@ -0,0 +1,203 @@
+"""Saving and loading models without pickle.
+
+A model file is laid out as:
+    - MAGIC
+    - the length of the header, as a little-endian uint32
+    - the header: utf8 JSON with the model's class, hyperparameters, codec
+      config and training history, and the dtype, shape and offset of each array
+    - the arrays (weights, biases and persistent chains), raw, each starting at
+      a multiple of ALIGNMENT bytes
+
+Since the arrays are stored raw, loading a model can just memory-map them. That's
+fast, and processes which load the same model file share the same pages of memory.
+Loading never unpickles anything, unless it's explicitly asked to load a legacy
+pickle (the scripts' --allow-pickle flag).
+
+Legacy pickles can be converted with
+    python ModelIO.py old_model.pickle [new_model.rbm]
+"""
+import argparse
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+import RBM
+from ShortTextCodec import ShortTextCodec, BinomialShortTextCodec
+
+MAGIC = b'CHARRBM\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+EXTENSION = '.rbm'
+
+MODEL_CLASSES = {kls.__name__: kls for kls in
+                 [RBM.BernoulliRBM, RBM.CharBernoulliRBM, RBM.CharBernoulliRBMSoftmax]}
+CODEC_CLASSES = {kls.__name__: kls for kls in [ShortTextCodec, BinomialShortTextCodec]}
+
+# Constructor args of BernoulliRBM, and their defaults for models pickled
+# before they existed
+PARAMS = {'n_components': 256, 'learning_rate': 0.1, 'batch_size': 10, 'n_iter': 10,
+          'verbose': 0, 'random_state': None, 'lr_backoff': False, 'weight_cost': 0,
+          'dtype': 'float64'}
+ARRAYS = ['components_', 'intercept_hidden_', 'intercept_visible_', 'h_samples_']
+
+
+class ModelFormatException(Exception):
+    pass
+
+
+def _jsonable(value):
+    """Convert numpy scalars and tuples (e.g. in a model's history) to plain
+    python types that json can handle."""
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def model_params(model):
+    params = {name: getattr(model, name, default) for name, default in PARAMS.items()}
+    params['learning_rate'] = getattr(model, 'base_learning_rate', params['learning_rate'])
+    params['dtype'] = np.dtype(params['dtype']).name
+    if not isinstance(params['random_state'], (int, np.integer)):
+        params['random_state'] = None
+    return _jsonable(params)
+
+def save(model, fname):
+    """Save the given (fitted) model to fname."""
+    arrays = [(name, getattr(model, name)) for name in ARRAYS if getattr(model, name, None) is not None]
+    header = {'format_version': FORMAT_VERSION,
+              'class': type(model).__name__,
+              'params': model_params(model),
+              'history': _jsonable(getattr(model, 'history', {})),
+              'arrays': {},
+              }
+    codec = getattr(model, 'codec', None)
+    if codec is not None:
+        header['codec'] = codec.config()
+
+    # Work out where each array will go. (Offsets are relative to the end of the
+    # header, so they don't depend on its length.)
+    offset = 0
+    for name, array in arrays:
+        order = 'F' if np.isfortran(array) else 'C'
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                                  'order': order, 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf8')
+    data_start = _align(len(MAGIC) + 4 + len(header_bytes))
+
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            order = header['arrays'][name]['order']
+            f.write(np.asarray(array).tobytes(order=order))
+    os.replace(tmp_fname, fname)
+
+def is_model_file(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_header(fname):
+    """Return the JSON header of the given model file, and the offset the arrays start at."""
+    with open(fname, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ModelFormatException("{} is not a model file".format(fname))
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf8'))
+    if header['format_version'] > FORMAT_VERSION:
+        raise ModelFormatException("{} has format version {}. Only know how to read up to {}".format(
+            fname, header['format_version'], FORMAT_VERSION))
+    return header, _align(len(MAGIC) + 4 + header_len)
+
+def load(fname, mmap_mode='c', allow_pickle=False):
+    """Load a model saved with save().
+
+    mmap_mode : {'c', 'r', None}
+        How to map the arrays into memory (see np.memmap). The default, 'c'
+        (copy-on-write) lets the model be modified (e.g. trained further) without
+        touching the file. 'r' is read-only. None reads everything into memory.
+
+    allow_pickle : bool
+        If fname is a legacy pickled model rather than a model file, unpickle it.
+        Unpickling can run arbitrary code, so only do this with files you trust.
+        Otherwise, legacy pickles are an error (convert them with convert()).
+    """
+    if not is_model_file(fname):
+        if not allow_pickle:
+            raise ModelFormatException("{} is not a model file. If it's a legacy pickle you trust,"
+                                       " convert it with ModelIO.py, or pass --allow-pickle".format(fname))
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+
+    header, data_start = read_header(fname)
+    try:
+        kls = MODEL_CLASSES[header['class']]
+    except KeyError:
+        raise ModelFormatException("Unknown model class {}".format(header['class']))
+    params = header['params']
+    if 'codec' in header:
+        model = kls(codec_from_config(header['codec']), **params)
+    else:
+        model = kls(**params)
+    model.history = header['history']
+
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        offset = data_start + info['offset']
+        if mmap_mode is None:
+            with open(fname, 'rb') as f:
+                f.seek(offset)
+                count = int(np.prod(shape))
+                array = np.fromfile(f, dtype=dtype, count=count).reshape(shape, order=info['order'])
+        else:
+            array = np.memmap(fname, dtype=dtype, mode=mmap_mode, offset=offset,
+                              shape=shape, order=info['order'])
+        setattr(model, name, array)
+    return model
+
+def load_codec(fname, allow_pickle=False):
+    """Return the codec of the model saved in fname. Only the header is read, unless
+    it's a legacy pickle (see load), which has to be loaded whole."""
+    if is_model_file(fname):
+        header, _ = read_header(fname)
+        return codec_from_config(header['codec'])
+    return load(fname, allow_pickle=allow_pickle).codec
+
+def codec_from_config(config):
+    """Rebuild a codec from the output of its config() method."""
+    try:
+        kls = CODEC_CLASSES[config['class']]
+    except KeyError:
+        raise ModelFormatException("Unknown codec class {}".format(config['class']))
+    return kls.from_config(config)
+
+def convert(pickle_fname, out_fname=None):
+    """Convert a legacy pickled model to a model file. Returns the new file's name."""
+    if out_fname is None:
+        out_fname = os.path.splitext(pickle_fname)[0] + EXTENSION
+    with open(pickle_fname, 'rb') as f:
+        model = pickle.load(f)
+    save(model, out_fname)
+    return out_fname
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a pickled model to the model file format')
+    parser.add_argument('pickle_fname', metavar='model.pickle')
+    parser.add_argument('out_fname', nargs='?', default=None,
+                        help='Where to write the converted model. Defaults to the same name with a {} extension'.format(EXTENSION))
+    args = parser.parse_args()
+    print ("Wrote " + convert(args.pickle_fname, args.out_fname))
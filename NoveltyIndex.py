@@ -0,0 +1,191 @@
+"""An index of the strings in a training corpus, for telling whether samples
+are novel, and how far they are from the nearest training example.
+
+Strings are stored as their (canonical) char indices, packed one byte per char
+into a sorted array of fixed-width byte strings, so membership tests for a
+whole batch of samples are a single searchsorted. Edit distances are computed
+with Myers' bit-parallel algorithm, vectorized across the corpus. That keeps
+each corpus string's bitmasks in a single uint64, so codecs can have a maxlen
+of at most 64.
+
+Build an index for a model's codec with
+    python NoveltyIndex.py model.rbm names.txt [more.txt ...] -o names.novelty.npz
+"""
+import argparse
+import json
+
+import numpy as np
+
+import ModelIO
+import Utils
+
+EXTENSION = '.novelty.npz'
+
+
+class NoveltyIndex(object):
+
+    def __init__(self, codec, indices, sources=()):
+        """indices is an array of char indices of shape (n, maxlen), as encoded
+        by codec (e.g. from Utils.load_char_indices)."""
+        assert codec.nchars < 256, "Can't fit char indices in a byte"
+        assert codec.maxlen <= 64, "Can't fit strings longer than 64 chars in the edit distance bitmasks"
+        self.codec = codec
+        self.sources = list(sources)
+        # Shift everything up by one, since numpy strips trailing NULs from byte strings
+        rows = codec.canonical_indices(np.asarray(indices)).astype(np.uint8) + 1
+        self.keys = np.unique(self._keys(rows))
+        self._lengths = None
+        self._peq = None
+
+    @classmethod
+    def from_txtfiles(cls, codec, fnames):
+        indices = [Utils.load_char_indices(fname, codec) for fname in fnames]
+        if indices:
+            indices = np.concatenate(indices)
+        else:
+            indices = np.zeros((0, codec.maxlen), dtype=codec.INDEX_DTYPE)
+        return cls(codec, indices, fnames)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _keys(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=np.uint8)
+        return rows.view('S{}'.format(self.codec.maxlen)).reshape(len(rows))
+
+    def _query_keys(self, indices):
+        return self._keys(self.codec.canonical_indices(np.asarray(indices)).astype(np.uint8) + 1)
+
+    @property
+    def indices(self):
+        """The (canonical) char indices of the strings in the index, in sorted order."""
+        return self.keys.view(np.uint8).reshape(len(self.keys), self.codec.maxlen).astype(np.intp) - 1
+
+    def lookup(self, indices):
+        """Return the position in self.indices of each row of char indices, or -1
+        for those which aren't in the index."""
+        keys = self._query_keys(indices)
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.intp)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    def contains(self, indices):
+        """Return a boolean array saying which rows of char indices are in the index."""
+        return self.lookup(indices) != -1
+
+    def contains_strings(self, strings):
+        """Like contains(), but for a list of strings. Strings the codec can't
+        encode can't be in the index."""
+        indices, reasons = self.codec.encode_batch(strings)
+        return self.contains(indices) & (reasons == '')
+
+    def _lengths_and_peq(self):
+        # Lengths of the corpus strings, and for each char c, a bitmask per string
+        # with bit i set iff its ith char is c (the 'pattern match vectors' of
+        # Myers' algorithm)
+        if self._peq is None:
+            rows = self.indices
+            filler = self.codec.pretty_filler_index
+            self._lengths = (rows != filler).sum(axis=1)
+            bits = np.uint64(1) << np.arange(self.codec.maxlen, dtype=np.uint64)
+            peq = np.zeros((self.codec.nchars, len(rows)), dtype=np.uint64)
+            for posn in range(self.codec.maxlen):
+                # Padding is at the end of each row, and isn't part of the pattern
+                live = posn < self._lengths
+                peq[rows[live, posn], np.flatnonzero(live)] |= bits[posn]
+            self._peq = peq
+        return self._lengths, self._peq
+
+    def _distances_to(self, row):
+        """Edit distance from the string with the given (canonical) char indices
+        to every string in the index."""
+        lengths, peq = self._lengths_and_peq()
+        filler = self.codec.pretty_filler_index
+        text = row[row != filler]
+        one = np.uint64(1)
+        # The bit for the last char of each pattern (nothing, for empty patterns)
+        last = np.where(lengths > 0, one << (np.maximum(lengths, 1) - 1).astype(np.uint64), np.uint64(0))
+        pv = np.full(len(lengths), ~np.uint64(0))
+        mv = np.zeros(len(lengths), dtype=np.uint64)
+        score = lengths.astype(np.intp)
+        for char in text:
+            eq = peq[char]
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | ~(xh | pv)
+            mh = pv & xh
+            score += (ph & last) != 0
+            score -= (mh & last) != 0
+            ph = (ph << one) | one
+            mh = mh << one
+            pv = mh | ~(xv | ph)
+            mv = ph & xv
+        # Empty patterns never see a last bit, and are just len(text) away
+        return np.where(lengths > 0, score, len(text))
+
+    def nearest(self, indices):
+        """For each row of char indices, return the edit distance to the nearest
+        string in the index, and that string's position in self.indices.
+        Rows which are in the index are at distance 0 from themselves.
+        """
+        indices = self.codec.canonical_indices(np.asarray(indices))
+        distances = np.zeros(len(indices), dtype=np.intp)
+        neighbours = self.lookup(indices)
+        if not len(self.keys):
+            return distances, neighbours
+        with np.errstate(over='ignore'):
+            for i in np.flatnonzero(neighbours == -1):
+                dists = self._distances_to(indices[i])
+                neighbours[i] = np.argmin(dists)
+                distances[i] = dists[neighbours[i]]
+        return distances, neighbours
+
+    def nearest_strings(self, strings):
+        """Like nearest(), but for a list of strings, and returns the decoded
+        neighbours rather than their positions. Strings the codec can't encode
+        get a distance of -1 and a neighbour of None."""
+        indices, reasons = self.codec.encode_batch(strings)
+        ok = reasons == ''
+        distances = np.full(len(strings), -1, dtype=np.intp)
+        neighbours = [None] * len(strings)
+        if ok.any():
+            dists, rows = self.nearest(indices[ok])
+            distances[ok] = dists
+            decoded = self.codec.decode_indices(self.indices[rows], pretty=True) if len(self.keys) else [None] * len(rows)
+            for i, neighbour in zip(np.flatnonzero(ok), decoded):
+                neighbours[i] = neighbour
+        return distances, neighbours
+
+    def save(self, fname):
+        np.savez(fname, keys=self.keys, codec=json.dumps(self.codec.config()),
+                 sources=json.dumps(self.sources))
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname, allow_pickle=False) as data:
+            index = cls.__new__(cls)
+            index.codec = ModelIO.codec_from_config(json.loads(str(data['codec'])))
+            index.sources = json.loads(str(data['sources']))
+            index.keys = data['keys']
+        index._lengths = None
+        index._peq = None
+        return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an index of the strings in some text files, for'
+                                     + ' checking the novelty of samples from a model')
+    parser.add_argument('model_fname', metavar='model.rbm', help='A model whose codec to encode the strings with')
+    parser.add_argument('txtfiles', nargs='+', metavar='txtfile', help='Text files with one string per line')
+    parser.add_argument('--allow-pickle', dest='allow_pickle', action='store_true',
+                        help='Allow loading legacy pickled models. Unpickling can run arbitrary code, so only use this with files you trust.')
+    parser.add_argument('-o', '--out', default=None,
+                        help='Where to save the index. Defaults to the first text file\'s name with a {} extension'.format(EXTENSION))
+    args = parser.parse_args()
+
+    codec = ModelIO.load_codec(args.model_fname, allow_pickle=args.allow_pickle)
+    index = NoveltyIndex.from_txtfiles(codec, args.txtfiles)
+    out = args.out or args.txtfiles[0].rsplit('.', 1)[0] + EXTENSION
+    index.save(out)
+    print ("Wrote index of {} strings to {}".format(len(index), out))
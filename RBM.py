@@ -10,6 +10,11 @@ Based on sklearn's BernoulliRBM class.
 
 import time
 import re
+import numbers
+import copy
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.sparse as sp
@@ -20,10 +25,10 @@ from sklearn.utils import check_array
 from sklearn.utils import check_random_state
 from sklearn.utils import gen_even_slices
 from sklearn.utils import issparse
-from sklearn.utils import shuffle
 from sklearn.utils.extmath import safe_sparse_dot, log_logistic
 import scipy
 from scipy.special import expit             # logistic function
+from scipy.special import logsumexp
 from sklearn.utils.validation import check_is_fitted
 
 import Utils
@@ -36,6 +41,205 @@ import Utils
 # This kind of helped but wasn't amazing. Possibly I just needed a longer/gentler annealing schedule?
 BIASED_PRIOR = 0
 
+# If true, wellness_check reports the exact pseudo-likelihood (see score_samples)
+# rather than the usual one-unit-per-sample estimate. Deterministic, but slower.
+EXACT_PSEUDOLIKELIHOOD = 0
+
+# Max number of elements in the scratch arrays used for the exact pseudo-likelihood.
+SCRATCH_SIZE = 2**22
+
+# Free energies and pseudo-likelihoods are computed over blocks of at most this
+# many rows at a time, so memory use doesn't grow with the size of the input.
+SCORE_CHUNK_SIZE = 10**4
+# Number of threads to score chunks with. numpy releases the GIL for the heavy
+# lifting, so this can help on big inputs.
+SCORE_THREADS = 1
+
+# Guards setting up each thread's workspace (see BernoulliRBM._get_workspace)
+_WORKSPACE_LOCK = threading.Lock()
+
+
+def _seed_sequence(random_state, rng):
+    """A SeedSequence which is fixed by random_state if it's an integer, else by
+    one draw from rng (so seeding the global RNG beforehand still works)."""
+    if isinstance(random_state, numbers.Integral):
+        return np.random.SeedSequence(random_state)
+    return np.random.SeedSequence(rng.randint(np.iinfo(np.int32).max))
+
+def _bias_temperature(temperature):
+    return np.minimum(1.0, temperature) if BIASED_PRIOR else temperature
+
+def _dot(a, b, out=None):
+    """Like safe_sparse_dot(a, b, dense_output=True), but writes the result to out
+    (if provided), without allocating a temporary whenever possible.
+    """
+    if out is None:
+        return safe_sparse_dot(a, b, dense_output=True)
+    if (not issparse(a) and out.flags.c_contiguous
+            and out.dtype == np.result_type(a.dtype, b.dtype)):
+        return np.dot(a, b, out=out)
+    out[...] = safe_sparse_dot(a, b, dense_output=True)
+    return out
+
+
+def _iter_row_chunks(X, chunk_size):
+    """Yield (chunk, rows) pairs covering X in blocks of at most chunk_size rows,
+    where rows is the slice of X the chunk corresponds to. X may be a matrix,
+    or an iterable of matrices (e.g. from Utils.iter_vector_chunks)."""
+    chunks = [X] if hasattr(X, 'shape') else X
+    start = 0
+    for chunk in chunks:
+        n = chunk.shape[0]
+        for i in range(0, n, chunk_size):
+            block = chunk if (i == 0 and n <= chunk_size) else chunk[i:i + chunk_size]
+            yield block, slice(start, start + block.shape[0])
+            start += block.shape[0]
+
+def _map_chunks(f, X, chunk_size=None, n_threads=None):
+    """Compute f(chunk, rows) for each block of rows of X (see _iter_row_chunks),
+    and concatenate the results. If n_threads > 1, blocks are processed in a
+    thread pool, with a bounded number in flight at once."""
+    chunk_size = chunk_size or SCORE_CHUNK_SIZE
+    n_threads = SCORE_THREADS if n_threads is None else n_threads
+    chunks = _iter_row_chunks(X, chunk_size)
+    if n_threads <= 1:
+        results = [f(chunk, rows) for chunk, rows in chunks]
+    else:
+        results = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for chunk, rows in chunks:
+                pending.append(pool.submit(f, chunk, rows))
+                if len(pending) >= 2 * n_threads:
+                    results.append(pending.popleft().result())
+            results.extend(future.result() for future in pending)
+    if len(results) == 1:
+        return results[0]
+    return np.concatenate(results) if results else np.zeros(0)
+
+
+class _Workspace(object):
+    """Scratch arrays which are reused across minibatches and Gibbs steps, so
+    that the hot loops don't have to go to the heap. Buffers are looked up by
+    name, and only reallocated if a bigger (or differently shaped) one is asked
+    for. Also owns the Generator used to draw into them, since RandomState
+    can't fill an existing array.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        """Return an uninitialized array of the given shape (a view of the first
+        shape[0] rows of the named buffer)."""
+        buf = self._buffers.get(name)
+        if (buf is None or buf.dtype != dtype or buf.shape[1:] != tuple(shape[1:])
+                or buf.shape[0] < shape[0]):
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:shape[0]]
+
+    def uniform(self, name, shape, dtype=np.float64, rng=None):
+        """Return the named buffer filled with draws from U[0, 1) (from the
+        given Generator, or our own)."""
+        rng = self.rng if rng is None else rng
+        return rng.random(out=self.get(name, shape, dtype), dtype=dtype)
+
+    def reserve(self, batch_size, n_fantasy, n_components, n_features, dtype=np.float64):
+        """Allocate everything BernoulliRBM._fit needs up front."""
+        for name, shape in [('h_pos', (batch_size, n_components)),
+                            ('h_neg', (n_fantasy, n_components)),
+                            ('v_neg', (n_fantasy, n_features)),
+                            ('update', (n_features, n_components)),
+                            ('gather', (max(batch_size, n_fantasy), n_components)),
+                            ('uniform_h', (n_fantasy, n_components)),
+                            ('uniform_v', (n_fantasy, n_features)),
+                            ]:
+            self.get(name, shape, dtype)
+
+class Monitor(object):
+    """Decides when fit() runs wellness_check, and on what data. The defaults
+    check after every epoch but the last, on (up to) the first 10^5 examples
+    of the training data as currently shuffled.
+
+    every_epochs : int or None
+        Check after every this many epochs (except the last one).
+
+    every_batches : int or None
+        Check after every this many minibatches, counting across epochs.
+
+    subsample : int
+        Max number of training examples to score.
+
+    fixed_subsample : bool
+        If true, score the same training examples every time (chosen once, at
+        the start of fit), rather than the first ones of the current shuffle.
+        Less noisy, and saves slicing a copy of the training data per check.
+
+    background : bool
+        If true, score a snapshot of the model in a background thread while
+        training continues. If a check comes due while the previous one is
+        still running, it's skipped.
+    """
+
+    def __init__(self, every_epochs=1, every_batches=None, subsample=10**5,
+                 fixed_subsample=False, background=False):
+        self.every_epochs = every_epochs
+        self.every_batches = every_batches
+        self.subsample = subsample
+        self.fixed_subsample = fixed_subsample
+        self.background = background
+
+    def start(self, model, train, validation, batches=0):
+        self.model = model
+        self.validation = validation
+        # Enough rows to compare against the validation data, too
+        n = max(self.subsample, validation.shape[0] if validation is not None else 0)
+        self.n_train = min(n, train.shape[0])
+        self.train_sample = train[:self.n_train] if self.fixed_subsample else None
+        self.batches = batches
+        self.last_check = time.time()
+        self._executor = None
+        self._pending = None
+
+    def after_batch(self, epoch, train):
+        self.batches += 1
+        if self.every_batches and self.batches % self.every_batches == 0:
+            self.check(epoch, train, batch=self.batches)
+
+    def after_epoch(self, epoch, train):
+        if self.every_epochs and epoch % self.every_epochs == 0 and epoch != self.model.n_iter:
+            self.check(epoch, train)
+
+    def check(self, epoch, train, batch=None):
+        model = self.model
+        if not model.verbose:
+            return
+        train = self.train_sample if self.fixed_subsample else train[:self.n_train]
+        now = time.time()
+        duration, self.last_check = now - self.last_check, now
+        if not self.background:
+            model.wellness_check(epoch, duration, train, self.validation, batch=batch)
+            return
+        if self._pending is not None and not self._pending.done():
+            print ("Skipping check at epoch {}: previous one still running".format(epoch))
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = self._executor.submit(model._snapshot().wellness_check,
+                                              epoch, duration, train, self.validation, batch=batch)
+
+    def finish(self):
+        """Wait for any check running in the background."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            if self._pending is not None:
+                # Surface any exception
+                self._pending.result()
+            self._executor = self._pending = None
+
+
 class BernoulliRBM(BaseEstimator, TransformerMixin):
     """Bernoulli Restricted Boltzmann Machine (RBM).
 
@@ -73,6 +277,11 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         random permutations generator. If an integer is given, it fixes the
         seed. Defaults to the global numpy random number generator.
 
+    dtype : numpy dtype, optional
+        Floating point type used for the weights, biases and all intermediate
+        computations. np.float32 roughly halves memory traffic compared to the
+        default np.float64, at the cost of some precision (see README).
+
     Attributes
     ----------
     intercept_hidden_ : array-like, shape (n_components,)
@@ -98,7 +307,8 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
     """
 
     def __init__(self, n_components=256, learning_rate=0.1, batch_size=10,
-                 n_iter=10, verbose=0, random_state=None, lr_backoff=False, weight_cost=0):
+                 n_iter=10, verbose=0, random_state=None, lr_backoff=False, weight_cost=0,
+                 dtype=np.float64):
         self.n_components = n_components
         self.base_learning_rate = learning_rate
         self.learning_rate = learning_rate
@@ -108,7 +318,13 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         self.verbose = verbose
         self.random_state = random_state
         self.rng_ = check_random_state(self.random_state)
+        # Per-thread workspace Generators and snapshots (see _snapshot) are
+        # spawned from these, rather than seeded from rng_, so that how many
+        # threads we score with, or how often we check on training, doesn't
+        # change the random numbers used for training
+        self._workspace_seeds, self._snapshot_seeds = _seed_sequence(random_state, self.rng_).spawn(2)
         self.weight_cost = weight_cost
+        self.dtype = dtype
         # A history of some summary statistics recorded at the end of each epoch of training
         # Each key maps to a 2-d array. One row per 'session', one value per epoch.
         # (Another session means this model was pickled, then loaded and fit again.)
@@ -120,94 +336,338 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
     def fantasy_to_batch(self):
         return 1
 
+    def __getstate__(self):
+        try:
+            state = super(BernoulliRBM, self).__getstate__()
+        except AttributeError:
+            state = self.__dict__
+        state = dict(state)
+        # Scratch space. No reason to pickle it. But do keep the state of its
+        # RNG, so that training can be resumed exactly (see fit).
+        workspaces = state.pop('_workspaces', None)
+        workspace = getattr(workspaces, 'workspace', None)
+        if workspace is not None:
+            state['_workspace_rng_state'] = workspace.rng.bit_generator.state
+        # Persistent sampling chains (see Sampling.ChainPool) belong to this process
+        state.pop('_chain_pool', None)
+        return state
+
+    def __setstate__(self, state):
+        # Models pickled before dtype was configurable: go by the weights
+        if 'dtype' not in state:
+            components = state.get('components_')
+            state['dtype'] = components.dtype.type if components is not None else np.float64
+        if '_snapshot_seeds' not in state:
+            state['_workspace_seeds'], state['_snapshot_seeds'] = _seed_sequence(
+                state.get('random_state'), state['rng_']).spawn(2)
+        try:
+            super(BernoulliRBM, self).__setstate__(state)
+        except AttributeError:
+            self.__dict__.update(state)
+
+    @property
+    def compute_dtype(self):
+        return np.dtype(self.dtype)
+
+    def _cast_params(self):
+        """Make sure the weights, biases and fantasy particles are of compute_dtype
+        (e.g. when continuing to train a loaded model with a different dtype)."""
+        dtype = self.compute_dtype
+        for attr in ['components_', 'intercept_hidden_', 'intercept_visible_', 'h_samples_']:
+            value = getattr(self, attr, None)
+            if value is not None and value.dtype != dtype:
+                # order='K' keeps components_ Fortran-ordered
+                setattr(self, attr, value.astype(dtype, order='K'))
+
+    def _init_components(self, n_features):
+        self.components_ = np.asarray(
+            self.rng_.normal(0, 0.01, (self.n_components, n_features)),
+            dtype=self.compute_dtype, order='F')
+
+    def _get_workspace(self):
+        # One workspace per thread, so that scoring in a thread pool (see
+        # SCORE_THREADS) doesn't have threads scribbling over each other's scratch
+        workspace = getattr(getattr(self, '_workspaces', None), 'workspace', None)
+        if workspace is None:
+            # SeedSequence.spawn isn't thread-safe, and two threads mustn't both
+            # set up _workspaces (or get the same seed)
+            with _WORKSPACE_LOCK:
+                workspaces = getattr(self, '_workspaces', None)
+                if workspaces is None:
+                    workspaces = self._workspaces = threading.local()
+                rng_state = self.__dict__.pop('_workspace_rng_state', None)
+                if rng_state is not None:
+                    # Carry on from where we were when pickled
+                    rng = np.random.default_rng()
+                    rng.bit_generator.state = rng_state
+                else:
+                    rng = np.random.default_rng(self._workspace_seeds.spawn(1)[0])
+                workspace = workspaces.workspace = _Workspace(rng)
+        return workspace
+
+    def _snapshot(self):
+        """A copy of this model, with its own copy of the parameters and RNG, which
+        can be scored while this one keeps training. The history is shared, so
+        anything the snapshot records shows up here."""
+        snapshot = copy.copy(self)
+        # copy goes through __getstate__, so would otherwise carry on with our
+        # workspace's random numbers
+        for attr in ['_workspaces', '_chain_pool', '_workspace_rng_state']:
+            snapshot.__dict__.pop(attr, None)
+        for attr in ['components_', 'intercept_hidden_', 'intercept_visible_', 'h_samples_']:
+            setattr(snapshot, attr, getattr(self, attr).copy(order='K'))
+        # Don't draw from rng_ here, or checking on training would change its outcome
+        seeds = self._snapshot_seeds.spawn(1)[0]
+        snapshot.rng_ = np.random.RandomState(np.random.MT19937(seeds))
+        snapshot._workspace_seeds, snapshot._snapshot_seeds = seeds.spawn(2)
+        return snapshot
+
     def record(self, name, value):
         if not hasattr(self, 'history'):
             self.history = {'pseudo-likelihood': [], 'overfit': []}
         self.history[name][-1].append(value)
 
-    def _mean_hiddens(self, v, temperature=1.0):
+    def _onehot_columns(self, v):
+        """If v is a CSR matrix of 0/1 values with the same number of nonzeros in
+        every row (e.g. the one-hot encoded strings from Utils.vectors_from_txtfile),
+        return the indices of the units that are on, as an array of shape
+        (n_samples, nnz_per_row). Otherwise return None.
+        """
+        if not issparse(v) or v.format != 'csr' or v.shape[0] == 0:
+            return None
+        n_samples = v.shape[0]
+        nnz_per_row, remainder = divmod(v.nnz, n_samples)
+        if (remainder or nnz_per_row == 0
+                or not np.array_equal(v.indptr, np.arange(0, v.nnz + 1, nnz_per_row))
+                or not np.all(v.data == 1)):
+            return None
+        return v.indices.reshape(n_samples, nnz_per_row)
+
+    def _hidden_activations_columns(self, cols, out=None):
+        """Computes v . W^T where v has a 1 at each of the given unit indices, and
+        is 0 elsewhere, by summing the corresponding columns of components_.
+
+        cols : array-like, shape (n_samples, n_on)
+
+        Returns
+        -------
+        a : array-like, shape (n_samples, n_components)
+        """
+        # components_ is Fortran-ordered, so this is C-ordered, and each gather
+        # below is a contiguous copy of one row per sample
+        weights = self.components_.T
+        a = np.take(weights, cols[:, 0], axis=0, out=out)
+        scratch = self._get_workspace().get('gather', a.shape, a.dtype)
+        for i in range(1, cols.shape[1]):
+            a += np.take(weights, cols[:, i], axis=0, out=scratch)
+        return a
+
+    def _hidden_preactivation(self, v):
+        """Computes v . W^T + c, the argument to the logistic function for the
+        hidden units (at temperature 1).
+
+        Returns
+        -------
+        a : array-like, shape (n_samples, n_components)
+        """
+        cols = self._onehot_columns(v)
+        if cols is not None:
+            a = self._hidden_activations_columns(cols)
+        else:
+            a = safe_sparse_dot(v, self.components_.T, dense_output=True)
+        a += self.intercept_hidden_
+        return a
+
+    def _activate(self, p, bias, temperature):
+        """In-place, turn v.W^T (or h.W) into the argument to the logistic/softmax
+        function at the given temperature, without copying the weights or biases
+        unless we need to.
+
+        temperature may be a scalar, or an array with one temperature per row of p.
+        """
+        if np.ndim(temperature) == 0:
+            if temperature != 1.0:
+                p /= temperature
+            bias_temp = _bias_temperature(temperature)
+            p += bias if bias_temp == 1.0 else bias/bias_temp
+            return p
+        temperature = np.asarray(temperature, dtype=p.dtype).reshape(-1, 1)
+        if temperature.shape[0] != p.shape[0]:
+            raise ValueError("Got {} temperatures for {} samples".format(temperature.shape[0], p.shape[0]))
+        if BIASED_PRIOR:
+            p /= temperature
+            p += bias / _bias_temperature(temperature)
+        else:
+            p += bias
+            p /= temperature
+        return p
+
+    def _sample_bernoulli(self, p, name, rng=None):
+        """In-place, replace probabilities p with binary samples (as 0.0/1.0)."""
+        uniform = self._get_workspace().uniform(name, p.shape, p.dtype, rng)
+        return np.less(uniform, p, out=p)
+
+    def _mean_hiddens(self, v, temperature=1.0, out=None):
         """Computes the probabilities P(h=1|v).
 
         v : array-like, shape (n_samples, n_features)
             Values of the visible layer.
 
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature, or one temperature per sample.
+
+        out : array, shape (n_samples, n_components), optional
+            Where to write the result.
+
         Returns
         -------
         h : array-like, shape (n_samples, n_components)
             Corresponding mean field values for the hidden layer.
         """
-        p = safe_sparse_dot(v, self.components_.T/temperature)
-        p += self.intercept_hidden_/(min(1.0, temperature) if BIASED_PRIOR else temperature)
+        cols = self._onehot_columns(v)
+        if cols is not None:
+            p = self._hidden_activations_columns(cols, out=out)
+        else:
+            p = _dot(v, self.components_.T, out=out)
+        self._activate(p, self.intercept_hidden_, temperature)
         return expit(p, out=p)
 
-    def _sample_hiddens(self, v, temperature=1.0):
+    def _sample_hiddens(self, v, temperature=1.0, out=None, rng=None):
         """Sample from the distribution P(h|v).
 
         v : array-like, shape (n_samples, n_features)
             Values of the visible layer to sample from.
 
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature, or one temperature per sample.
+
+        out : array, shape (n_samples, n_components), optional
+            Where to write the result.
+
+        rng : numpy.random.Generator, optional
+            Where to draw random numbers from. Defaults to the model's own
+            (per-thread) generator.
+
         Returns
         -------
         h : array-like, shape (n_samples, n_components)
             Values of the hidden layer.
         """
-        p = self._mean_hiddens(v, temperature)
-        return (self.rng_.random_sample(size=p.shape) < p)
+        p = self._mean_hiddens(v, temperature, out=out)
+        return self._sample_bernoulli(p, 'uniform_h', rng)
 
-    def _sample_visibles(self, h, temperature=1.0):
+    def _sample_visibles(self, h, temperature=1.0, out=None, visible_bias=None, rng=None):
         """Sample from the distribution P(v|h).
 
         h : array-like, shape (n_samples, n_components)
             Values of the hidden layer to sample from.
 
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature, or one temperature per sample.
+
+        out : array, shape (n_samples, n_features), optional
+            Where to write the result.
+
+        visible_bias : array-like, shape (n_features,) or (n_samples, n_features), optional
+            Added to the visible biases (e.g. to steer samples towards some
+            lengths - see Sampling.length_bias), without touching the model.
+
+        rng : numpy.random.Generator, optional
+            Where to draw random numbers from. Defaults to the model's own
+            (per-thread) generator.
+
         Returns
         -------
         v : array-like, shape (n_samples, n_features)
             Values of the visible layer.
         """
-        p = np.dot(h, self.components_/temperature)
-        p += self.intercept_visible_/(min(1.0, temperature) if BIASED_PRIOR else temperature)
+        p = _dot(h, self.components_, out=out)
+        self._activate(p, self._visible_bias(visible_bias), temperature)
         expit(p, out=p)
-        return (self.rng_.random_sample(size=p.shape) < p)
+        return self._sample_bernoulli(p, 'uniform_v', rng)
 
-    def _free_energy(self, v):
+    def _free_energy(self, v, temperature=1.0):
         """Computes the free energy F(v) = - log sum_h exp(-E(v,h)).
 
         v : array-like, shape (n_samples, n_features)
-            Values of the visible layer.
+            Values of the visible layer. May also be an iterable of such
+            arrays, which are scored one after another (see _map_chunks).
+
+        temperature : float or array-like, shape (n_samples,), optional
+            Compute the free energy of the distribution sampled from by
+            gibbs(v, temperature) rather than the model's distribution.
 
         Returns
         -------
         free_energy : array-like, shape (n_samples,)
             The value of the free energy.
         """
-        return (- safe_sparse_dot(v, self.intercept_visible_)
-                - np.logaddexp(0, safe_sparse_dot(v, self.components_.T)
-                               + self.intercept_hidden_).sum(axis=1))
+        if np.ndim(temperature) == 0:
+            return _map_chunks(lambda chunk, rows: self._free_energy_block(chunk, temperature), v)
+        temperature = np.asarray(temperature)
+        return _map_chunks(lambda chunk, rows: self._free_energy_block(chunk, temperature[rows]), v)
+
+    def _free_energy_block(self, v, temperature=1.0):
+        """_free_energy for a single array, all at once."""
+        cols = self._onehot_columns(v)
+        if cols is not None:
+            a = self._hidden_activations_columns(cols)
+            visible_term = self.intercept_visible_[cols].sum(axis=1, dtype=np.float64)
+        else:
+            a = safe_sparse_dot(v, self.components_.T, dense_output=True)
+            visible_term = safe_sparse_dot(v, self.intercept_visible_)
+        if np.ndim(temperature) or temperature != 1.0:
+            self._activate(a, self.intercept_hidden_, temperature)
+            visible_term = visible_term / _bias_temperature(temperature)
+        else:
+            a += self.intercept_hidden_
+        # Accumulate in double precision, even for float32 models
+        return - visible_term - np.logaddexp(0, a, out=a).sum(axis=1, dtype=np.float64)
+
+    def _visible_bias(self, visible_bias=None):
+        if visible_bias is None:
+            return self.intercept_visible_
+        return self.intercept_visible_ + np.asarray(visible_bias, dtype=self.intercept_visible_.dtype)
 
-    def gibbs(self, v, temperature=1.0):
+    def gibbs(self, v, temperature=1.0, visible_bias=None, rng=None):
         """Perform one Gibbs sampling step.
 
         v : array-like, shape (n_samples, n_features)
             Values of the visible layer to start from.
 
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature to sample at, or one temperature per sample.
+
+        visible_bias : array-like, shape (n_features,) or (n_samples, n_features), optional
+            Added to the visible biases (e.g. to steer samples towards some
+            lengths - see Sampling.length_bias), without touching the model.
+
+        rng : numpy.random.Generator, optional
+            Where to draw random numbers from. Defaults to the model's own
+            (per-thread) generator.
+
         Returns
         -------
         v_new : array-like, shape (n_samples, n_features)
             Values of the visible layer after one Gibbs step.
         """
         check_is_fitted(self, "components_")
-        h_ = self._sample_hiddens(v, temperature)
-        v_ = self._sample_visibles(h_, temperature)
+        h_ = self._sample_hiddens(v, temperature, out=self._hidden_scratch(v.shape[0]), rng=rng)
+        v_ = self._sample_visibles(h_, temperature, visible_bias=visible_bias, rng=rng)
 
         return v_
 
+    def _hidden_scratch(self, n_samples):
+        return self._get_workspace().get('gibbs_h', (n_samples, self.n_components),
+                                         self.components_.dtype)
+
     def repeated_gibbs(self, v, niters):
         """Perform n rounds of alternating Gibbs sampling starting from the
         given visible vectors.
         """
+        h = self._hidden_scratch(v.shape[0])
         for i in range(niters):
-            h = self._sample_hiddens(v)
+            self._sample_hiddens(v, out=h)
             v = self._sample_visibles(h, temperature=1.0)
         return v
 
@@ -223,21 +683,17 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         self : BernoulliRBM
             The fitted model.
         """
-        X = check_array(X, accept_sparse='csr', dtype=np.float)
+        dtype = self.compute_dtype
+        X = check_array(X, accept_sparse='csr', dtype=dtype)
         if not hasattr(self, 'components_'):
-            self.components_ = np.asarray(
-                self.rng_.normal(
-                    0,
-                    0.01,
-                    (self.n_components, X.shape[1])
-                ),
-                order='fortran')
+            self._init_components(X.shape[1])
         if not hasattr(self, 'intercept_hidden_'):
-            self.intercept_hidden_ = np.zeros(self.n_components, )
+            self.intercept_hidden_ = np.zeros(self.n_components, dtype=dtype)
         if not hasattr(self, 'intercept_visible_'):
-            self.intercept_visible_ = np.zeros(X.shape[1], )
+            self.intercept_visible_ = np.zeros(X.shape[1], dtype=dtype)
         if not hasattr(self, 'h_samples_'):
-            self.h_samples_ = np.zeros((self.batch_size, self.n_components))
+            self.h_samples_ = np.zeros((self.batch_size, self.n_components), dtype=dtype)
+        self._cast_params()
 
         self._fit(X)
 
@@ -250,7 +706,11 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         v_pos : array-like, shape (n_samples, n_features)
             The data to use for training.
         """
-        h_pos = self._mean_hiddens(v_pos)
+        workspace = self._get_workspace()
+        n_samples, n_features = v_pos.shape
+        n_fantasy = self.h_samples_.shape[0]
+        dtype = self.components_.dtype
+        h_pos = self._mean_hiddens(v_pos, out=workspace.get('h_pos', (n_samples, self.n_components), dtype))
         # TODO: Worth trying with visible probabilities rather than binary states.
         # PG: it is common to use p_i instead of sampling a binary value'... 'it reduces
         # sampling noise this allowing faster learning. There is some evidence that it leads
@@ -261,44 +721,73 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         # a pseudo-version of using visible probabilities. Without softmax, v_neg
         # can have multiple 1s per one-hot vector, which maybe somehow accelerates learning?
         # Need to think about this some more.
-        v_neg = self._sample_visibles(self.h_samples_)
-        h_neg = self._mean_hiddens(v_neg)
-
-        lr = float(self.learning_rate) / v_pos.shape[0]
-        update = safe_sparse_dot(v_pos.T, h_pos, dense_output=True).T
-        update -= np.dot(h_neg.T, v_neg) / self.fantasy_to_batch
-        # L2 weight penalty
-        update -= self.components_ * self.weight_cost
-        self.components_ += lr * update
+        v_neg = self._sample_visibles(self.h_samples_, out=workspace.get('v_neg', (n_fantasy, n_features), dtype))
+        h_neg = self._mean_hiddens(v_neg, out=workspace.get('h_neg', (n_fantasy, self.n_components), dtype))
+
+        lr = float(self.learning_rate) / n_samples
+        # We build up the transpose of the update, shape (n_features, n_components),
+        # which has the same memory layout as components_.T
+        update = np.dot(v_neg.T, h_neg, out=workspace.get('update', (n_features, self.n_components), dtype))
+        update /= -self.fantasy_to_batch
+        pos_cols = self._onehot_columns(v_pos)
+        if pos_cols is not None:
+            # Positive phase for one-hot training data. Each unit that's on
+            # contributes its example's hidden probabilities to its row of the
+            # update, which is much cheaper than a generic sparse matmul for
+            # small batches.
+            for i in range(pos_cols.shape[1]):
+                np.add.at(update, pos_cols[:, i], h_pos)
+            v_pos_sum = np.bincount(pos_cols.ravel(), minlength=n_features)
+        else:
+            update += safe_sparse_dot(v_pos.T, h_pos, dense_output=True)
+            v_pos_sum = np.asarray(v_pos.sum(axis=0)).squeeze()
+        # L2 weight penalty. W += lr * (update - weight_cost * W), without
+        # making a scaled copy of W.
+        if self.weight_cost:
+            self.components_ *= (1 - lr * self.weight_cost)
+        update *= lr
+        self.components_ += update.T
         self.intercept_hidden_ += lr * (h_pos.sum(axis=0) - h_neg.sum(axis=0)/self.fantasy_to_batch)
-        self.intercept_visible_ += lr * (np.asarray(
-                                         v_pos.sum(axis=0)).squeeze() -
+        self.intercept_visible_ += lr * (v_pos_sum -
                                          v_neg.sum(axis=0)/self.fantasy_to_batch)
 
-        h_neg[self.rng_.uniform(size=h_neg.shape) < h_neg] = 1.0  # sample binomial
-        self.h_samples_ = np.floor(h_neg, h_neg)
+        # Sample binomial, straight into the persistent chains
+        uniform = workspace.uniform('uniform_h', h_neg.shape, dtype)
+        np.less(uniform, h_neg, out=self.h_samples_)
 
-    def corrupt(self, v):
-        # Randomly corrupt one feature in each sample in v.
-        ind = (np.arange(v.shape[0]),
-               self.rng_.randint(0, v.shape[1], v.shape[0]))
-        if issparse(v):
-            data = -2 * v[ind] + 1
-            v_ = v + sp.csr_matrix((data.A.ravel(), ind), shape=v.shape)
-        else:
-            v_ = v.copy()
-            v_[ind] = 1 - v_[ind]
-        return v_, None
+    def corruption(self, v, rng):
+        """Choose a random corruption of each sample in v, for estimating the
+        pseudo-likelihood, using the Generator rng. Rather than building the
+        corrupted samples, return a description of the change: units cols[i] of
+        sample i are to be turned on (where signs[i] is 1) or off (where it's -1).
 
-    def uncorrupt(self, visibles, state):
-        pass
+        Returns
+        -------
+        cols : array-like, shape (n_samples, n_changed)
+
+        signs : array-like, shape (n_samples, n_changed)
+        """
+        # Randomly flip one feature in each sample in v.
+        rows = np.arange(v.shape[0])
+        cols = rng.integers(0, v.shape[1], v.shape[0])
+        current = v[rows, cols]
+        current = np.asarray(current.todense() if issparse(current) else current).ravel()
+        signs = 1 - 2 * current
+        return cols.reshape(-1, 1), signs.reshape(-1, 1)
 
     @Utils.timeit
-    def score_samples(self, X):
+    def score_samples(self, X, exact=False):
         """Compute the pseudo-likelihood of X.
 
         X : {array-like, sparse matrix} shape (n_samples, n_features)
             Values of the visible layer. Must be all-boolean (not checked).
+            May also be an iterable of such matrices. Either way, X is scored
+            in chunks of SCORE_CHUNK_SIZE rows, in SCORE_THREADS threads.
+
+        exact : bool, optional
+            If true, compute the exact pseudo-likelihood, by scoring every
+            possible change to each visible unit (see _exact_pseudolikelihood),
+            rather than estimating it from one randomly chosen unit.
 
         Returns
         -------
@@ -307,19 +796,41 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
 
         Notes
         -----
-        This method is not deterministic: it computes a quantity called the
-        free energy on X, then on a randomly corrupted version of X, and
-        returns the log of the logistic function of the difference.
+        Unless exact is true, this method is not deterministic: it computes a
+        quantity called the free energy on X, then on a randomly corrupted
+        version of X, and returns the log of the logistic function of the
+        difference. The corruptions are drawn from a stream seeded by one draw
+        from rng_, so the result only depends on rng_'s state, not on the
+        number of threads.
         """
         check_is_fitted(self, "components_")
 
-        v = check_array(X, accept_sparse='csr')
-        fe = self._free_energy(v)
-
-        v_, state = self.corrupt(v)
-        # TODO: If I wanted to be really fancy here, I would do one of those "with..." things.
-        fe_corrupted = self._free_energy(v)
-        self.uncorrupt(v, state)
+        # Each chunk gets its own stream, keyed by where it starts, so that it
+        # doesn't matter what order threads get to them in
+        seed = None if exact else self.rng_.randint(np.iinfo(np.int32).max)
+        def score(chunk, rows):
+            v = check_array(chunk, accept_sparse='csr')
+            if exact:
+                return self._exact_pseudolikelihood(v)
+            return self._estimate_pseudolikelihood(v, np.random.default_rng([seed, rows.start]))
+        return _map_chunks(score, X)
+
+    def _estimate_pseudolikelihood(self, v, rng):
+        a = self._hidden_preactivation(v)
+        hidden_term = np.logaddexp(0, a).sum(axis=1, dtype=np.float64)
+
+        # Rather than building the corrupted samples and computing their free
+        # energy from scratch, update the hidden pre-activations in place, adding
+        # the rows of W^T for units turned on, and subtracting those turned off
+        cols, signs = self.corruption(v, rng)
+        signs = signs.astype(a.dtype, copy=False)
+        weights = self.components_.T
+        for k in range(cols.shape[1]):
+            a += signs[:, k:k+1] * weights[cols[:, k]]
+        corrupted_hidden_term = np.logaddexp(0, a, out=a).sum(axis=1, dtype=np.float64)
+        # F(v_corrupted) - F(v)
+        fe_delta = ((hidden_term - corrupted_hidden_term)
+                    - (signs * self.intercept_visible_[cols]).sum(axis=1, dtype=np.float64))
 
         # See https://en.wikipedia.org/wiki/Pseudolikelihood
         # Let x be some visible vector. x_i is the ith entry. x_-i is the vector except that entry.
@@ -335,7 +846,39 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
             normalizer = self.codec.shape()[0]
         else:
             normalizer = v.shape[1]
-        return normalizer * log_logistic(fe_corrupted - fe)
+        return normalizer * log_logistic(fe_delta)
+
+    def _exact_pseudolikelihood(self, v):
+        """Sum over all visible units i of log P(v_i | v_-i). Rather than computing
+        the free energy of each of the n_features corrupted copies of v from
+        scratch, we compute the hidden pre-activations for v once, then for
+        each unit j add or subtract W[:, j], depending on whether it's being
+        turned on or off.
+        """
+        base = self._hidden_preactivation(v)
+        base_softplus = np.logaddexp(0, base).sum(axis=1, dtype=np.float64)
+        weights = self.components_.T
+        n_samples, n_features = v.shape
+        # Work on blocks of samples x units, sized so as to bound the
+        # (rows, units, n_components) scratch array
+        row_chunk = max(1, min(n_samples, SCRATCH_SIZE // self.n_components))
+        unit_chunk = max(1, SCRATCH_SIZE // (row_chunk * self.n_components))
+        pl = np.zeros(n_samples)
+        for row_start in range(0, n_samples, row_chunk):
+            rows = slice(row_start, min(row_start + row_chunk, n_samples))
+            for unit_start in range(0, n_features, unit_chunk):
+                units = slice(unit_start, min(unit_start + unit_chunk, n_features))
+                v_chunk = v[rows, units]
+                v_chunk = v_chunk.toarray() if issparse(v_chunk) else np.asarray(v_chunk)
+                # +1 for units being turned on, -1 for units being turned off
+                signs = 1 - 2 * v_chunk
+                flipped = base[rows, np.newaxis, :] + signs[:, :, np.newaxis] * weights[np.newaxis, units]
+                # F(v_flipped) - F(v)
+                delta = (base_softplus[rows, np.newaxis]
+                         - np.logaddexp(0, flipped, out=flipped).sum(axis=2, dtype=np.float64)
+                         - signs * self.intercept_visible_[units])
+                pl[rows] += log_logistic(delta).sum(axis=1)
+        return pl
 
     # TODO: No longer used
     def pseudolikelihood_ratio(self, good, bad):
@@ -351,11 +894,14 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         subset of the training data. This is useful for monitoring overfitting.
         If the model isn't overfitting, the difference should be around 0. The
         greater the difference, the more the model is overfitting.
+
+        Both are scored in chunks (see _free_energy), so this is fine to call
+        with large validation sets.
         """
         # It's important to use the same subset of the training data every time (per Hinton's "Practical Guide")
         return self._free_energy(train[:validation.shape[0]]).mean(), self._free_energy(validation).mean()
 
-    def fit(self, X, validation=None):
+    def fit(self, X, validation=None, monitor=None, callback=None, resume=False):
         """Fit the model to the data X.
 
         X : {array-like, sparse matrix} shape (n_samples, n_features)
@@ -363,19 +909,85 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
 
         validation : {array-like, sparse matrix}
 
+        monitor : Monitor, optional
+            When and how to report on progress (if verbose). Defaults to
+            Monitor().
+
+        callback : callable, optional
+            Called with the model after every minibatch. If it returns true,
+            training stops early, leaving fit_state_ set, so that it can be
+            picked up later (e.g. after pickling and unpickling the model)
+            with resume=True.
+
+        resume : bool, optional
+            Continue a call to fit that was stopped early, from the minibatch
+            where it left off. X must be the same training data. Given the
+            same data (and the same monitoring), a resumed fit produces exactly
+            the same model as one that was never interrupted.
+
         Returns
         -------
         self : BernoulliRBM
             The fitted model.
         """
-        X = check_array(X, accept_sparse='csr', dtype=np.float)
+        dtype = self.compute_dtype
+        X = check_array(X, accept_sparse='csr', dtype=dtype)
         n_samples = X.shape[0]
 
+        state = getattr(self, 'fit_state_', None) if resume else None
+        if state is not None:
+            if state['order'].shape[0] != n_samples:
+                raise ValueError("Can't resume training on {} examples. Expected {}".format(
+                    n_samples, state['order'].shape[0]))
+            print ("Resuming at epoch {}, minibatch {}".format(state['epoch'], state['batch']))
+        else:
+            self._start_fit(X)
+            # Where we're at. Everything else needed to pick up where we left off
+            # (the weights, the persistent chains, the RNGs) is already part of the model.
+            state = self.fit_state_ = {'epoch': 1, 'batch': 0, 'order': np.arange(n_samples)}
+        self._cast_params()
+        self._get_workspace().reserve(self.batch_size, self.h_samples_.shape[0], self.n_components,
+                                      X.shape[1], dtype)
+
+        n_batches = int(np.ceil(float(n_samples) / self.batch_size))
+        batch_slices = list(gen_even_slices(n_batches * self.batch_size,
+                                            n_batches, n_samples))
+        monitor = Monitor() if monitor is None else monitor
+        monitor.start(self, X, validation, batches=(state['epoch'] - 1) * n_batches + state['batch'])
+        for iteration in range(state['epoch'], self.n_iter + 1):
+            if self.lr_backoff:
+                # If, e.g., we're doing 10 epochs, use the full learning rate for
+                # the first iteration, 90% of the base learning rate for the second
+                # iteration... and 10% for the final iteration
+                self.learning_rate = ((self.n_iter - (iteration - 1)) / (self.n_iter+0.0)) * self.base_learning_rate
+                print ("Using learning rate of {:.3f} (base LR={:.3f})".format(self.learning_rate, self.base_learning_rate))
+
+            X_epoch = X[state['order']] if iteration > 1 else X
+            for b in range(state['batch'], n_batches):
+                self._fit(X_epoch[batch_slices[b]])
+                state['batch'] = b + 1
+                monitor.after_batch(iteration, X_epoch)
+                if callback is not None and callback(self):
+                    monitor.finish()
+                    return self
+
+            monitor.after_epoch(iteration, X_epoch)
+            if iteration != self.n_iter:
+                state['order'] = state['order'][self.rng_.permutation(n_samples)]
+            state['epoch'] = iteration + 1
+            state['batch'] = 0
+
+        monitor.finish()
+        self.fit_state_ = None
+        return self
+
+    def _start_fit(self, X):
+        """Set up the weights, biases, persistent chains and history for a fresh
+        call to fit."""
+        dtype = self.compute_dtype
         if not hasattr(self, 'components_'):
-            self.components_ = np.asarray(
-                self.rng_.normal(0, 0.01, (self.n_components, X.shape[1])),
-                order='fortran')
-            self.intercept_hidden_ = np.zeros(self.n_components, )
+            self._init_components(X.shape[1])
+            self.intercept_hidden_ = np.zeros(self.n_components, dtype=dtype)
             # 'It is usually helpful to initialize the bias of visible unit i to log[p_i/(1-p_i)] where p_i is the prptn of training vectors where i is on' - Practical Guide
             # TODO: Make this configurable?
             if 1:
@@ -384,9 +996,9 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
                 assert np.max(counts) < X.shape[0], "Found a visible unit always on in the training data. Fishy."
                 # There might be some units never on. Add a pseudo-count of 1 to avoid inf
                 vis_priors = (counts + 1) / float(X.shape[0])
-                self.intercept_visible_ = np.log( vis_priors / (1 - vis_priors) )
+                self.intercept_visible_ = np.log( vis_priors / (1 - vis_priors) ).astype(dtype)
             else:
-                self.intercept_visible_ = np.zeros(X.shape[1], )
+                self.intercept_visible_ = np.zeros(X.shape[1], dtype=dtype)
 
         # If this already *does* have weights and biases before fit() is called,
         # we'll start from them rather than wiping them out. May want to train
@@ -395,7 +1007,7 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
         else:
             print ("Reusing existing weights and biases")
         # Don't necessarily want to reuse h_samples if we have one leftover from before - batch size might have changed
-        self.h_samples_ = np.zeros((self.batch_size * self.fantasy_to_batch, self.n_components))
+        self.h_samples_ = np.zeros((self.batch_size * self.fantasy_to_batch, self.n_components), dtype=dtype)
 
         # Add new inner lists for this session
         if not hasattr(self, 'history'):
@@ -404,32 +1016,7 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
             value = session[1]
             session[1].append([])
 
-        n_batches = int(np.ceil(float(n_samples) / self.batch_size))
-        batch_slices = list(gen_even_slices(n_batches * self.batch_size,
-                                            n_batches, n_samples))
-        verbose = self.verbose
-        begin = time.time()
-        for iteration in range(1, self.n_iter + 1):
-            if self.lr_backoff:
-                # If, e.g., we're doing 10 epochs, use the full learning rate for
-                # the first iteration, 90% of the base learning rate for the second
-                # iteration... and 10% for the final iteration
-                self.learning_rate = ((self.n_iter - (iteration - 1)) / (self.n_iter+0.0)) * self.base_learning_rate
-                print ("Using learning rate of {:.3f} (base LR={:.3f})".format(self.learning_rate, self.base_learning_rate))
-
-            for batch_slice in batch_slices:
-                self._fit(X[batch_slice])
-
-            if verbose and iteration != self.n_iter:
-                end = time.time()
-                self.wellness_check(iteration, end - begin, X, validation)
-                begin = end
-            if iteration != self.n_iter:
-                X = shuffle(X)
-
-        return self
-
-    def wellness_check(self, epoch, duration, train, validation):
+    def wellness_check(self, epoch, duration, train, validation, batch=None):
         """Log some diagnostic information on how the model is doing so far."""
         validation_debug = ''
         if validation is not None:
@@ -439,12 +1026,13 @@ class BernoulliRBM(BaseEstimator, TransformerMixin):
             self.record('overfit', (v_energy, t_energy))
 
         # TODO: This is pretty expensive. Figure out why? Or just do less often.
-        # Also, can use crippling amounts of memory for large datasets. Hack...
-        pseudo = self.score_samples(train[:min(train.shape[0], 10**5)])
+        # (See Monitor for how to do it less often, or on fewer examples.)
+        pseudo = self.score_samples(train, exact=EXACT_PSEUDOLIKELIHOOD)
         self.record('pseudo-likelihood', pseudo.mean())
-        print (re.sub('\n *', '\n', """[{}] Iteration {}/{}\tt = {:.2f}s
+        batch_debug = ' (minibatch {})'.format(batch) if batch is not None else ''
+        print (re.sub('\n *', '\n', """[{}] Iteration {}/{}{}\tt = {:.2f}s
                 Pseudo-log-likelihood sum: {:.2f}\tAverage per instance: {:.2f}{}""".format
-                     (type(self).__name__, epoch, self.n_iter, duration,
+                     (type(self).__name__, epoch, self.n_iter, batch_debug, duration,
                       pseudo.sum(), pseudo.mean(), validation_debug,
                       )))
 
@@ -466,40 +1054,129 @@ class CharBernoulliRBM(BernoulliRBM):
         # Old-style class :(
         BernoulliRBM.__init__(self, *args, **kwargs)
 
-    def wellness_check(self, epoch, duration, train, validation):
-        BernoulliRBM.wellness_check(self, epoch, duration, train, validation)
-        fantasy_samples = '|'.join([self.codec.decode(vec) for vec in
-                                    self._sample_visibles(self.h_samples_[:3], temperature=0.1)])
+    def wellness_check(self, epoch, duration, train, validation, batch=None):
+        BernoulliRBM.wellness_check(self, epoch, duration, train, validation, batch)
+        fantasy_samples = '|'.join(self.codec.decode_batch(
+            self._sample_visibles(self.h_samples_[:3], temperature=0.1)))
         print ("Fantasy samples: {}".format(fantasy_samples))
 
-    def corrupt(self, v):
+    def _softmax_columns(self, v):
+        """Indices of the visible units which are on in v, one per softmax, as an
+        array of shape (n_samples, maxlen)."""
+        n_softmax, n_opts = self.softmax_shape
+        cols = self._onehot_columns(v)
+        # Only use v's own column indices if the kth one belongs to the kth
+        # softmax. CSR matrices built by hand needn't have sorted indices.
+        if cols is not None and (cols.shape[1] != n_softmax
+                                 or not np.all(cols // n_opts == np.arange(n_softmax))):
+            cols = None
+        if cols is None:
+            cols = self._visible_columns(Utils.onehot_to_indices(v, self.softmax_shape))
+        return cols
+
+    def corruption(self, v, rng):
+        """Change one randomly chosen char of each sample to some other char.
+        (See BernoulliRBM.corruption.)"""
         n_softmax, n_opts = self.softmax_shape
-        # Select a random index in to the indices of the non-zero values of each input
         # TODO: In the char-RBM case, if I wanted to really challenge the model, I would avoid selecting any
         # trailing spaces here. Cause any dumb model can figure out that it should assign high energy to
         # any instance of /  [^ ]/
-        meta_indices_to_corrupt = self.rng_.randint(0, n_softmax, v.shape[0]) + np.arange(0, n_softmax * v.shape[0], n_softmax)
+        positions = rng.integers(0, n_softmax, v.shape[0])
+        # Offset the chars by a random amount (but not 0 - we want to actually change them),
+        # wrapping around so we don't "spill over" into a different softmax.
+        offsets = rng.integers(1, n_opts, v.shape[0])
+        old = self._softmax_columns(v)[np.arange(v.shape[0]), positions]
+        new = positions * n_opts + (old - positions * n_opts + offsets) % n_opts
+        cols = np.stack([new, old], axis=1)
+        signs = np.tile([1, -1], (v.shape[0], 1))
+        return cols, signs
+
+    def _exact_pseudolikelihood(self, v):
+        """Sum over all softmax units i of log P(v_i | v_-i), where the conditional
+        is a softmax over the free energies of the nchars strings which differ
+        from v at most in position i. Rather than computing those free energies
+        from scratch, we compute the hidden pre-activations for v once, then for
+        each position get those of the alternatives as base + W[:, new] - W[:, old].
+
+        Note that this is on a different scale than the default estimate from
+        score_samples, which compares each string to one alternative, not nchars-1.
+        """
+        n_softmax, n_opts = self.softmax_shape
+        cols = self._softmax_columns(v)
+        base = self._hidden_preactivation(v)
+        weights = self.components_.T
+        n_samples = v.shape[0]
+        chunk = max(1, SCRATCH_SIZE // (n_opts * self.n_components))
+        pl = np.zeros(n_samples)
+        for pos in range(n_softmax):
+            candidates = slice(pos * n_opts, (pos + 1) * n_opts)
+            candidate_weights = weights[np.newaxis, candidates]
+            for start in range(0, n_samples, chunk):
+                rows = slice(start, min(start + chunk, n_samples))
+                old = cols[rows, pos]
+                # Pre-activations of the hidden units for each candidate char at this position
+                unchanged = base[rows] - weights[old]
+                a = unchanged[:, np.newaxis, :] + candidate_weights
+                # -F(candidate), up to a constant shared by all candidates
+                neg_energy = (np.logaddexp(0, a, out=a).sum(axis=2, dtype=np.float64)
+                              + self.intercept_visible_[candidates])
+                actual = neg_energy[np.arange(neg_energy.shape[0]), old - pos * n_opts]
+                pl[rows] += actual - logsumexp(neg_energy, axis=1)
+        return pl
+
+    # Index-based ('gather') versions of the methods above. Rather than an
+    # (n_samples, maxlen*nchars) array of one-hot vectors, these take visible
+    # configurations as an (n_samples, maxlen) array of char indices.
+
+    def _visible_columns(self, idx):
+        """Map an (n_samples, maxlen) array of char indices to the indices of
+        the corresponding visible units."""
+        n_softmax, n_opts = self.softmax_shape
+        return idx + n_opts * np.arange(n_softmax)
+
+    def _hidden_activations_indices(self, idx, out=None):
+        """Computes v . W^T for the visible configurations given by char indices
+        idx, by summing the columns of components_ corresponding to the units
+        which are on (one per softmax).
+
+        Returns
+        -------
+        a : array-like, shape (n_samples, n_components)
+        """
+        return self._hidden_activations_columns(self._visible_columns(idx), out=out)
+
+    def _mean_hiddens_indices(self, idx, temperature=1.0, out=None):
+        """Computes the probabilities P(h=1|v) for char indices idx.
+
+        idx : array-like, shape (n_samples, maxlen)
+
+        temperature : float or array-like, shape (n_samples,), optional
 
-        # Offset these indices by a random amount (but not 0 - we want to actually change them)
-        offsets = self.rng_.randint(1, n_opts, v.shape[0])
-        # Also, do some math to make sure we don't "spill over" into a different softmax.
-        # E.g. if n_opts=5, and we're corrupting index 3, we should choose offsets from {-3, -2, -1, +1}
-        # 1-d array that matches with meta_i_t_c but which contains the indices themselves
-        indices_to_corrupt = v.indices[meta_indices_to_corrupt]
-        # Sweet lucifer
-        offsets = offsets - (n_opts * (((indices_to_corrupt % n_opts) + offsets.ravel()) >= n_opts))
+        Returns
+        -------
+        h : array-like, shape (n_samples, n_components)
+        """
+        p = self._hidden_activations_indices(idx, out=out)
+        self._activate(p, self.intercept_hidden_, temperature)
+        return expit(p, out=p)
 
-        v.indices[meta_indices_to_corrupt] += offsets
-        return v, (meta_indices_to_corrupt, offsets)
+    def _sample_hiddens_indices(self, idx, temperature=1.0, out=None, rng=None):
+        p = self._mean_hiddens_indices(idx, temperature, out=out)
+        return self._sample_bernoulli(p, 'uniform_h', rng)
 
-    def uncorrupt(self, visibles, state):
-        mitc, offsets = state
-        visibles.indices[mitc] -= offsets
+    def _free_energy_indices(self, idx, temperature=1.0):
+        """Equivalent to _free_energy, for visibles given as char indices."""
+        a = self._hidden_activations_indices(idx)
+        self._activate(a, self.intercept_hidden_, temperature)
+        visible_term = self.intercept_visible_[self._visible_columns(idx)].sum(axis=1, dtype=np.float64)
+        if np.ndim(temperature) or temperature != 1.0:
+            visible_term /= _bias_temperature(temperature)
+        return - visible_term - np.logaddexp(0, a, out=a).sum(axis=1, dtype=np.float64)
 
 
 class CharBernoulliRBMSoftmax(CharBernoulliRBM):
 
-    def _sample_visibles(self, h, temperature=1.0):
+    def _sample_visibles(self, h, temperature=1.0, out=None, visible_bias=None, rng=None):
         """Sample from the distribution P(v|h). This obeys the softmax constraint
         on visible units. i.e. sum(v) == softmax_shape[0] for any visible
         configuration v.
@@ -507,13 +1184,83 @@ class CharBernoulliRBMSoftmax(CharBernoulliRBM):
         h : array-like, shape (n_samples, n_components)
             Values of the hidden layer to sample from.
 
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature, or one temperature per sample.
+
+        out : array, shape (n_samples, n_features), optional
+            Where to write the result.
+
+        visible_bias : array-like, shape (n_features,) or (n_samples, n_features), optional
+            Added to the visible biases (e.g. to steer samples towards some
+            lengths - see Sampling.length_bias), without touching the model.
+
+        rng : numpy.random.Generator, optional
+            Where to draw random numbers from. Defaults to the model's own
+            (per-thread) generator.
+
         Returns
         -------
         v : array-like, shape (n_samples, n_features)
             Values of the visible layer.
         """
-        p = np.dot(h, self.components_/temperature)
-        p += self.intercept_visible_/(min(1.0, temperature) if BIASED_PRIOR else temperature)
-        nsamples, nfeats = p.shape
-        reshaped = np.reshape(p, (nsamples,) + self.softmax_shape)
-        return Utils.softmax_and_sample(reshaped).reshape((nsamples, nfeats))
+        idx = self._sample_visibles_indices(h, temperature, visible_bias, rng)
+        return Utils.indices_to_onehot(idx, self.softmax_shape[1], out=out, dtype=self.components_.dtype)
+
+    def _sample_visibles_indices(self, h, temperature=1.0, visible_bias=None, rng=None):
+        """Sample from the distribution P(v|h), returning the index of the
+        value chosen for each softmax unit rather than one-hot vectors.
+
+        h : array-like, shape (n_samples, n_components)
+            Values of the hidden layer to sample from.
+
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature, or one temperature per sample.
+
+        visible_bias : array-like, shape (n_features,) or (n_samples, n_features), optional
+            Added to the visible biases (e.g. to steer samples towards some
+            lengths - see Sampling.length_bias), without touching the model.
+
+        rng : numpy.random.Generator, optional
+            Where to draw random numbers from. Defaults to the model's own
+            (per-thread) generator.
+
+        Returns
+        -------
+        idx : array-like, shape (n_samples, maxlen)
+            Char indices of the visible layer.
+        """
+        logits = self._get_workspace().get('logits', (h.shape[0], self.components_.shape[1]),
+                                           self.components_.dtype)
+        p = _dot(h, self.components_, out=logits)
+        self._activate(p, self._visible_bias(visible_bias), temperature)
+        reshaped = np.reshape(p, (p.shape[0],) + self.softmax_shape)
+        if rng is None:
+            rng = self._get_workspace().rng
+        return Utils.softmax_sample_indices(reshaped, copy=False, rng=rng)
+
+    def gibbs_indices(self, idx, temperature=1.0, visible_bias=None, rng=None):
+        """Perform one Gibbs sampling step, with visibles represented as
+        char indices (see _visible_columns). Never materializes one-hot vectors.
+
+        idx : array-like, shape (n_samples, maxlen)
+            Char indices of the visible layer to start from.
+
+        temperature : float or array-like, shape (n_samples,), optional
+            Temperature to sample at, or one temperature per sample.
+
+        visible_bias : array-like, shape (n_features,) or (n_samples, n_features), optional
+            Added to the visible biases (e.g. to steer samples towards some
+            lengths - see Sampling.length_bias), without touching the model.
+
+        rng : numpy.random.Generator, optional
+            Where to draw random numbers from. Defaults to the model's own
+            (per-thread) generator.
+
+        Returns
+        -------
+        idx_new : array-like, shape (n_samples, maxlen)
+            Char indices of the visible layer after one Gibbs step.
+        """
+        check_is_fitted(self, "components_")
+        h_ = self._sample_hiddens_indices(idx, temperature, out=self._hidden_scratch(idx.shape[0]), rng=rng)
+        return self._sample_visibles_indices(h_, temperature, visible_bias, rng)
@@ -1,10 +1,13 @@
 from __future__ import division
 import argparse
-import pickle
 import numpy as np
 import enum
+import threading
+import warnings
+from scipy.sparse import issparse
 
 import Utils
+import ModelIO
 from ShortTextCodec import ShortTextCodec
 
 MAX_PROG_SAMPLE_INTERVAL = 10000
@@ -16,34 +19,61 @@ LINEAR_ANNEAL = 0
 
 BIG_NUMBER = 3.0
 
+def length_bias(codec, n, min_length=0, max_length=0, dtype=np.float64):
+    """Return extra visible biases which push n samples towards lengths between
+    min_length and max_length (inclusive), by discouraging padding within the
+    first min_length chars and encouraging it after the first max_length.
+    min_length and max_length may be scalars, giving one row of shape
+    (maxlen * nchars,) which applies to every sample, or arrays of shape (n,)
+    giving each particle its own range, in which case the result has shape
+    (n, maxlen * nchars). A max_length of 0 means no max. Pass the result as the
+    visible_bias of model.gibbs etc.
+    """
+    maxlen, nchars = codec.maxlen, codec.nchars
+    per_particle = np.ndim(min_length) or np.ndim(max_length)
+    rows = n if per_particle else 1
+    min_length = np.broadcast_to(min_length, (rows,)).reshape(rows, 1)
+    max_length = np.broadcast_to(max_length, (rows,)).reshape(rows, 1)
+    max_length = np.where(max_length == 0, maxlen, max_length)
+    assert np.all((1 <= max_length) & (max_length <= maxlen))
+    assert np.all((0 <= min_length) & (min_length <= maxlen))
+    bias = np.zeros((rows, maxlen, nchars), dtype=dtype)
+    # Codecs with no filler only do strings of exactly maxlen, so there's nothing to push
+    if codec.filler_index != -1:
+        # How far into the string each position is (left-padded strings end at the last position)
+        posn = np.arange(maxlen)
+        if codec.leftpad:
+            posn = posn[::-1]
+        bias[:, :, codec.filler_index] = (
+            np.where(posn < min_length, -BIG_NUMBER, 0.0) + np.where(posn >= max_length, BIG_NUMBER, 0.0))
+    bias = bias.reshape(rows, maxlen * nchars)
+    return bias if per_particle else bias[0]
+
 class shrink_model(object):
+    """Deprecated: pass visible_bias=length_bias(...) to the samplers instead.
+
+    Context manager which adds length_bias(model.codec, 1, min_length, max_length)
+    to the model's own visible biases for the duration, which isn't safe while
+    other threads are sampling from the model. The bias is also available as
+    visible_bias, for callers moving off this.
+    """
 
     def __init__(self, model, min_length, max_length):
+        warnings.warn("shrink_model is deprecated. Pass visible_bias=length_bias(...) to the samplers instead.",
+                      DeprecationWarning, stacklevel=2)
         assert 1 <= max_length <= model.codec.maxlen
         assert 0 <= min_length <= model.codec.maxlen
         self.model = model
-        self.min_length = min_length
-        self.max_length = max_length
+        self.visible_bias = length_bias(model.codec, 1, min_length, max_length,
+                                        model.intercept_visible_.dtype)
 
     def __enter__(self):
-        codec = self.model.codec
-        model = self.model
-        padidx = codec.char_lookup[codec.filler]
-        self.prev_biases = [model.intercept_visible_[codec.nchars*posn+padidx] for posn in range(codec.maxlen)]
-        # Force padding character off for all indices up to min length
-        for posn in range(self.min_length):
-            model.intercept_visible_[codec.nchars*posn + padidx] += -1*BIG_NUMBER
-
-        # Force padding character *on* for indices past max length
-        for posn in range(self.max_length, codec.maxlen):
-            model.intercept_visible_[codec.nchars*posn + padidx] += BIG_NUMBER
+        self.prev_biases = self.model.intercept_visible_.copy()
+        self.model.intercept_visible_ += self.visible_bias
+        return self
 
     def __exit__(self, *args):
-        padidx = self.model.codec.char_lookup[self.model.codec.filler]
-        for posn, bias in enumerate(self.prev_biases):
-            self.model.intercept_visible_[self.model.codec.nchars*posn + padidx] = bias
-            
-        
+        self.model.intercept_visible_[:] = self.prev_biases
 
 class VisInit(enum.Enum):
     """Ways of initializing visible units before repeated gibbs sampling."""
@@ -67,19 +97,32 @@ class VisInit(enum.Enum):
 class BadInitMethodException(Exception):
     pass
 
-def starting_visible_configs(init_method, n, model, training_examples_fname=None):
+def spawn_rngs(seed, n):
+    """Return n independent Generators, spawned from the given seed (an int,
+    SeedSequence, or None for fresh entropy). Give each sampling thread (or
+    process) one of these, for reproducible, independent streams."""
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n)]
+
+def _generator(rng):
+    # None means 'the default source of randomness', whatever that is. Otherwise
+    # accept a Generator, or a seed for one.
+    return None if rng is None else np.random.default_rng(rng)
+
+def starting_visible_configs(init_method, n, model, training_examples_fname=None, rng=None):
     """Return an ndarray of n visible configurations for the given model
-    according to the specified init method (which should be a member of the VisInit enum)
+    according to the specified init method (which should be a member of the VisInit enum).
+    Random numbers come from rng (a Generator) if given, else the global RNGs.
     """
+    rng = _generator(rng)
     vis_shape = (n, model.intercept_visible_.shape[0])
     maxlen, nchars = model.codec.maxlen, model.codec.nchars
     if init_method == VisInit.biases:
         sm = np.tile(model.intercept_visible_, [n, 1]).reshape( (-1,) + model.codec.shape() )
-        return Utils.softmax_and_sample(sm).reshape(vis_shape)
+        return Utils.softmax_and_sample(sm, rng=rng).reshape(vis_shape)
     elif init_method == VisInit.zeros:
         return np.zeros(vis_shape)
     elif init_method == VisInit.uniform:
-        return np.random.randint(0, 2, vis_shape)
+        return np.random.randint(0, 2, vis_shape) if rng is None else rng.integers(0, 2, vis_shape)
     # This will fail if ' ' isn't in the alphabet of this model
     elif init_method == VisInit.spaces or init_method == VisInit.padding:
         fillchar = {VisInit.spaces: ' ', VisInit.padding: model.codec.filler}[init_method]
@@ -93,6 +136,9 @@ def starting_visible_configs(init_method, n, model, training_examples_fname=None
         return vis.reshape(vis_shape)
     elif init_method == VisInit.train or init_method == VisInit.silhouettes:
         assert training_examples_fname is not None, "No training examples provided to initialize with"
+        if rng is not None and init_method == VisInit.silhouettes:
+            indices = Utils.load_char_indices(training_examples_fname, model.codec, limit=n)
+            return Utils.onehot_csr(model.codec.mutagen_silhouettes_batch(indices, rng), nchars)
         mutagen = model.codec.mutagen_silhouettes if init_method == VisInit.silhouettes else None
         examples = Utils.vectors_from_txtfile(training_examples_fname, model.codec, limit=n, mutagen=mutagen)
         return examples
@@ -101,81 +147,491 @@ def starting_visible_configs(init_method, n, model, training_examples_fname=None
         # I don't think I'll ever write idiomatic numpy.
 
         # Start w uniform dist
-        char_indices = np.random.randint(0, nchars, (n,maxlen))
+        if rng is None:
+            char_indices = np.random.randint(0, nchars, (n,maxlen))
+        else:
+            char_indices = rng.integers(0, nchars, (n,maxlen))
         if init_method == VisInit.chunks:
             # Choose some random lengths
-            lengths = np.clip(maxlen*.25 * np.random.randn(n) + (maxlen*.66), 1, maxlen
+            noise = np.random.randn(n) if rng is None else rng.standard_normal(n)
+            lengths = np.clip(maxlen*.25 * noise + (maxlen*.66), 1, maxlen
                 ).astype('int8').reshape(n, 1)
             _, i = np.indices((n, maxlen))
             char_indices[i>=lengths] = model.codec.char_lookup[model.codec.filler]
-        
-        # TODO: This is a useful little trick. Make it a helper function and reuse it elsewhere?
-        return np.eye(nchars)[char_indices.ravel()].reshape(vis_shape)
+
+        return Utils.indices_to_onehot(char_indices, nchars)
     else:
         raise ValueError("Unrecognized init method: {}".format(init_method))
 
 
 def print_sample_callback(sample_strings, i, energy=None):
     if energy is not None:
-        print ("\n").join('{}\t{:.2f}'.format(t[0], t[1]) for t in zip(sample_strings, energy))
+        print ("\n".join('{}\t{:.2f}'.format(t[0], t[1]) for t in zip(sample_strings, energy)))
     else:
-        print ("\n").join(sample_strings)
-    print
+        print ("\n".join(sample_strings))
+    print ()
 
 @Utils.timeit
 def sample_model(model, n, iters, sample_iter_indices, 
                  start_temp=1.0, final_temp=1.0,
                  callback=print_sample_callback, init_method=VisInit.biases, training_examples=None, 
                  sample_energy=False, starting_vis=None, min_length=0, max_length=0,
-                 ):
+                 rng=None):
+    """Run n chains of Gibbs sampling for iters rounds, annealing from start_temp
+    to final_temp, and call callback with the decoded samples at each iteration
+    in sample_iter_indices. start_temp and final_temp may be scalars, or arrays of
+    shape (n,) giving each chain its own schedule. Likewise min_length and
+    max_length (see length_bias). The model itself is never modified, so it's
+    safe to sample from it in several threads at once. Note that this means the
+    energies given to callback with sample_energy are those of the unmodified
+    model, without the length biases.
+
+    rng, if given, is a Generator (or a seed for one) which all random numbers
+    are drawn from, so that a given Generator state always gives the same
+    samples. Otherwise, they come from the model's per-thread generator and the
+    global RNGs.
+    """
+    rng = _generator(rng)
     if callback is None:
-        callback = lambda: None 
+        callback = lambda *args: None
     if starting_vis is not None:
         vis = starting_vis
     else:
-        vis = starting_visible_configs(init_method, n, model, training_examples)
-
-    args = [model, vis, iters, sample_iter_indices, start_temp, final_temp, callback, sample_energy]
-    if min_length or max_length:
-        if max_length == 0:
-            max_length = model.codec.maxlen
-        with shrink_model(model, min_length, max_length):
-            return _sample_model(*args)
-    else:
-        return _sample_model(*args)
+        vis = starting_visible_configs(init_method, n, model, training_examples, rng)
 
-def _sample_model(model, vis, iters, sample_iter_indices, start_temp, final_temp, callback,
-                 sample_energy):
+    visible_bias = None
+    if np.any(min_length) or np.any(max_length):
+        visible_bias = length_bias(model.codec, vis.shape[0], min_length, max_length,
+                                   model.intercept_visible_.dtype)
+    return _sample_model(model, vis, iters, sample_iter_indices, start_temp, final_temp, callback,
+                         sample_energy, visible_bias, rng)
 
+def _temperatures(start_temp, final_temp, iters, n=None):
+    """Yield the temperature to use at each of iters rounds of sampling, annealing
+    from start_temp to final_temp. start_temp and final_temp may also be arrays with
+    one value per particle (n of them), to run many annealing schedules (or fixed
+    temperatures) in one batch.
+    """
+    if np.ndim(start_temp) or np.ndim(final_temp):
+        start_temp = np.array(np.broadcast_to(start_temp, (n,)), dtype=float)
+        final_temp = np.asarray(final_temp, dtype=float)
+    if iters == 0:
+        return
     temp = start_temp
     temp_decay = (final_temp/start_temp)**(1/iters)
     temp_delta = (final_temp-start_temp)/iters
-    next_sample_metaindex = 0
     for i in range(iters):
+        yield temp
+        if LINEAR_ANNEAL:
+            temp += temp_delta
+        else:
+            temp *= temp_decay
+
+class GibbsChains(object):
+    """A batch of Gibbs chains, and their current state.
+
+    Models with softmax visible units can run the chains on (n, maxlen) arrays
+    of char indices rather than one-hot vectors. We take the first step using
+    the regular one-hot representation in case the starting configurations
+    aren't valid one-hot vectors (e.g. VisInit.zeros).
+
+    visible_bias, if given, is added to the model's visible biases when
+    sampling (e.g. from length_bias). rng, if given, is the Generator to draw
+    random numbers from.
+    """
+
+    def __init__(self, model, vis, visible_bias=None, rng=None):
+        self.model = model
+        self.vis = vis
+        self.idx = None
+        self.visible_bias = visible_bias
+        self.rng = rng
+        self.use_indices = hasattr(model, 'gibbs_indices')
+
+    def __len__(self):
+        return self.vis.shape[0] if self.idx is None else self.idx.shape[0]
+
+    def step(self, temperature=1.0):
+        self.set_state(*self.next_state(temperature))
+
+    def next_state(self, temperature=1.0):
+        """Return the (vis, idx) state after one more round of sampling, without
+        moving the chains there (see set_state)."""
+        if self.idx is not None:
+            return None, self.model.gibbs_indices(self.idx, temperature, self.visible_bias, self.rng)
+        vis = self.model.gibbs(self.vis, temperature, self.visible_bias, self.rng)
+        if self.use_indices:
+            return None, Utils.onehot_to_indices(vis, self.model.codec.shape())
+        return vis, None
+
+    def set_state(self, vis, idx):
+        self.vis, self.idx = vis, idx
+
+    def decode(self, rows=slice(None)):
+        """Decode the current state of the chains (or just the given rows)."""
+        if self.idx is not None:
+            return self.model.codec.decode_indices(self.idx[rows], pretty=True)
+        return self.model.codec.decode_batch(self.vis[rows], pretty=True, strict=False)
+
+    def energy(self, rows=slice(None)):
+        if self.idx is not None:
+            return self.model._free_energy_indices(self.idx[rows])
+        return self.model._free_energy(self.vis[rows])
+
+    def visibles(self):
+        if self.idx is not None:
+            return Utils.indices_to_onehot(self.idx, self.model.codec.nchars)
+        return self.vis
+
+    def indices(self):
+        """Return the chains' states as char indices, and a boolean array saying
+        which of them are valid (i.e. have exactly one unit on per softmax)."""
+        if self.idx is not None:
+            return self.idx, np.ones(len(self.idx), dtype=bool)
+        shape = self.model.codec.shape()
+        vis = self.vis.toarray() if issparse(self.vis) else self.vis
+        valid = (np.count_nonzero(np.reshape(vis, (-1,) + shape), axis=2) == 1).all(axis=1)
+        return Utils.onehot_to_indices(vis, shape), valid
+
+def _sample_model(model, vis, iters, sample_iter_indices, start_temp, final_temp, callback,
+                 sample_energy, visible_bias=None, rng=None):
+    chains = GibbsChains(model, vis, visible_bias, rng)
+    next_sample_metaindex = 0
+    for i, temp in enumerate(_temperatures(start_temp, final_temp, iters, vis.shape[0])):
         if i == sample_iter_indices[next_sample_metaindex]:
             # Time to take samples
-            sample_strings = [model.codec.decode(v, pretty=True, strict=False) for v in vis]
+            sample_strings = chains.decode()
             if sample_energy:
-                energy = model._free_energy(vis)
-                callback(sample_strings, i, energy)
+                callback(sample_strings, i, chains.energy())
             else:
                 callback(sample_strings, i)
             next_sample_metaindex += 1
             if next_sample_metaindex == len(sample_iter_indices):
                 break
-        vis = model.gibbs(vis, temp)
-        if LINEAR_ANNEAL:
-            temp += temp_delta
-        else:
-            temp *= temp_decay
-    return vis
+        chains.step(temp)
+    return chains.visibles()
+
+class KeySet(object):
+    """A set of keys from Utils.index_keys (uint64s, or records of several),
+    stored in a handful of sorted arrays, so it takes 8 bytes per key word, and
+    lookups and insertions are vectorized. The arrays are merged like the digits
+    of a binary counter, so there are never more than log2(len(self)) of them.
+    """
+
+    def __init__(self, keys=None):
+        self._runs = []
+        if keys is not None:
+            self.add(keys)
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs)
+
+    def contains(self, keys):
+        """Return a boolean array saying which of the given keys are in the set."""
+        keys = _as_keys(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self._runs:
+            pos = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            found |= run[pos] == keys
+        return found
+
+    def add(self, keys):
+        """Add the given keys to the set. Returns a boolean array saying which
+        of them were new (only the first occurrence of a key repeated within
+        keys counts as new)."""
+        keys = _as_keys(keys)
+        distinct, first = np.unique(keys, return_index=True)
+        unseen = ~self.contains(distinct)
+        new = np.zeros(len(keys), dtype=bool)
+        new[first[unseen]] = True
+        run = distinct[unseen]
+        if len(run):
+            while self._runs and len(self._runs[-1]) <= len(run):
+                run = np.sort(np.concatenate([self._runs.pop(), run]))
+            self._runs.append(run)
+        return new
+
+def _as_keys(keys):
+    if isinstance(keys, np.ndarray) and keys.dtype.names:
+        return keys
+    return np.asarray(keys, dtype=np.uint64)
+
+def sample_keys(codec, indices):
+    """Keys for a KeySet such that samples get the same key iff they decode to
+    the same string."""
+    return Utils.index_keys(codec.canonical_indices(indices), codec.nchars)
+
+def iter_unique_samples(model, n=None, n_chains=100, burn_in=10**3, sample_every=10,
+                        start_temp=1.0, final_temp=1.0, init_method=VisInit.biases,
+                        training_examples=None, exclude=(), seen=None, sample_energy=False,
+                        max_iters=None, novelty=None, min_distance=1, min_length=0, max_length=0,
+                        rng=None):
+    """Yield distinct samples from model as soon as the chains come up with them.
+
+    Runs n_chains chains for burn_in rounds of Gibbs sampling (annealing from
+    start_temp to final_temp), then keeps running them at final_temp, taking
+    samples every sample_every rounds. Each sample that hasn't come up before
+    is yielded (as a string, or a (string, free energy) tuple if sample_energy).
+    Stops after n samples, or max_iters rounds of sampling in total (if either
+    is given). min_length, max_length and rng work as for sample_model.
+
+    Samples are remembered by their keys (see sample_keys) in the KeySet
+    seen, so memory use is 8 bytes per distinct sample (or 16, for codecs
+    whose strings take more than 64 bits to tell apart, e.g. maxlen 20 with
+    28 chars), and nothing else is buffered. Passing in the seen set from a previous call carries on where
+    it left off. Strings in the text files listed in exclude (e.g. the
+    training data) are never yielded.
+
+    novelty, if given, is a NoveltyIndex (e.g. of the training data). Samples
+    in it aren't yielded, and nor are samples less than min_distance edits
+    away from everything in it.
+    """
+    if novelty is not None:
+        assert novelty.codec.config() == model.codec.config(), "Novelty index was built with a different codec"
+    if n is not None and n <= 0:
+        return
+    if seen is None:
+        seen = KeySet()
+    for fname in exclude:
+        seen.add(sample_keys(model.codec, Utils.load_char_indices(fname, model.codec)))
+    rng = _generator(rng)
+    vis = starting_visible_configs(init_method, n_chains, model, training_examples, rng)
+    visible_bias = None
+    if np.any(min_length) or np.any(max_length):
+        visible_bias = length_bias(model.codec, n_chains, min_length, max_length,
+                                   model.intercept_visible_.dtype)
+    chains = GibbsChains(model, vis, visible_bias, rng)
+    for temp in _temperatures(start_temp, final_temp, burn_in, n_chains):
+        chains.step(temp)
+    yielded = 0
+    iters = burn_in
+    while max_iters is None or iters < max_iters:
+        idx, valid = chains.indices()
+        new = seen.add(sample_keys(model.codec, idx[valid]))
+        if new.any():
+            rows = np.flatnonzero(valid)[new]
+            if novelty is not None:
+                if min_distance > 1:
+                    rows = rows[novelty.nearest(idx[rows])[0] >= min_distance]
+                else:
+                    rows = rows[~novelty.contains(idx[rows])]
+            strings = model.codec.decode_indices(idx[rows], pretty=True)
+            if sample_energy:
+                energy = chains.energy(rows)
+                strings = zip(strings, energy)
+            for s in strings:
+                yield s
+                yielded += 1
+                if yielded == n:
+                    return
+        for _ in range(sample_every):
+            chains.step(final_temp)
+        iters += sample_every
+
+class ChainPool(object):
+    """A pool of Gibbs chains which are kept running between calls, so that
+    samples can be handed out without waiting for a fresh batch of chains to
+    burn in.
+
+    Chains run at a fixed temperature. A chain can be sampled once it has gone
+    decorrelation rounds of sampling since it was last sampled (or burn_in
+    rounds since it started). If background is true, a daemon thread sweeps the
+    pool whenever some chains aren't ready, so that it refills between calls to
+    sample(). Otherwise, sample() sweeps the pool itself when it runs short.
+
+    Use chain_pool() to get the pool attached to a model, rather than making a
+    new one (and burning it in) each time.
+
+    rng works as for sample_model. Only one thread at a time ever sweeps the
+    pool, so a pool can have its own Generator.
+    """
+
+    def __init__(self, model, n_chains=1000, burn_in=10**3, decorrelation=20, temperature=1.0,
+                 init_method=VisInit.biases, training_examples=None, background=True, rng=None):
+        assert decorrelation >= 1
+        self.model = model
+        self.decorrelation = decorrelation
+        self.temperature = temperature
+        rng = _generator(rng)
+        vis = starting_visible_configs(init_method, n_chains, model, training_examples, rng)
+        self.chains = GibbsChains(model, vis, rng=rng)
+        # Rounds of sampling since each chain was last sampled. Start everything
+        # off burn_in rounds short of being ready.
+        self.ages = np.full(n_chains, decorrelation - burn_in)
+        self.sweeps = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._refill, name='ChainPool refill')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __len__(self):
+        return len(self.ages)
+
+    def ready(self):
+        """The number of chains which can be sampled right now."""
+        with self._cond:
+            return int((self.ages >= self.decorrelation).sum())
+
+    def _sweep(self):
+        # Caller must hold the lock
+        self.chains.step(self.temperature)
+        self.ages += 1
+        self.sweeps += 1
+
+    def _refill(self):
+        while True:
+            with self._cond:
+                while not self._closed and (self.ages >= self.decorrelation).all():
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # Work out the next state without holding the lock, so that sample()
+            # can hand out chains which are ready in the meantime. Moving to it
+            # and bumping the ages happen together under the lock, so a chain
+            # sampled mid-sweep is exactly one sweep past its sample afterwards,
+            # which is what its age says.
+            vis, idx = self.chains.next_state(self.temperature)
+            with self._cond:
+                self.chains.set_state(vis, idx)
+                self.ages += 1
+                self.sweeps += 1
+                self._cond.notify_all()
+
+    def sample(self, n, sample_energy=False):
+        """Return n samples (decoded strings) from chains which are ready, oldest
+        first, waiting for chains to come ready as needed. If sample_energy,
+        also return an array of their free energies.
+        """
+        strings = []
+        energy = []
+        with self._cond:
+            while len(strings) < n:
+                ready = np.flatnonzero(self.ages >= self.decorrelation)
+                if len(ready) == 0:
+                    if self._thread is not None:
+                        self._cond.wait()
+                    else:
+                        self._sweep()
+                    continue
+                rows = ready[np.argsort(-self.ages[ready], kind='stable')][:n - len(strings)]
+                strings += self.chains.decode(rows)
+                if sample_energy:
+                    energy.append(self.chains.energy(rows))
+                self.ages[rows] = 0
+                # Let the refill thread know there's work to do
+                self._cond.notify_all()
+        if sample_energy:
+            return strings, np.concatenate(energy) if energy else np.zeros(0)
+        return strings
+
+    def close(self):
+        """Stop the refill thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+_CHAIN_POOL_LOCK = threading.Lock()
+
+def chain_pool(model, **kwargs):
+    """Return the ChainPool attached to model, first creating one with the given
+    kwargs (see ChainPool) if there isn't one yet."""
+    with _CHAIN_POOL_LOCK:
+        pool = getattr(model, '_chain_pool', None)
+        if pool is None:
+            pool = model._chain_pool = ChainPool(model, **kwargs)
+    return pool
+
+@Utils.timeit
+def sample_model_tempered(model, n, iters, sample_iter_indices, temperatures,
+                          swap_every=1, callback=print_sample_callback, init_method=VisInit.biases,
+                          training_examples=None, sample_energy=False, starting_vis=None, rng=None):
+    """Parallel tempering (aka replica exchange). Runs n chains, each having one
+    replica per temperature in temperatures, all stacked in one batch so that
+    each round of Gibbs sampling is a single call to model.gibbs with per-row
+    temperatures. Every swap_every rounds, replicas at adjacent temperatures
+    propose to swap states (alternating between even and odd pairs of rungs),
+    and accept with the usual Metropolis probability. The hot replicas explore
+    freely, and hand off their discoveries to the colder ones.
+
+    Samples passed to the callback (and the returned visibles) come from the
+    replicas at temperatures[0], which should be the temperature we actually
+    care about (usually 1.0).
+
+    starting_vis, if provided, should have n * len(temperatures) rows. rng works
+    as for sample_model.
+    """
+    rng = _generator(rng)
+    temperatures = np.asarray(temperatures, dtype=float)
+    n_rungs = len(temperatures)
+    if starting_vis is not None:
+        vis = starting_vis
+    else:
+        vis = starting_visible_configs(init_method, n * n_rungs, model, training_examples, rng)
+
+    # Rather than moving states between rows on a successful swap, we swap the
+    # rows' temperatures. rung_rows[r, c] is the row holding the replica of
+    # chain c which is currently at temperatures[r].
+    rung_rows = np.arange(n_rungs * n).reshape(n_rungs, n)
+    row_temps = np.repeat(temperatures, n)
+    next_sample_metaindex = 0
+    for i in range(iters):
+        if i == sample_iter_indices[next_sample_metaindex]:
+            coldest = vis[rung_rows[0]]
+            sample_strings = model.codec.decode_batch(coldest, pretty=True, strict=False)
+            if sample_energy:
+                callback(sample_strings, i, model._free_energy(coldest))
+            else:
+                callback(sample_strings, i)
+            next_sample_metaindex += 1
+            if next_sample_metaindex == len(sample_iter_indices):
+                break
+        vis = model.gibbs(vis, row_temps, rng=rng)
+        if (i + 1) % swap_every == 0:
+            _swap_replicas(model, vis, temperatures, rung_rows, row_temps, ((i + 1) // swap_every) % 2, rng)
+    return vis[rung_rows[0]]
+
+def _swap_replicas(model, vis, temperatures, rung_rows, row_temps, parity, rng=None):
+    """Propose swaps between each replica at rung r and the one at rung r+1 of the
+    same chain, for every r of the given parity. Updates rung_rows and row_temps
+    in place. Returns the fraction of proposals accepted.
+    """
+    lower = np.arange(parity, len(temperatures) - 1, 2)
+    if len(lower) == 0:
+        return 0.0
+    n = rung_rows.shape[1]
+    rows_lo = rung_rows[lower].ravel()
+    rows_hi = rung_rows[lower + 1].ravel()
+    temps_lo = np.repeat(temperatures[lower], n)
+    temps_hi = np.repeat(temperatures[lower + 1], n)
+    rows = np.concatenate([rows_lo, rows_hi])
+    states = vis[rows]
+    own = model._free_energy(states, np.concatenate([temps_lo, temps_hi]))
+    other = model._free_energy(states, np.concatenate([temps_hi, temps_lo]))
+    m = len(rows_lo)
+    # log of p_lo(x_hi) p_hi(x_lo) / (p_lo(x_lo) p_hi(x_hi))
+    log_ratio = (own[:m] + own[m:]) - (other[:m] + other[m:])
+    uniform = np.random.rand(m) if rng is None else rng.random(m)
+    accept = np.log(uniform) < log_ratio
+    rung_lo = np.repeat(lower, n)[accept]
+    chain = np.tile(np.arange(n), len(lower))[accept]
+    rung_rows[rung_lo, chain] = rows_hi[accept]
+    rung_rows[rung_lo + 1, chain] = rows_lo[accept]
+    row_temps[rows_hi[accept]] = temps_lo[accept]
+    row_temps[rows_lo[accept]] = temps_hi[accept]
+    return accept.mean()
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Sample short texts from a pickled model',
+    parser = argparse.ArgumentParser(description='Sample short texts from a saved model',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('model_fname', metavar='model.pickle', nargs='+',
-                        help='One or more pickled RBM models')
+    parser.add_argument('model_fname', metavar='model.rbm', nargs='+',
+                        help='One or more RBM models (as saved by train.py, or legacy pickles)')
     parser.add_argument('-n', '--n-samples', dest='n_samples', type=int, default=30,
                               help='How many samples to draw')
     parser.add_argument('-i', '--iters', dest='iters', type=int, default=10**4,
@@ -185,16 +641,16 @@ if __name__ == '__main__':
     parser.add_argument('--init', '--init-method', dest='init_method', default='silhouettes', help="How to initialize vectors before sampling")
     parser.add_argument('--energy', action='store_true', help='Along with each sample generated, print its free energy')
     parser.add_argument('--every', type=int, default=None, help='Sample once every this many iters. Incompatible with --prog and --table.')
+    parser.add_argument('--allow-pickle', dest='allow_pickle', action='store_true',
+                        help='Allow loading legacy pickled models. Unpickling can run arbitrary code, so only use this with files you trust.')
 
     args = parser.parse_args()
 
     args.init_method = VisInit[args.init_method]
 
     for model_fname in args.model_fname:
-        print ("Drawing samples from model defined at {}").format(model_fname)
-        f = open(model_fname)
-        model = pickle.load(f)
-        f.close()
+        print ("Drawing samples from model defined at {}".format(model_fname))
+        model = ModelIO.load(model_fname, allow_pickle=args.allow_pickle)
         # TODO: add as arg
         if 'usgeo' in model_fname:
             example_file = 'data/usgeo.txt'
@@ -17,6 +17,9 @@ class ShortTextCodec(object):
     # If a one-hot vector can't be decoded meaningfully, render this char in its place
     MYSTERY = '?'
 
+    # dtype of the arrays of char indices returned by encode_batch. (No codec has anywhere near 2**15 chars.)
+    INDEX_DTYPE = np.int16
+
     # Backward-compatibility. Was probably a mistake to have FILLER be a class var rather than instance
     @property
     def filler(self):
@@ -25,6 +28,19 @@ class ShortTextCodec(object):
         # Old versions of this class used ' ' as filler
         return ' '
 
+    @property
+    def filler_index(self):
+        """Index of the filler char, or -1 if the alphabet doesn't have one
+        (codecs with minlen == maxlen never need padding)."""
+        return self.char_lookup.get(self.filler, -1)
+
+    @property
+    def pretty_filler_index(self):
+        """Index of the padding char which pretty decoding strips, or -1 if
+        there isn't one. (Old codecs pad with ' ', which pretty decoding keeps,
+        like any other space.)"""
+        return self.alphabet.find(self.FILLER)
+
     def __init__(self, extra_chars, maxlength, minlength=0, preserve_case=False, leftpad=False):
         assert 0 <= minlength <= maxlength
         if self.FILLER not in extra_chars and maxlength != minlength:
@@ -54,6 +70,31 @@ class ShortTextCodec(object):
     def debug_description(self):
         return ' '.join('{}={}'.format(attr, repr(getattr(self, attr, None))) for attr in ['maxlen', 'minlen', 'leftpad', 'alphabet', 'nchars'])
 
+    def config(self):
+        """A dict of everything that determines how this codec encodes strings.
+        Two codecs with equal configs produce identical encodings."""
+        return {'class': type(self).__name__,
+                'alphabet': self.alphabet,
+                'maxlen': self.maxlen,
+                'minlen': getattr(self, 'minlen', 0),
+                'leftpad': self.leftpad,
+                }
+
+    @classmethod
+    def from_config(cls, config):
+        """Rebuild a codec from the output of config()."""
+        codec = cls.__new__(cls)
+        codec.maxlen = config['maxlen']
+        codec.minlen = config['minlen']
+        codec.leftpad_ = config['leftpad']
+        codec.alphabet = config['alphabet']
+        codec.char_lookup = {c: i for i, c in enumerate(codec.alphabet)}
+        # Codecs that don't preserve case map uppercase letters to lowercase ones
+        for c in codec.alphabet:
+            if 'a' <= c <= 'z' and c.upper() not in codec.char_lookup:
+                codec.char_lookup[c.upper()] = codec.char_lookup[c]
+        return codec
+
     @property
     def leftpad(self):
         return getattr(self, 'leftpad_', False)
@@ -91,31 +132,164 @@ class ShortTextCodec(object):
 
     def encode_onehot(self, s):
         indices = self.encode(s)
-        return np.eye(self.nchars)[indices].ravel()
+        vec = np.zeros(self.nchars * self.maxlen)
+        vec[np.arange(len(indices)) * self.nchars + indices] = 1
+        return vec
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Derived from char_lookup. Rebuilt on demand.
+        state.pop('_codepoint_table', None)
+        return state
+
+    @property
+    def codepoint_table(self):
+        """An array mapping unicode codepoints to the index of the corresponding
+        char in our alphabet, or -1 for chars we can't encode."""
+        table = getattr(self, '_codepoint_table', None)
+        if table is None:
+            table = np.full(max(ord(c) for c in self.char_lookup) + 1, -1, dtype=self.INDEX_DTYPE)
+            for char, index in self.char_lookup.items():
+                table[ord(char)] = index
+            self._codepoint_table = table
+        return table
+
+    def _encode_batch(self, strings, padlen):
+        """Vectorized _encode. strings is a 1-d numpy unicode array. Returns an
+        array of char indices with shape (n, padlen), and a 1-d array of rejection
+        reasons ('' for strings which were encoded successfully)."""
+        if strings.dtype.itemsize == 0:
+            # All empty strings
+            strings = strings.astype('U1')
+        n = len(strings)
+        reasons = np.zeros(n, dtype='U20')
+        lengths = np.char.str_len(strings)
+        width = strings.dtype.itemsize // 4
+        codepoints = np.ascontiguousarray(strings).view(np.uint32).reshape(n, width)
+        if width < padlen:
+            codepoints = np.pad(codepoints, ((0, 0), (0, padlen - width)))
+        codepoints = codepoints[:, :padlen]
+        table = self.codepoint_table
+        indices = table[np.minimum(codepoints, len(table) - 1)]
+        indices[codepoints >= len(table)] = -1
+        positions = np.arange(padlen)
+        in_string = positions < lengths.reshape(n, 1)
+
+        toolong = lengths > padlen
+        reasons[toolong] = 'toolong'
+        reasons[~toolong & np.any(in_string & (indices < 0), axis=1)] = 'illegal_char'
+
+        if self.leftpad:
+            # Position i holds char i - (padlen - length) of the string
+            source = positions - (padlen - lengths.reshape(n, 1))
+            in_string = source >= 0
+            indices = np.take_along_axis(indices, np.clip(source, 0, padlen - 1), axis=1)
+        padding = ~in_string
+        # Only look up the filler if we need it. Codecs with minlen == maxlen have none.
+        if padding.any():
+            filler = self.char_lookup.get(self.filler)
+            if filler is None:
+                reasons[(reasons == '') & padding.any(axis=1)] = 'tooshort'
+                filler = 0
+            indices[padding] = filler
+        return indices, reasons
+
+    def encode_batch(self, strings):
+        """Encode a list (or 1-d array) of strings at once.
+
+        Returns
+        -------
+        indices : array, shape (n, maxlen), dtype INDEX_DTYPE
+            Char indices of each string (as returned by encode()). Rows for
+            strings which couldn't be encoded are meaningless.
+        reasons : array of str, shape (n,)
+            Why each string couldn't be encoded ('toolong', 'tooshort',
+            'illegal_char', matching the reason of the NonEncodableTextException
+            encode() would raise), or '' for strings which were encoded.
+        """
+        # One char wider than maxlen, so that strings which are too long are recognizable as such
+        strings = np.asarray(strings, dtype='U{}'.format(self.maxlen + 1)).reshape(-1)
+        indices, reasons = self._encode_batch(strings, self.maxlen)
+        tooshort = np.char.str_len(strings) < getattr(self, 'minlen', 0)
+        reasons[tooshort & (reasons != 'toolong')] = 'tooshort'
+        return indices, reasons
 
     def decode(self, vec, pretty=False, strict=True):
         # TODO: Whether we should use 'strict' mode depends on whether the model
         # we got this vector from does softmax sampling of visibles. Anywhere this
         # is called on fantasy samples, we should use the model to set this param.
-        if issparse(vec):
-            vec = vec.toarray().reshape(-1)
-        assert vec.shape == (self.nchars * self.maxlen,)
-        chars = []
-        for position_index in range(self.maxlen):
-            # Hack - insert a tab between name parts in binomial mode
-            if isinstance(self, BinomialShortTextCodec) and pretty and position_index == self.maxlen/2:
-                chars.append('\t')
-            subarr = vec[position_index * self.nchars:(position_index + 1) * self.nchars]
-            if np.count_nonzero(subarr) != 1 and strict:
-                char = self.MYSTERY
+        assert vec.shape in ((self.nchars * self.maxlen,), (1, self.nchars * self.maxlen))
+        return self.decode_batch(vec.reshape(1, -1), pretty, strict)[0]
+
+    def decode_batch(self, vecs, pretty=False, strict=True):
+        """Decode a whole matrix of one-hot vectors (dense or sparse), with shape
+        (n, maxlen * nchars), at once. Returns a list of n strings.
+        """
+        n = vecs.shape[0]
+        assert vecs.shape == (n, self.nchars * self.maxlen)
+        if issparse(vecs):
+            vecs = vecs.tocsr()
+            rows = np.repeat(np.arange(n), np.diff(vecs.indptr))
+            nonzero = vecs.data != 0
+            rows, columns = rows[nonzero], vecs.indices[nonzero]
+            positions, chars = np.divmod(columns, self.nchars)
+            counts = np.zeros((n, self.maxlen), dtype=np.intp)
+            np.add.at(counts, (rows, positions), 1)
+            # Same as argmax on the dense vector: the first char that's on, or 0 if none
+            indices = np.full((n, self.maxlen), self.nchars, dtype=np.intp)
+            np.minimum.at(indices, (rows, positions), chars)
+            indices[counts == 0] = 0
+        else:
+            vecs = np.reshape(vecs, (n, self.maxlen, self.nchars))
+            indices = np.argmax(vecs, axis=2)
+            counts = np.count_nonzero(vecs, axis=2)
+        return self.decode_indices(indices, pretty, invalid=(counts != 1) if strict else None)
+
+    def decode_indices(self, indices, pretty=False, invalid=None):
+        """Decode an array of char indices with shape (n, maxlen). Positions where
+        the (optional) boolean array invalid is True are rendered as MYSTERY.
+        Returns a list of n strings.
+        """
+        n = indices.shape[0]
+        chars = np.array(list(self.alphabet))[indices]
+        binomial = isinstance(self, BinomialShortTextCodec)
+        removed = None
+        if pretty:
+            fillers = indices == self.alphabet.find(self.FILLER)
+            if invalid is not None:
+                fillers &= ~invalid
+            if binomial:
+                # Hack
+                chars[fillers] = ' '
             else:
-                char_index = np.argmax(subarr)
-                char = self.alphabet[char_index]
-                if pretty and char == self.FILLER:
-                    # Hack
-                    char = ' ' if isinstance(self, BinomialShortTextCodec) else ''
-            chars.append(char)
-        return ''.join(chars)
+                removed = fillers
+        if invalid is not None:
+            chars[invalid] = self.MYSTERY
+        if removed is not None and removed.any():
+            # Removed chars become empty strings (i.e. NULs) in our array of
+            # single chars. NULs only disappear when they're trailing, so shift
+            # them to the end of each row.
+            chars[removed] = ''
+            order = np.argsort(removed, axis=1, kind='stable')
+            chars = np.take_along_axis(chars, order, axis=1)
+        # Hack - insert a tab between name parts in binomial mode
+        if binomial and pretty and self.maxlen % 2 == 0:
+            chars = np.insert(chars, self.maxlen // 2, '\t', axis=1)
+        width = chars.shape[1]
+        strings = np.ascontiguousarray(chars).view('U{}'.format(width)).reshape(n)
+        return strings.tolist()
+
+    def canonical_indices(self, indices):
+        """Return a copy of an (n, maxlen) array of char indices where any two
+        rows which decode (with pretty=True) to the same string are identical.
+        For regular codecs, that means moving padding to the end of each row.
+        """
+        filler = self.pretty_filler_index
+        if filler == -1:
+            return np.array(indices)
+        fillers = indices == filler
+        order = np.argsort(fillers, axis=1, kind='stable')
+        return np.take_along_axis(indices, order, axis=1)
 
     def shape(self):
         """The shape of a set of RBM inputs given this codecs configuration."""
@@ -154,6 +328,84 @@ class ShortTextCodec(object):
     def mutagen_noise(self, s):
         return ''.join(random.choice(self.alphabet) for _ in range(self.maxlen))
 
+    # Array versions of the mutagens above. These take an array of char indices
+    # with shape (n, maxlen) (as returned by encode_batch) and a numpy Generator,
+    # and return a mutated copy. Results are distributed the same as encoding
+    # the strings after applying the corresponding string mutagen.
+
+    def _roll_batch(self, rng, n, forbidden):
+        """Draw n char indices uniformly at random from the alphabet, minus the
+        forbidden indices. forbidden is a list of per-row arrays or scalars, where
+        -1 forbids nothing."""
+        chars = rng.integers(0, self.nchars, n)
+        bad = np.ones(n, dtype=bool)
+        while True:
+            bad[:] = False
+            for f in forbidden:
+                bad |= chars == f
+            if not bad.any():
+                return chars
+            chars[bad] = rng.integers(0, self.nchars, bad.sum())
+
+    def _shift_rows(self, indices, shifts):
+        """Shift each row of indices right by the corresponding amount in shifts
+        (left, for negative shifts), filling vacated positions with padding."""
+        width = indices.shape[1]
+        source = np.arange(width) - shifts.reshape(-1, 1)
+        valid = (source >= 0) & (source < width)
+        shifted = np.take_along_axis(indices, np.clip(source, 0, width - 1), axis=1)
+        if not valid.all():
+            shifted[~valid] = self.char_lookup[self.filler]
+        return shifted
+
+    def mutagen_nudge_batch(self, indices, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        n, width = indices.shape
+        padding = self.filler_index
+        filler = self.alphabet.find(self.FILLER)
+        space = self.alphabet.find(' ')
+        rows = np.arange(n)
+        lengths = np.count_nonzero(indices != padding, axis=1)
+        # Work with right-padded strings, where char i of the string is at position i
+        strings = self._shift_rows(indices, -(width - lengths)) if self.leftpad else indices.copy()
+        new_lengths = lengths.copy()
+        i = rng.integers(0, np.minimum(lengths, width - 1) + 1)
+
+        # Add a char to the end
+        append = i == lengths
+        strings[rows[append], i[append]] = self._roll_batch(rng, n, [filler, space])[append]
+        new_lengths[append] += 1
+
+        # Change the last char (or drop it, if the replacement is the filler char).
+        # The double roll is as in mutagen_nudge.
+        last = (i == lengths - 1) & ~append
+        last_chars = strings[rows, np.maximum(lengths - 1, 0)]
+        first_roll = self._roll_batch(rng, n, [space, last_chars])
+        drop = last & (first_roll == filler)
+        strings[rows[drop], i[drop]] = padding
+        new_lengths[drop] -= 1
+        replace = last & ~drop
+        strings[rows[replace], i[replace]] = self._roll_batch(rng, n, [space, last_chars])[replace]
+
+        # Change some char in the middle
+        middle = ~append & ~last
+        middle_chars = strings[rows, i]
+        strings[rows[middle], i[middle]] = self._roll_batch(rng, n, [middle_chars, filler])[middle]
+
+        return self._shift_rows(strings, width - new_lengths) if self.leftpad else strings
+
+    def mutagen_silhouettes_batch(self, indices, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        choices = np.array([self.char_lookup[c] for c in self.non_special_char_alphabet])
+        mutated = indices.copy()
+        mask = (indices != self.alphabet.find(' ')) & (indices != self.filler_index)
+        mutated[mask] = choices[rng.integers(0, len(choices), np.count_nonzero(mask))]
+        return mutated
+
+    def mutagen_noise_batch(self, indices, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        return rng.integers(0, self.nchars, indices.shape).astype(indices.dtype)
+
 class BinomialShortTextCodec(ShortTextCodec):
     """Encodes two-part names (e.g. "John Smith"), padding each part separately
     to the same length. (Presumed to  help learning.)
@@ -166,8 +418,20 @@ class BinomialShortTextCodec(ShortTextCodec):
         # an equal share
         assert self.maxlen % 2 == 0, "Maxlen must be even for binomial codec"
 
+    def config(self):
+        config = super(BinomialShortTextCodec, self).config()
+        config['separator'] = self.separator
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        codec = super(BinomialShortTextCodec, cls).from_config(config)
+        # Configs from before the separator was part of them always used ','
+        codec.separator = config.get('separator', ',')
+        return codec
+
     def encode(self, s, mutagen=None):
-        namelen = self.maxlen / 2
+        namelen = self.maxlen // 2
         if self.separator not in s:
             first = s
             last = ''
@@ -183,8 +447,45 @@ class BinomialShortTextCodec(ShortTextCodec):
             last = mutagen(last)
         return self._encode(first, namelen) + self._encode(last, namelen)
 
+    def encode_batch(self, strings):
+        strings = np.asarray(strings, dtype=str).reshape(-1)
+        n = len(strings)
+        namelen = self.maxlen // 2
+        reasons = np.zeros(n, dtype='U20')
+        nseparators = np.char.count(strings, self.separator)
+        reasons[nseparators > 1] = 'too many separators'
+        before, _, after = np.moveaxis(np.char.partition(strings, self.separator), -1, 0)
+        has_separator = nseparators > 0
+        first = np.char.strip(np.where(has_separator, after, before))
+        last = np.char.strip(np.where(has_separator, before, ''))
+        first_indices, first_reasons = self._encode_batch(first, namelen)
+        last_indices, last_reasons = self._encode_batch(last, namelen)
+        for part_reasons in (first_reasons, last_reasons):
+            unset = reasons == ''
+            reasons[unset] = part_reasons[unset]
+        return np.concatenate([first_indices, last_indices], axis=1), reasons
+
     # We don't really need to override decode(). It should do basically the right
     # thing (modulo some funny spacing)
 
+    @property
+    def pretty_filler_index(self):
+        # Pretty decoding renders padding as spaces rather than stripping it
+        return -1
+
+    def canonical_indices(self, indices):
+        # Pretty decoding renders padding as spaces, wherever it is
+        indices = np.array(indices)
+        if ' ' in self.char_lookup:
+            indices[indices == self.filler_index] = self.char_lookup[' ']
+        return indices
+
+    def mutagen_nudge_batch(self, indices, rng=None):
+        # Like the string version (as applied by encode), nudge each part of the name separately
+        n, width = indices.shape
+        halves = indices.reshape(2 * n, width // 2)
+        nudge = super(BinomialShortTextCodec, self).mutagen_nudge_batch
+        return nudge(halves, rng).reshape(n, width)
+
     # TODO: Probably *do* need to override some or all mutagen methods. Leaving
     # them for now since they're only necessary for evaluation.
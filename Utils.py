@@ -1,11 +1,15 @@
 import numpy as np
+import scipy.sparse as sp
+import itertools
+import hashlib
+import json
+import os
 import time
 import logging
 from collections import Counter
+from scipy.sparse import issparse
 
-from ShortTextCodec import NonEncodableTextException
-
-from sklearn.preprocessing import OneHotEncoder
+from ShortTextCodec import NonEncodableTextException, ShortTextCodec
 
 DEBUG_TIMING = False
 
@@ -26,25 +30,154 @@ def timeit(f):
 
     return timed
 
-def vectors_from_txtfile(fname, codec, limit=-1, mutagen=None):
-    f = open(fname,encoding="utf8")
+# Number of lines to read and encode at a time when vectorizing text files
+CHUNKSIZE = 10**5
+
+# Where to cache encoded text files (see cached_char_indices). Set the environment
+# variable to the empty string to disable caching.
+VECTOR_CACHE_DIR = os.environ.get('CHAR_RBM_CACHE_DIR', '.vector_cache')
+
+INDEX_DTYPE = ShortTextCodec.INDEX_DTYPE
+
+def _encode_lines(lines, codec, mutagen=None):
+    """Encode a list of strings as an array of char indices, with shape
+    (n_encodable, maxlen). Strings which can't be encoded are dropped. Returns
+    the array, and a Counter of the reasons for dropping strings.
+    """
     skipped = Counter()
-    vecs = []
-    for line in f:
-        line = line.strip()
-        try:
-            vecs.append(codec.encode(line, mutagen=mutagen))
-            if len(vecs) == limit:
+    if mutagen is not None:
+        # TODO: Vectorize this case too
+        vecs = []
+        for line in lines:
+            try:
+                vecs.append(codec.encode(line, mutagen=mutagen))
+            except NonEncodableTextException as e:
+                skipped[e.reason] += 1
+        return np.array(vecs, dtype=INDEX_DTYPE).reshape(len(vecs), codec.maxlen), skipped
+
+    indices, reasons = codec.encode_batch(lines)
+    rejected = reasons != ''
+    if rejected.any():
+        values, counts = np.unique(reasons[rejected], return_counts=True)
+        skipped.update(dict(zip(values.tolist(), counts.tolist())))
+    return indices[~rejected], skipped
+
+def iter_char_index_chunks(fname, codec, chunksize=CHUNKSIZE, limit=-1, mutagen=None, skipped=None):
+    """Read the text file fname (one string per line), and yield arrays of char
+    indices of shape (<= chunksize, maxlen), one per chunk of lines, for the
+    strings that the codec can encode. Stops after limit strings, if limit is
+    not -1. If a Counter is passed in as skipped, it's updated with the reasons
+    for dropping lines.
+    """
+    n = 0
+    with open(fname, encoding="utf8") as f:
+        while n != limit:
+            lines = [line.strip() for line in itertools.islice(f, chunksize)]
+            if not lines:
                 break
-        except NonEncodableTextException as e:
-            # Too long, or illegal characters
-            skipped[e.reason] += 1
+            indices, chunk_skipped = _encode_lines(lines, codec, mutagen)
+            if skipped is not None:
+                skipped.update(chunk_skipped)
+            if limit != -1:
+                indices = indices[:limit - n]
+            n += len(indices)
+            if len(indices):
+                yield indices
+
+def onehot_csr(indices, nchars, dtype=np.float64):
+    """Given an array of char indices with shape (n, maxlen), return the one-hot
+    encoding as a CSR matrix with shape (n, maxlen * nchars). Every row has
+    exactly maxlen nonzeros, so we can just build the CSR arrays directly.
+    """
+    n, maxlen = indices.shape
+    columns = (indices + nchars * np.arange(maxlen, dtype=np.int32)).astype(np.int32).ravel()
+    indptr = np.arange(0, n * maxlen + 1, maxlen, dtype=np.int32)
+    data = np.ones(n * maxlen, dtype=dtype)
+    return sp.csr_matrix((data, columns, indptr), shape=(n, maxlen * nchars))
 
-    logging.debug("Gathered {} vectors. Skipped {} ({})".format(len(vecs), 
+def iter_vector_chunks(fname, codec, chunksize=CHUNKSIZE, limit=-1, mutagen=None, skipped=None):
+    """Like iter_char_index_chunks, but yields one-hot CSR matrices."""
+    for indices in iter_char_index_chunks(fname, codec, chunksize, limit, mutagen, skipped):
+        yield onehot_csr(indices, codec.nchars)
+
+def char_indices_from_txtfile(fname, codec, limit=-1, mutagen=None):
+    """Return an array of shape (n, maxlen) of char indices for the encodable
+    strings in fname, and a Counter of the reasons for skipping the others."""
+    skipped = Counter()
+    chunks = list(iter_char_index_chunks(fname, codec, limit=limit, mutagen=mutagen, skipped=skipped))
+    if chunks:
+        indices = np.concatenate(chunks)
+    else:
+        indices = np.zeros((0, codec.maxlen), dtype=INDEX_DTYPE)
+    logging.debug("Gathered {} vectors. Skipped {} ({})".format(len(indices),
         sum(skipped.values()), dict(skipped)))
-    vecs = np.asarray(vecs)
-    # TODO: Why default to dtype=float? Seems wasteful? Maybe it doesn't really matter. Actually, docs here seem inconsistent? Constructor docs say default float. transform docs say int. Should file a bug on sklearn.
-    return OneHotEncoder(len(codec.alphabet)).fit_transform(vecs)
+    return indices, skipped
+
+# Digests of files we've already hashed, keyed by (path, mtime, size)
+_DIGESTS = {}
+
+def file_digest(fname):
+    """Return the SHA-1 hex digest of the contents of the given file. Only
+    hashes a given file once, unless its mtime or size change."""
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+    if key not in _DIGESTS:
+        digest = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        _DIGESTS[key] = digest.hexdigest()
+    return _DIGESTS[key]
+
+def _cache_paths(fname, codec):
+    key = {'file': file_digest(fname), 'codec': codec.config()}
+    name = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+    base = os.path.join(VECTOR_CACHE_DIR, name)
+    return base + '.npy', base + '.json'
+
+def cached_char_indices(fname, codec):
+    """Like char_indices_from_txtfile (minus limit and mutagens), but the encoded strings
+    are cached on disk in VECTOR_CACHE_DIR, keyed by the contents of the file and
+    the codec's config. Later calls memory-map the cached array, rather than
+    reading and encoding the file again.
+    """
+    array_path, meta_path = _cache_paths(fname, codec)
+    if os.path.exists(array_path) and os.path.exists(meta_path):
+        indices = np.load(array_path, mmap_mode='r')
+        with open(meta_path) as f:
+            skipped = Counter(json.load(f)['skipped'])
+    else:
+        indices, skipped = char_indices_from_txtfile(fname, codec)
+        if not os.path.isdir(VECTOR_CACHE_DIR):
+            os.makedirs(VECTOR_CACHE_DIR)
+        # Write to temp files and rename, so a concurrent reader never sees half a file
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(array_path + tmp_suffix, 'wb') as f:
+            np.save(f, indices)
+        with open(meta_path + tmp_suffix, 'w') as f:
+            json.dump({'source': fname, 'codec': codec.config(), 'rows': len(indices),
+                       'skipped': dict(skipped)}, f)
+        os.replace(array_path + tmp_suffix, array_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+    return indices, skipped
+
+def load_char_indices(fname, codec, limit=-1):
+    """Return an array of char indices for the encodable strings in fname, going
+    through the cache if it's enabled."""
+    # With a limit, just reading the first few lines is cheaper than hashing
+    # (let alone encoding) the whole file to find it in the cache
+    if VECTOR_CACHE_DIR and limit == -1:
+        indices, _ = cached_char_indices(fname, codec)
+    else:
+        indices, _ = char_indices_from_txtfile(fname, codec, limit)
+    return indices
+
+def vectors_from_txtfile(fname, codec, limit=-1, mutagen=None):
+    if mutagen is None:
+        indices = load_char_indices(fname, codec, limit)
+    else:
+        indices, _ = char_indices_from_txtfile(fname, codec, limit, mutagen)
+    return onehot_csr(indices, codec.nchars)
 
 # Adapted from sklearn.utils.extmath.softmax
 def softmax(X, copy=True):
@@ -61,7 +194,42 @@ def softmax(X, copy=True):
     X /= sum_prob
     return X
 
-def softmax_and_sample(X, copy=True):
+def softmax_sample_indices(X, copy=True, rng=None):
+    """
+    Like softmax_and_sample, but rather than building one-hot vectors, return
+    the index of the value sampled for each softmax unit.
+
+    Parameters
+    ----------
+    X: array-like, shape (n_samples, M, N), dtype=float
+        Argument to the logistic function
+    copy: bool, optional
+        Copy X or not. If False, X is used as scratch space and clobbered.
+    rng: numpy.random.Generator, optional
+        Where to draw random numbers from. Defaults to the global RandomState.
+    Returns
+    -------
+    out: array of int, shape (n_samples, M)
+        Index of the sampled value for each softmax unit
+    """
+    if copy:
+        X = np.copy(X)
+    # Unnormalized probabilities. No need to divide through by the sum - we
+    # can just scale the thresholds up to match the last entry of the cumsum.
+    X -= np.max(X, axis=2, keepdims=True)
+    np.exp(X, X)
+    cumsum = np.cumsum(X, axis=2, out=X)
+    if rng is None:
+        thresholds = np.random.rand(X.shape[0], X.shape[1], 1).astype(X.dtype, copy=False)
+    else:
+        thresholds = rng.random((X.shape[0], X.shape[1], 1), dtype=X.dtype)
+    thresholds *= cumsum[:, :, -1:]
+    # Number of cumulative values below the threshold == index of the selected value
+    to_select = (cumsum < thresholds).sum(axis=2)
+    # Guard against rounding error selecting one past the end
+    return np.minimum(to_select, X.shape[2] - 1, out=to_select)
+
+def softmax_and_sample(X, copy=True, rng=None):
     """
     Given an array of 2-d arrays, each having shape (M, N) representing M softmax
     units with N possible values each, return an array of the same shape where
@@ -75,22 +243,75 @@ def softmax_and_sample(X, copy=True):
         Argument to the logistic function
     copy: bool, optional
         Copy X or not.
+    rng: numpy.random.Generator, optional
+        Where to draw random numbers from. Defaults to the global RandomState.
     Returns
     -------
     out: array of 0,1, shape (n_samples, M, N)
         Softmax function evaluated at every point in x and sampled
     """
-    a,b,c = X.shape
-    X_shape = X.shape
-    X = softmax(X, copy)
-    # We've got our probabilities, now sample from them
-    thresholds = np.random.rand(X.shape[0], X.shape[1], 1)
-    cumsum = np.cumsum(X, axis=2, out=X)
-    x, y, z = np.indices(cumsum.shape)
-    # This relies on the fact that, if there are multiple instances of the max
-    # value in an array, argmax returns the index of the first one
-    to_select = np.argmax(cumsum > thresholds, axis=2).reshape(a, b, 1)
-    bin_sample = np.zeros(X_shape)
-    bin_sample[x, y, to_select] = 1
-
-    return bin_sample
+    a, b, c = X.shape
+    to_select = softmax_sample_indices(X, copy, rng)
+    return indices_to_onehot(to_select, c, dtype=X.dtype).reshape(a, b, c)
+
+def indices_to_onehot(indices, nchars, out=None, dtype=np.float64):
+    """Given an array of shape (n_samples, M) of indices into softmax units
+    having nchars values each, return the corresponding flattened one-hot
+    vectors, with shape (n_samples, M * nchars). If out is provided, the
+    result is written there.
+    """
+    n, m = indices.shape
+    if out is None:
+        onehot = np.zeros((n, m * nchars), dtype=dtype)
+    else:
+        onehot = out
+        onehot.fill(0)
+    onehot[np.arange(n).reshape(n, 1), indices + nchars * np.arange(m)] = 1
+    return onehot
+
+def index_keys(indices, nchars):
+    """Return a key for each row of an array of char indices with shape (n, M),
+    such that distinct rows always get distinct keys. If nchars**M fits in 64
+    bits, the keys are uint64s: each row read as a base-nchars number. Otherwise
+    each row is split into as few chunks as fit in 64 bits each, and the keys
+    are records of one uint64 per chunk (which sort and compare like tuples).
+    """
+    indices = np.asarray(indices)
+    n, m = indices.shape
+    # How many chars fit in one word
+    per_word = 1
+    while per_word < m and nchars ** (per_word + 1) <= 2**64:
+        per_word += 1
+    n_words = -(-m // per_word)
+    words = np.zeros((n_words, n), dtype=np.uint64)
+    base = np.uint64(nchars)
+    for posn, col in enumerate(indices.T):
+        word = words[posn // per_word]
+        word *= base
+        word += col.astype(np.uint64)
+    if n_words == 1:
+        return words[0]
+    keys = np.zeros(n, dtype=[('w{}'.format(i), np.uint64) for i in range(n_words)])
+    for i, word in enumerate(words):
+        keys['w{}'.format(i)] = word
+    return keys
+
+def onehot_to_indices(vecs, shape):
+    """Inverse of indices_to_onehot. vecs may be dense or a CSR matrix, with
+    shape (n_samples, M * N), where shape is (M, N). For any softmax unit
+    that isn't on for exactly one value, the index of the first value that's
+    on (or 0) is returned.
+    """
+    m, nchars = shape
+    n = vecs.shape[0]
+    if issparse(vecs):
+        vecs = vecs.tocsr()
+        if vecs.nnz == n * m and np.all(np.diff(vecs.indptr) == m):
+            if not vecs.has_sorted_indices:
+                vecs = vecs.sorted_indices()
+            cols = vecs.indices.reshape(n, m)
+            offsets = nchars * np.arange(m)
+            if np.all(cols // nchars == np.arange(m)):
+                return (cols - offsets).astype(np.intp)
+        vecs = vecs.toarray()
+    return np.argmax(np.reshape(vecs, (n, m, nchars)), axis=2)
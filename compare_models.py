@@ -1,13 +1,20 @@
 import argparse
 import sys
-import pickle
+import copy
+import json
+import logging
+import numpy as np
 import Utils
+import ModelIO
 import csv
+import hashlib
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import sklearn.metrics.pairwise
 from sklearn.utils.extmath import log_logistic
 
-from short_text_codec import BinomialShortTextCodec
+from ShortTextCodec import BinomialShortTextCodec
 
 Utils.DEBUG_TIMING = True
 
@@ -27,19 +34,61 @@ SUBDIR_TO_SCORE = {
     'great': 4,
     }
 
-@Utils.timeit
-def eval_model(model, trainfile, n):
-    row  = {'name': model.name}
+MUTAGENS = ('nudge', 'sil', 'noise')
+
+# Bump this whenever the way any of the metrics are computed changes, so that
+# stale results in the store get recomputed.
+METRIC_VERSION = 1
+
+def load_model(path, grade=None, allow_pickle=False):
+    model = ModelIO.load(path, allow_pickle=allow_pickle)
+    model.name = os.path.basename(path)
+    if grade is not None:
+        model.grade = grade
+    return model
+
+def eval_codec(codec):
+    """The codec to use when encoding the evaluation data for a model with the given codec."""
     # Comparing models with different codec params seems problematic when they change the 
     # set of examples each model is looking at (some strings will be too short/long for one
     # model but not another). This could introduce a systematic bias where some models get
     # strings that are a little easier or harder. Quick experiment performed to clamp minlen
     # and maxlen to a shared middle ground for all models. Didn't really affect ranking.
+    if not FORCE_MINLEN:
+        return codec
+    codec = copy.copy(codec)
+    codec.minlen = FORCE_MINLEN
+    return codec
+
+def codec_key(codec):
+    """Models whose codecs have the same key can share evaluation data."""
+    return json.dumps(codec.config(), sort_keys=True)
+
+@Utils.timeit
+def eval_data(codec, trainfile, n, rng=None):
+    """Encode (up to) n examples from trainfile, and a mutant of each one per
+    mutagen. Returns a dict of one-hot CSR matrices, with the untainted data
+    under 'good', and the mutants under the names in MUTAGENS."""
+    rng = np.random.default_rng() if rng is None else rng
+    good_indices = Utils.load_char_indices(trainfile, codec, n)
+    data = {'good': Utils.onehot_csr(good_indices, codec.nchars)}
+    # TODO: too lazy to implement
+    if isinstance(codec, BinomialShortTextCodec):
+        return data
+    for name, mutagen in [ ('nudge', codec.mutagen_nudge_batch), 
+                            ('sil', codec.mutagen_silhouettes_batch),
+                            ('noise', codec.mutagen_noise_batch),
+                            ]:
+        data[name] = Utils.onehot_csr(mutagen(good_indices, rng), codec.nchars)
+    return data
+
+@Utils.timeit
+def score_model(model, data):
+    """Compute a row of metrics for the given model on data from eval_data."""
+    row  = {'name': model.name}
     codec = model.codec
     if FORCE_MINLEN:
-        old_minlen = getattr(codec, 'minlen', None)
-        codec.minlen = FORCE_MINLEN
-        row['minlen'] = '{} ({})'.format(old_minlen, codec.minlen)
+        row['minlen'] = '{} ({})'.format(getattr(codec, 'minlen', None), FORCE_MINLEN)
     else:
         row['minlen'] = getattr(codec, 'minlen', None)
 
@@ -53,21 +102,14 @@ def eval_model(model, trainfile, n):
     row['weight_cost'] = getattr(model, 'weight_cost', 'NA')
     row['grade'] = getattr(model, 'grade', '?')
 
-
-    # The untainted vectorizations
-    good = Utils.vectors_from_txtfile(trainfile, codec, n)
+    good = data['good']
+    n = good.shape[0]
     good_energy = model._free_energy(good)
     row['pseudol9'] = model.score_samples(good).mean()
-    for name, mutagen in [ ('nudge', codec.mutagen_nudge), 
-                            ('sil', codec.mutagen_silhouettes),
-                            ('noise', codec.mutagen_noise),
-                            ]:
-        bad = Utils.vectors_from_txtfile(trainfile, codec, n, mutagen)
-        bad_energy = model._free_energy(bad)
-
-        # TODO: too lazy to implement
-        if isinstance(model.codec, BinomialShortTextCodec):
-            break
+    for name in MUTAGENS:
+        if name not in data:
+            continue
+        bad_energy = model._free_energy(data[name])
 
         # log-likelihood ratio
         # This is precisely log(P_model(good)/P_model(bad))
@@ -123,74 +165,186 @@ def eval_model(model, trainfile, n):
             row[k] = "<sp>"
     return row
 
+def eval_model(model, trainfile, n):
+    return score_model(model, eval_data(eval_codec(model.codec), trainfile, n))
+
+def eval_group(specs, trainfile, n, seed=None, allow_pickle=False):
+    """Evaluate a group of models having equivalent codecs, given as a list of
+    (path, grade) pairs. The evaluation data is only encoded once for the whole
+    group. Returns a list of rows, in the same order as specs."""
+    models = [load_model(path, grade, allow_pickle) for path, grade in specs]
+    data = eval_data(eval_codec(models[0].codec), trainfile, n, np.random.default_rng(seed))
+    rows = []
+    for model in models:
+        logging.info("Evaluating {}".format(model.name))
+        rows.append(score_model(model, data))
+    return rows
+
+def mutant_seed(seed, key):
+    """The seed for generating mutants for the group of models with the given
+    codec_key. It only depends on seed and the codec, not on which other models
+    are being evaluated, so stored results can be reused across runs."""
+    if seed is None:
+        return None
+    return np.random.SeedSequence([seed, int(hashlib.sha1(key.encode('utf8')).hexdigest()[:8], 16)])
+
+def eval_models(specs, trainfile, n, jobs=1, seed=None, allow_pickle=False):
+    """Evaluate the models given by a list of (path, grade) pairs, grouping them
+    by codec so that each distinct codec's data is only prepared once. Groups
+    are farmed out to a pool of jobs processes. Returns a list of rows, in the
+    same order as specs. Legacy pickled models are only loaded if allow_pickle."""
+    groups = OrderedDict()
+    for i, (path, grade) in enumerate(specs):
+        # Only the codec is needed here (the models are loaded by whichever process evaluates them)
+        key = codec_key(eval_codec(ModelIO.load_codec(path, allow_pickle)))
+        groups.setdefault(key, []).append(i)
+    print ("Evaluating {} models ({} distinct codecs)".format(len(specs), len(groups)))
+    seeds = [mutant_seed(seed, key) for key in groups]
+    group_specs = [[specs[i] for i in members] for members in groups.values()]
+    if jobs == 1 or len(groups) == 1:
+        results = [eval_group(group, trainfile, n, group_seed, allow_pickle)
+                   for group, group_seed in zip(group_specs, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(groups))) as pool:
+            results = list(pool.map(eval_group, group_specs, [trainfile]*len(groups),
+                                    [n]*len(groups), seeds, [allow_pickle]*len(groups)))
+    rows = [None] * len(specs)
+    for members, group_rows in zip(groups.values(), results):
+        for i, row in zip(members, group_rows):
+            rows[i] = row
+    return rows
+
+class ResultStore(object):
+    """Persistent record of evaluation results, saved as json. Results are keyed
+    by the contents of the model file and the training file, along with n, the
+    seed, and anything else that affects the metrics, so models that were already
+    evaluated under the same conditions don't need to be evaluated again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.results = OrderedDict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.results = json.load(f, object_pairs_hook=OrderedDict)['results']
+
+    @staticmethod
+    def key(model_digest, train_digest, n, seed=None):
+        return json.dumps([model_digest, train_digest, n, seed, METRIC_VERSION, FORCE_MINLEN])
+
+    def get(self, key):
+        entry = self.results.get(key)
+        return None if entry is None else entry['row']
+
+    def put(self, key, path, row):
+        # Reinsert, so results end up ordered by when they were last seen
+        self.results.pop(key, None)
+        self.results[key] = {'path': path, 'row': row}
+
+    def rows(self, train_digest, n, seed=None):
+        """All stored rows for the given training data, n and seed. If a model file
+        has changed since some results for it were stored, only the latest are used."""
+        rows = OrderedDict()
+        for key, entry in self.results.items():
+            # (Keys from before the seed was part of them never match)
+            if json.loads(key)[1:] == [train_digest, n, seed, METRIC_VERSION, FORCE_MINLEN]:
+                rows.pop(entry['path'], None)
+                rows[entry['path']] = entry['row']
+        return list(rows.values())
+
+    def save(self):
+        tmp = self.path + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'results': self.results}, f, indent=1)
+        os.replace(tmp, self.path)
+
+def eval_models_incremental(specs, trainfile, n, store, jobs=1, seed=None, force=False, allow_pickle=False):
+    """Like eval_models, but only evaluate models that don't already have results
+    in the given ResultStore (unless force is True). New results are added to the
+    store, which is saved once they're all in."""
+    train_digest = Utils.file_digest(trainfile)
+    keys = [store.key(Utils.file_digest(path), train_digest, n, seed) for path, _ in specs]
+    rows = [None if force else store.get(key) for key in keys]
+    todo = [i for i, row in enumerate(rows) if row is None]
+    print ("Found results for {} of {} models".format(len(specs) - len(todo), len(specs)))
+    if todo:
+        new_rows = eval_models([specs[i] for i in todo], trainfile, n, jobs, seed, allow_pickle)
+        for i, row in zip(todo, new_rows):
+            rows[i] = row
+    for key, (path, grade), row in zip(keys, specs, rows):
+        # The same model file might have been moved or regraded since it was evaluated.
+        # Models not given a grade keep the one stored with their results (which
+        # score_model took from the model itself).
+        row = dict(row, name=os.path.basename(path))
+        if grade is not None:
+            row['grade'] = grade
+        store.put(key, path, row)
+    store.save()
+    return [store.get(key) for key in keys]
+
+def model_specs(paths):
+    """Expand the model arguments from the command line into a list of (path, grade)
+    pairs."""
+    specs = []
+    for fname in paths:
+        if os.path.isdir(fname):
+            print ("Received directory. Assuming this contains subdirs /bad, /okay, /good, /great with models")
+            for dirname, _, fnames in os.walk(fname):
+                leafdir = dirname.split(os.path.sep)[-1]
+                try:
+                    grade = SUBDIR_TO_SCORE[leafdir]
+                except KeyError:
+                    print ("Ignoring unrecognized subdir {}".format(dirname))
+                    continue
+                for fname in sorted(fnames):
+                    specs.append((os.path.join(dirname, fname), grade))
+        else:
+            specs.append((fname, None))
+    return specs
+
 if __name__ == '__main__':
-    # TODO: "Append" mode so we don't have to do a bunch of redundant calculations when we add one or two new models
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('models', metavar='model', nargs='+', help='Pickled RBM models')
+    parser.add_argument('models', metavar='model', nargs='+', help='RBM model files (or legacy pickles)')
     parser.add_argument('trainfile', help='File with training examples')
-    parser.add_argument('-a', '--append', action='store_true', help='If there exists a model_comparison_<tag>.csv'
-                        + ' file, append a row for each model file passed in, rather than clobbering. Does not '
-                        + 'attempt to dedupe rows.')
+    parser.add_argument('-a', '--append', action='store_true', help='Also include rows for models evaluated in'
+                        + ' earlier runs with the same tag, trainfile, n and seed, rather than just the models passed in.')
+    parser.add_argument('-f', '--force', action='store_true', help='Re-evaluate all models passed in, even those'
+                        + ' with stored results. (Results are stored per tag, in model_comparison_<tag>.json.)')
     parser.add_argument('-t', '--tag', default='', help='A tag to append to the output csv filename')
     parser.add_argument('-n', type=int, default=10**4, help="Number of samples to average over." +
                         "Default is pretty fast and, anecdotally, seems to give pretty reliable results."
                         + " Increasing it by a factor of 5-10 doesn't change much.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Max number of processes to use.'
+                        + ' Models with equivalent codecs are evaluated together in one process.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for generating the mutants')
+    parser.add_argument('--allow-pickle', dest='allow_pickle', action='store_true',
+                        help='Allow loading legacy pickled models. Unpickling can run arbitrary code, so only use this with files you trust.')
     args = parser.parse_args()
 
-    if args.trainfile.endswith('.pickle'):
-        print "trainfile is mandatory"
+    if args.trainfile.endswith(('.pickle', ModelIO.EXTENSION)):
+        print ("trainfile is mandatory")
         parser.print_usage()
         sys.exit(1)
 
-    models = []
-    for fname in args.models:
-        if os.path.isdir(fname):
-            print "Received directory. Assuming this contains subdirs /bad, /okay, /good, /great with pickles"
-            for dirname, _, fnames in os.walk(fname):
-                leafdir = dirname.split(os.path.sep)[-1]
-                try:
-                    grade = SUBDIR_TO_SCORE[leafdir]
-                except KeyError:
-                    print "Ignoring unrecognized subdir {}".format(dirname)
-                    continue
-                for fname in fnames:
-                    path = os.path.join(dirname, fname)
-                    f = open(path)
-                    model = pickle.load(f)
-                    f.close()
-                    model.name = os.path.basename(fname)
-                    model.grade = grade
-                    models.append(model)
-                
+    specs = model_specs(args.models)
 
-        else:
-            f = open(fname)
-            models.append(pickle.load(f))
-            models[-1].name = os.path.basename(fname)
-            f.close()
-
-    # We could try to be efficient and only load the training data once for all models
-    # But then we would need to require that all models passed in use equivalent codecs
-    # Or do something clever to only load n times for n distinct codecs
-    # Let's just do the dumb thing for now
     if not os.path.exists('model_comparisons/'):
-        print "Creating model_comparisons dir"
+        print ("Creating model_comparisons dir")
         os.mkdir("model_comparisons")
     outname = 'model_comparisons/model_comparison_{}.csv'.format(args.tag)
-    append = args.append
-    if append and not os.path.exists(outname):
-        print "WARNING: received append option, but found no existing file {}".format(outname)
-        append = False
-    f = open(outname, 'a' if append else 'w')
-    writer = csv.DictWriter(f, FIELDS, delimiter='\t')
-    if not append:
-        writer.writeheader()
+    store = ResultStore(os.path.splitext(outname)[0] + '.json')
 
-    for i, model in enumerate(models):
-        print "Evaluating {} [{}/{}]".format(model.name, i+1, len(models))
-        row = eval_model(model, args.trainfile, args.n)
-        writer.writerow(row)
-        print
+    rows = eval_models_incremental(specs, args.trainfile, args.n, store, args.jobs, args.seed, args.force,
+                                   args.allow_pickle)
+    if args.append:
+        # The store is ordered by when results were last seen, so this puts the
+        # models passed in last, as if we'd appended them to the file
+        rows = store.rows(Utils.file_digest(args.trainfile), args.n, args.seed)
 
+    # The tsv is always regenerated from scratch from the store
+    f = open(outname, 'w')
+    writer = csv.DictWriter(f, FIELDS, delimiter='\t')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
     f.close()
-    print "Wrote results to " + outname
+    print ("Wrote results to " + outname)
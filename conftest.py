@@ -0,0 +1,47 @@
+"""Fixtures shared by the tests: a sample of names.txt, and a small model
+trained on it."""
+import os
+
+import pytest
+
+import RBM
+import Utils
+from ShortTextCodec import ShortTextCodec
+
+# Don't leave cached encodings of the test data lying around
+Utils.VECTOR_CACHE_DIR = ''
+
+NAMES_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'names.txt')
+
+
+@pytest.fixture(scope='session')
+def names_fname(tmp_path_factory):
+    # names.txt is sorted, so take every 8th name rather than the first few thousand
+    with open(NAMES_FNAME) as f:
+        names = f.read().splitlines()[::8][:3000]
+    fname = tmp_path_factory.mktemp('data') / 'names.txt'
+    fname.write_text('\n'.join(names) + '\n')
+    return str(fname)
+
+@pytest.fixture(scope='session')
+def codec():
+    return ShortTextCodec('', 10, 0)
+
+@pytest.fixture(scope='session')
+def train_data(names_fname, codec):
+    return Utils.vectors_from_txtfile(names_fname, codec)
+
+@pytest.fixture(scope='session')
+def make_model(codec):
+    """A function returning a fresh, untrained model (with the given params
+    overriding the defaults)."""
+    def make(**kwargs):
+        params = dict(n_components=20, n_iter=2, batch_size=20, random_state=3)
+        params.update(kwargs)
+        return RBM.CharBernoulliRBMSoftmax(codec, **params)
+    return make
+
+@pytest.fixture(scope='session')
+def model(make_model, train_data):
+    """A trained model. Don't modify it - copy it first."""
+    return make_model().fit(train_data)
@@ -1,51 +1,73 @@
 import Sampling
+import ModelIO
+from NoveltyIndex import NoveltyIndex
 import sys
-import pickle
 import argparse
+import itertools
+import numpy as np
 import colorama
 colorama.init()
 
+def columns_cb(columns):
+    """Return a callback which appends each round of samples to the given list,
+    as a column for print_columns."""
+    def cb(strings, i, energy=None):
+        columns.append(list(zip(strings, energy)) if energy is not None else strings)
+    return cb
+
 SAMPLES = []
-def horizontal_cb(strings, i, energy=None):
-    global SAMPLES
-    if energy is not None:
-        SAMPLES.append(zip(strings, energy))
-    else:
-        SAMPLES.append(strings)
-
-DEDUPE_SEEN = []
-def dedupe_cb(strings, i, energy=None):
-    global DEDUPE_SEEN
-    if not DEDUPE_SEEN:
-        DEDUPE_SEEN = [set() for _ in strings]
-    for i in range(len(strings)):
-        if strings[i] in DEDUPE_SEEN[i]:
-            continue
-        print (strings[i] + "\t" + ("{:.2f}".format(energy[i]) if energy is not None else ""))
-        DEDUPE_SEEN[i].add(strings[i])
-    print
+horizontal_cb = columns_cb(SAMPLES)
+
+def make_dedupe_cb():
+    """Return a callback which prints each particle's samples, skipping the ones
+    that particle has already come up with. Each callback has its own memory."""
+    seen = []
+    def dedupe_cb(strings, i, energy=None):
+        if not seen:
+            seen.extend(set() for _ in strings)
+        for i in range(len(strings)):
+            if strings[i] in seen[i]:
+                continue
+            print (strings[i] + "\t" + ("{:.2f}".format(energy[i]) if energy is not None else ""))
+            seen[i].add(strings[i])
+        print
+    return dedupe_cb
+
+def grid_callback(grid, n, cb, label='T = {}'):
+    """Wrap a sampling callback so that it's called separately for the n samples
+    drawn at each temperature (or other setting) in grid. cb may also be a list
+    with a separate callback for each cell of the grid. Each cell's samples are
+    preceded by its label, unless label is None."""
+    cbs = cb if isinstance(cb, list) else [cb] * len(grid)
+    def grid_cb(strings, i, energy=None):
+        for g, temp in enumerate(grid):
+            if label is not None:
+                print (label.format(temp))
+            chunk = slice(g * n, (g + 1) * n)
+            cbs[g](strings[chunk], i, energy[chunk] if energy is not None else None)
+    return grid_cb
 
 def bold(s):
     return "\033[31m" + s + "\033[0m"
 
-def print_columns(maxlen):
+def print_columns(maxlen, columns=SAMPLES):
     col_width = maxlen+2
-    for fantasy_index in range(len(SAMPLES[0])):
-        particles = [s[fantasy_index] for s in SAMPLES]
+    for fantasy_index in range(len(columns[0])):
+        particles = [s[fantasy_index] for s in columns]
         if args.energy:
             min_energy = min(particles, key=lambda tup: tup[1])
-            print ("").join(
+            print ("".join(
                 bold(p[0].ljust(col_width)) if p == min_energy
                     else p[0].ljust(col_width)
-                for p in particles)
+                for p in particles))
         else:
-            print ("".join(s[fantasy_index].ljust(col_width) for s in SAMPLES))
+            print ("".join(s[fantasy_index].ljust(col_width) for s in columns))
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Sample short texts from a pickled model',
+    parser = argparse.ArgumentParser(description='Sample short texts from a saved model',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('model_fname', metavar='model.pickle', nargs='+',
-                        help='One or more pickled RBM models')
+    parser.add_argument('model_fname', metavar='model.rbm', nargs='+',
+                        help='One or more RBM models (as saved by train.py, or legacy pickles)')
     parser.add_argument('--every', type=int, default=-1, help='How often to sample.' +
                         ' If -1 (default) only sample after the last iteration.')
     parser.add_argument('-n', '--n-samples', dest='n_samples', type=int, default=30,
@@ -58,19 +80,60 @@ if __name__ == '__main__':
     parser.add_argument('--energy', action='store_true', help='Along with each sample generated, print its free energy')
     parser.add_argument('-s', '--start-temp', dest='start_temp', type=float, default=1.0, help="Temperature for first iteration")
     parser.add_argument('-e', '--end-temp', dest='end_temp', type=float, default=1.0, help="Temperature at last iteration")
+    parser.add_argument('--temp-grid', dest='temp_grid', help='Comma-separated list of temperatures. Draws'
+                        + ' n samples at each temperature, all in one batch. Ignores --start-temp and --end-temp.')
+    parser.add_argument('--ladder', help='Comma-separated list of temperatures for parallel tempering, starting with'
+                        + ' the temperature to take samples at (e.g. 1,1.3,1.7,2.2). Ignores --start-temp and --end-temp.')
+    parser.add_argument('--lengths', help='Comma-separated list of lengths, or ranges of lengths (e.g. 4,6-8).'
+                        + ' Draws n samples for each, all in one batch. Ignores --temp-grid and --ladder.')
+    parser.add_argument('--swap-every', dest='swap_every', type=int, default=1,
+                        help='With --ladder, how many rounds of Gibbs sampling between replica swaps')
     parser.add_argument('--no-col', dest='columns', action='store_false')
     parser.add_argument('--dedupe', action='store_true')
     parser.add_argument('--sil', help='data file for silhouettes')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed, for reproducible samples')
+    parser.add_argument('--allow-pickle', dest='allow_pickle', action='store_true',
+                        help='Allow loading legacy pickled models. Unpickling can run arbitrary code, so only use this with files you trust.')
+    parser.add_argument('--unique', action='store_true', help='Stream n distinct samples as the chains come up'
+                        + ' with them. Burns in for --iters rounds, then samples every --every rounds (default 10).')
+    parser.add_argument('--chains', type=int, default=100, help='With --unique, how many chains to run')
+    parser.add_argument('--exclude', action='append', default=[], metavar='TXTFILE',
+                        help='With --unique, never output strings from this file (e.g. the training data). May be repeated.')
+    parser.add_argument('--novelty', default=None, metavar='INDEX',
+                        help='With --unique, don\'t output strings in this index (as built by NoveltyIndex.py)')
+    parser.add_argument('--min-distance', dest='min_distance', type=int, default=1,
+                        help='With --novelty, only output strings at least this many edits away from anything in the index')
+    parser.add_argument('--neighbours', action='store_true',
+                        help='With --novelty, output the nearest string in the index, and its distance, after each sample')
 
     args = parser.parse_args()
+    if args.novelty and not args.unique:
+        parser.error('--novelty only works with --unique')
+    novelty = NoveltyIndex.load(args.novelty) if args.novelty else None
 
-
-    for model_fname in args.model_fname:
+    # One independent random stream per model
+    rngs = Sampling.spawn_rngs(args.seed, len(args.model_fname)) if args.seed is not None else [None] * len(args.model_fname)
+    for model_fname, rng in zip(args.model_fname, rngs):
         if len(args.model_fname) > 1 or not args.columns:
-            print ("Drawing samples from model defined at {}").format(model_fname)
-        f = open(model_fname, 'rb')
-        model = pickle.load(f)
-        f.close()
+            print ("Drawing samples from model defined at {}".format(model_fname))
+        model = ModelIO.load(model_fname, allow_pickle=args.allow_pickle)
+
+        if args.unique:
+            samples = Sampling.iter_unique_samples(
+                model, args.n_samples, args.chains, args.iters, args.every if args.every > 0 else 10,
+                start_temp=args.start_temp, final_temp=args.end_temp, exclude=args.exclude,
+                init_method=Sampling.VisInit.silhouettes if args.sil else Sampling.VisInit.biases,
+                training_examples=args.sil, sample_energy=args.energy, novelty=novelty,
+                min_distance=args.min_distance, rng=rng)
+            for batch in iter(lambda: list(itertools.islice(samples, 1000)), []):
+                lines = ['{}\t{:.2f}'.format(*sample) if args.energy else sample for sample in batch]
+                if args.neighbours and novelty is not None:
+                    strings = [sample[0] for sample in batch] if args.energy else batch
+                    distances, neighbours = novelty.nearest_strings(strings)
+                    lines = ['{}\t{}\t{}'.format(line, d, nb) for line, d, nb in zip(lines, distances, neighbours)]
+                for line in lines:
+                    print (line)
+            continue
 
         if args.every == -1:
             sample_indices = [args.iters-1]
@@ -80,23 +143,60 @@ if __name__ == '__main__':
             if sample_indices[-1] != args.iters - 1:
                 sample_indices.append(args.iters-1)
         
+        # Columns to print at the end, and their labels: one list of columns
+        # for each cell of the grid, if there is one
+        columns, labels = [[]], [None]
         if args.columns:
-            cb = horizontal_cb
+            cb = columns_cb(columns[0])
         elif args.dedupe:
-            cb = dedupe_cb
+            cb = make_dedupe_cb()
         else:
             cb = Sampling.print_sample_callback
+        def make_grid_callback(grid, label):
+            if args.columns:
+                # Print each cell's label over its own columns, once we're done
+                columns[:] = [[] for _ in grid]
+                labels[:] = [label.format(g) for g in grid]
+                return grid_callback(grid, args.n_samples, [columns_cb(cell) for cell in columns], label=None)
+            if args.dedupe:
+                # Particle j of one cell has nothing to do with particle j of another,
+                # so they shouldn't share what they've seen
+                return grid_callback(grid, args.n_samples, [make_dedupe_cb() for _ in grid], label)
+            return grid_callback(grid, args.n_samples, cb, label)
 
-        kwargs = dict(start_temp=args.start_temp, final_temp=args.end_temp, sample_energy=args.energy, 
-                    callback=cb)
+        kwargs = dict(sample_energy=args.energy, callback=cb, rng=rng)
         if args.sil:
             kwargs['init_method'] = Sampling.VisInit.silhouettes
             kwargs['training_examples'] = args.sil
-        
-        vis = Sampling.sample_model(model, args.n_samples, args.iters, sample_indices, **kwargs)
+
+        if args.lengths:
+            grid = args.lengths.split(',')
+            ranges = [[int(l) for l in g.split('-')] for g in grid]
+            mins = np.repeat([r[0] for r in ranges], args.n_samples)
+            maxes = np.repeat([r[-1] for r in ranges], args.n_samples)
+            kwargs['callback'] = make_grid_callback(grid, 'Length {}')
+            vis = Sampling.sample_model(model, len(mins), args.iters, sample_indices,
+                                        start_temp=args.start_temp, final_temp=args.end_temp,
+                                        min_length=mins, max_length=maxes, **kwargs)
+        elif args.temp_grid:
+            grid = [float(t) for t in args.temp_grid.split(',')]
+            temps = np.repeat(grid, args.n_samples)
+            kwargs['callback'] = make_grid_callback(grid, 'T = {}')
+            vis = Sampling.sample_model(model, len(temps), args.iters, sample_indices,
+                                        start_temp=temps, final_temp=temps, **kwargs)
+        elif args.ladder:
+            temperatures = [float(t) for t in args.ladder.split(',')]
+            vis = Sampling.sample_model_tempered(model, args.n_samples, args.iters, sample_indices,
+                                                 temperatures, swap_every=args.swap_every, **kwargs)
+        else:
+            vis = Sampling.sample_model(model, args.n_samples, args.iters, sample_indices,
+                                        start_temp=args.start_temp, final_temp=args.end_temp, **kwargs)
 
         if args.columns:
-            print_columns(model.codec.maxlen)
+            for label, cell in zip(labels, columns):
+                if label is not None:
+                    print (label)
+                print_columns(model.codec.maxlen, cell)
 
         if args.energy:
             fe = model._free_energy(vis)
@@ -0,0 +1,254 @@
+"""Serve samples from a model to other processes.
+
+Requests and responses are JSON, one per line. Reads requests from stdin and
+writes responses to stdout, or, with --socket, accepts any number of
+connections on a unix socket and speaks the same protocol on each one.
+
+A request looks like
+    {"id": 7, "n": 500, "iters": 1000, "start_temp": 1.0, "final_temp": 1.0,
+     "min_length": 0, "max_length": 0, "init": "biases", "energy": false, "seed": 1337}
+All fields are optional (see REQUEST_DEFAULTS). If the server was started with
+--pool, a request with "pool": true is served from chains which each worker
+keeps running between requests (see Sampling.ChainPool), so it doesn't have to
+wait for new chains to burn in. Those requests can't ask for particular
+iters, temperatures, lengths, init methods or seeds (see POOL_FIXED_FIELDS).
+The response is
+    {"id": 7, "samples": ["...", ...]}
+(with an "energy" list too if asked for), or {"id": 7, "error": "..."}.
+
+Each worker process loads the model once when it starts. Model files are
+memory-mapped, so the workers all share one copy of the weights. A request is
+split into chunks of at most --chunk-size chains, which are sampled in parallel
+across the pool. Given a seed, the samples returned don't depend on the number
+of workers. With "init": "train" or "silhouettes", the request's n chains start
+from the first n examples in the --sil file (going back to the start if there
+are fewer than n).
+"""
+import argparse
+import json
+import os
+import socketserver
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ModelIO
+import Sampling
+import Utils
+
+REQUEST_DEFAULTS = {'id': None, 'n': 10, 'iters': 10**3, 'start_temp': 1.0, 'final_temp': 1.0,
+                    'min_length': 0, 'max_length': 0, 'init': 'biases', 'energy': False,
+                    'seed': None, 'pool': False}
+
+# Fields which can't be set in requests served from the chain pool
+POOL_FIXED_FIELDS = ['iters', 'start_temp', 'final_temp', 'min_length', 'max_length', 'init', 'seed']
+
+# Cap on the number of samples in one request, so one client can't tie up the pool forever
+MAX_REQUEST_SAMPLES = 10**6
+
+class BadRequestException(Exception):
+    pass
+
+# The model loaded by this worker process (see _init_worker)
+_MODEL = None
+_TRAINING_EXAMPLES = None
+# Char indices of the strings in _TRAINING_EXAMPLES (see _training_indices)
+_TRAINING_INDICES = None
+
+def _init_worker(model_fname, training_examples, pool_kwargs):
+    global _MODEL, _TRAINING_EXAMPLES
+    # Sampling never modifies the model, so the weights can be mapped read-only
+    _MODEL = ModelIO.load(model_fname, mmap_mode='r')
+    _TRAINING_EXAMPLES = training_examples
+    if pool_kwargs:
+        # Start burning in right away
+        Sampling.chain_pool(_MODEL, **pool_kwargs)
+
+def _training_indices():
+    """All the (encodable) training examples, loaded the first time they're needed."""
+    global _TRAINING_INDICES
+    if _TRAINING_INDICES is None:
+        _TRAINING_INDICES = Utils.load_char_indices(_TRAINING_EXAMPLES, _MODEL.codec)
+    return _TRAINING_INDICES
+
+def _sample_chunk(n, offset, request, seed_seq):
+    """Sample n strings for the given request. offset is where this chunk starts
+    in the request, so that chunks initialized from training examples each get
+    their own share of them."""
+    model = _MODEL
+    if request['pool']:
+        if request['energy']:
+            strings, energy = Sampling.chain_pool(model).sample(n, sample_energy=True)
+            return strings, energy.tolist()
+        return Sampling.chain_pool(model).sample(n), None
+    rng = np.random.default_rng(seed_seq)
+    starting_vis = None
+    if request['init'] in ('train', 'silhouettes'):
+        # Examples offset to offset + n of the file (wrapping around if it's too short)
+        indices = np.take(_training_indices(), np.arange(offset, offset + n), axis=0, mode='wrap')
+        if request['init'] == 'silhouettes':
+            indices = model.codec.mutagen_silhouettes_batch(indices, rng)
+        starting_vis = Utils.onehot_csr(indices, model.codec.nchars)
+    results = []
+    def cb(strings, i, energy=None):
+        results.append((strings, energy))
+    Sampling.sample_model(model, n, request['iters'], [request['iters'] - 1],
+                          start_temp=request['start_temp'], final_temp=request['final_temp'],
+                          callback=cb, init_method=Sampling.VisInit[request['init']],
+                          sample_energy=request['energy'], starting_vis=starting_vis,
+                          min_length=request['min_length'], max_length=request['max_length'],
+                          rng=rng)
+    strings, energy = results[-1]
+    return list(strings), (energy.tolist() if energy is not None else None)
+
+def parse_request(line):
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        raise BadRequestException("Couldn't parse request: {}".format(e))
+    if not isinstance(request, dict):
+        raise BadRequestException("Request should be a JSON object")
+    unknown = set(request) - set(REQUEST_DEFAULTS)
+    if unknown:
+        raise BadRequestException("Unknown request fields: {}".format(', '.join(sorted(unknown))))
+    parsed = dict(REQUEST_DEFAULTS)
+    parsed.update(request)
+    if not (isinstance(parsed['n'], int) and 0 <= parsed['n'] <= MAX_REQUEST_SAMPLES):
+        raise BadRequestException("n should be an integer between 0 and {}".format(MAX_REQUEST_SAMPLES))
+    if not (isinstance(parsed['iters'], int) and parsed['iters'] >= 1):
+        raise BadRequestException("iters should be a positive integer")
+    if parsed['init'] not in Sampling.VisInit.__members__:
+        raise BadRequestException("Unrecognized init method: {}".format(parsed['init']))
+    return parsed
+
+
+class SampleServer(object):
+
+    def __init__(self, model_fname, jobs=None, chunk_size=100, training_examples=None, pool_kwargs=None):
+        """pool_kwargs, if given, are passed to Sampling.ChainPool to make each
+        worker a pool of chains to serve requests with "pool": true from."""
+        self.chunk_size = chunk_size
+        self.training_examples = training_examples
+        self.pool_kwargs = pool_kwargs
+        header, _ = ModelIO.read_header(model_fname)
+        self.maxlen = header['codec']['maxlen']
+        self.pool = ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                        initargs=(model_fname, training_examples, pool_kwargs))
+
+    def sample(self, request):
+        """Return the response (a dict) to the given parsed request."""
+        if request['pool']:
+            if not self.pool_kwargs:
+                raise BadRequestException("Server wasn't started with --pool")
+            # The pool's chains were started and run at settings fixed by the server
+            fixed = [field for field in POOL_FIXED_FIELDS if request[field] != REQUEST_DEFAULTS[field]]
+            if fixed:
+                raise BadRequestException("Pooled requests can't set {}".format(', '.join(fixed)))
+        if (request['init'] in ('train', 'silhouettes')) and self.training_examples is None:
+            raise BadRequestException("Init method {} needs the server to be started with --sil".format(request['init']))
+        if not 0 <= request['min_length'] <= self.maxlen or not 0 <= request['max_length'] <= self.maxlen:
+            raise BadRequestException("Lengths should be between 0 and {}".format(self.maxlen))
+        n = request['n']
+        sizes = [self.chunk_size] * (n // self.chunk_size)
+        if n % self.chunk_size:
+            sizes.append(n % self.chunk_size)
+        # One independent stream per chunk. Chunking only depends on n and
+        # chunk_size, so a given seed always gives the same samples.
+        seeds = np.random.SeedSequence(request['seed']).spawn(len(sizes))
+        offsets = np.cumsum([0] + sizes[:-1])
+        futures = [self.pool.submit(_sample_chunk, size, int(offset), request, seed)
+                   for size, offset, seed in zip(sizes, offsets, seeds)]
+        response = {'id': request['id'], 'samples': []}
+        if request['energy']:
+            response['energy'] = []
+        for future in futures:
+            strings, energy = future.result()
+            response['samples'] += strings
+            if request['energy']:
+                response['energy'] += energy
+        return response
+
+    def handle_line(self, line):
+        """Return the response to one line of input, as a line of JSON."""
+        request_id = None
+        try:
+            request = parse_request(line)
+            request_id = request['id']
+            response = self.sample(request)
+        except BadRequestException as e:
+            response = {'id': request_id, 'error': str(e)}
+        except Exception as e:
+            response = {'id': request_id, 'error': 'Internal error: {!r}'.format(e)}
+        return json.dumps(response) + '\n'
+
+    def serve_stream(self, infile, outfile):
+        for line in infile:
+            if not line.strip():
+                continue
+            outfile.write(self.handle_line(line))
+            outfile.flush()
+
+    def serve_socket(self, path):
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    line = line.decode('utf8')
+                    if not line.strip():
+                        continue
+                    self.wfile.write(server.handle_line(line).encode('utf8'))
+                    self.wfile.flush()
+
+        if os.path.exists(path):
+            os.remove(path)
+        sockserver = socketserver.ThreadingUnixStreamServer(path, Handler)
+        sockserver.daemon_threads = True
+        sys.stderr.write("Listening on {}\n".format(path))
+        try:
+            sockserver.serve_forever()
+        finally:
+            sockserver.server_close()
+            os.remove(path)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve samples from a saved model over stdin/stdout or a unix socket'
+                                     + ' (see the docstring at the top of this file for the protocol)',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('model_fname', metavar='model.rbm', help='A model saved by train.py')
+    parser.add_argument('--socket', default=None, help='Listen on a unix socket at this path, rather than stdin')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=100,
+                        help='Max number of chains sampled by one worker at a time')
+    parser.add_argument('--sil', default=None,
+                        help='Data file to draw training examples from, for the train and silhouettes init methods')
+    parser.add_argument('--pool', type=int, default=0, metavar='N_CHAINS',
+                        help='Keep this many chains running in each worker, to serve requests with "pool": true')
+    parser.add_argument('--pool-burn-in', dest='pool_burn_in', type=int, default=10**3,
+                        help='Rounds of sampling before pooled chains are first used')
+    parser.add_argument('--pool-decorrelation', dest='pool_decorrelation', type=int, default=20,
+                        help='Rounds of sampling between uses of a pooled chain')
+    parser.add_argument('--pool-temp', dest='pool_temp', type=float, default=1.0,
+                        help='Temperature to run pooled chains at')
+    args = parser.parse_args()
+
+    if not ModelIO.is_model_file(args.model_fname):
+        parser.error("{} is not a model file. Convert it with ModelIO.py first.".format(args.model_fname))
+    pool_kwargs = None
+    if args.pool:
+        pool_kwargs = dict(n_chains=args.pool, burn_in=args.pool_burn_in,
+                           decorrelation=args.pool_decorrelation, temperature=args.pool_temp)
+    server = SampleServer(args.model_fname, args.jobs, args.chunk_size, args.sil, pool_kwargs)
+    try:
+        if args.socket:
+            server.serve_socket(args.socket)
+        else:
+            server.serve_stream(sys.stdin, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from ShortTextCodec import ShortTextCodec, BinomialShortTextCodec, NonEncodableTextException
+
+STRINGS = ['bob', 'Alice', '', 'a', 'abcdefghij', 'abcdefghijk', 'o\'brien', 'mary jane',
+           'zoë', 'ZZZ', 'x' * 30]
+
+CODECS = [ShortTextCodec('', 10),
+          ShortTextCodec(' \'', 10, 3),
+          ShortTextCodec('', 10, 0, preserve_case=True),
+          ShortTextCodec(' ', 10, 2, leftpad=True),
+          # No filler char, since every string is the same length
+          ShortTextCodec('', 5, 5),
+          ]
+
+
+def legacy_codec(extra_chars, maxlen):
+    """A codec like those made by old versions of ShortTextCodec, which padded
+    strings with ' ' rather than FILLER."""
+    codec = ShortTextCodec(extra_chars, maxlen)
+    return ShortTextCodec.from_config(dict(codec.config(), alphabet=codec.alphabet.replace(codec.FILLER, '')))
+
+
+def decode_one(codec, vec, pretty=False, strict=True):
+    """decode() as it was before decode_batch, one softmax unit at a time."""
+    if sp.issparse(vec):
+        vec = vec.toarray().reshape(-1)
+    chars = []
+    for position_index in range(codec.maxlen):
+        if isinstance(codec, BinomialShortTextCodec) and pretty and position_index == codec.maxlen // 2:
+            chars.append('\t')
+        subarr = vec[position_index * codec.nchars:(position_index + 1) * codec.nchars]
+        if np.count_nonzero(subarr) != 1 and strict:
+            char = codec.MYSTERY
+        else:
+            char = codec.alphabet[np.argmax(subarr)]
+            if pretty and char == codec.FILLER:
+                char = ' ' if isinstance(codec, BinomialShortTextCodec) else ''
+        chars.append(char)
+    return ''.join(chars)
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_encode_batch_matches_encode(codec):
+    strings = STRINGS + ['abcde', 'vwxyz']
+    indices, reasons = codec.encode_batch(strings)
+    for s, row, reason in zip(strings, indices, reasons):
+        try:
+            expected = codec.encode(s)
+        except NonEncodableTextException as e:
+            assert reason == e.reason, s
+        else:
+            assert reason == '', s
+            assert list(row) == list(expected), s
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_decode_batch_matches_decode(codec):
+    indices, reasons = codec.encode_batch(STRINGS + ['abcde'])
+    nchars = codec.nchars
+    valid = np.zeros((len(indices), codec.maxlen * nchars))
+    valid[np.arange(len(indices))[:, None], np.arange(codec.maxlen) * nchars + indices] = 1
+    # Plus some vectors with zero or several units on per softmax
+    junk = np.random.RandomState(0).randint(0, 2, (20, codec.maxlen * nchars)).astype(float)
+    junk[:, :nchars] = 0
+    for vecs in [valid, junk]:
+        for pretty in [False, True]:
+            for strict in [False, True]:
+                expected = [decode_one(codec, vec, pretty, strict) for vec in vecs]
+                assert codec.decode_batch(vecs, pretty, strict) == expected
+                assert codec.decode_batch(sp.csr_matrix(vecs), pretty, strict) == expected
+                assert [codec.decode(vec, pretty, strict) for vec in vecs] == expected
+
+def test_decode_roundtrip():
+    codec = CODECS[1]
+    strings = ['bob', 'o\'brien', 'mary jane']
+    indices, reasons = codec.encode_batch(strings)
+    assert codec.decode_indices(indices, pretty=True) == strings
+
+@pytest.mark.parametrize('codec', CODECS + [legacy_codec(' ', 10)])
+def test_canonical_indices(codec):
+    indices, reasons = codec.encode_batch(STRINGS + ['abcde'])
+    indices = indices[reasons == '']
+    canonical = codec.canonical_indices(indices)
+    assert codec.decode_indices(canonical, pretty=True) == codec.decode_indices(indices, pretty=True)
+    # Padding goes at the end, whichever side the codec pads on
+    assert codec.decode_indices(canonical) == [s.ljust(codec.maxlen, codec.filler)
+                                                for s in codec.decode_indices(indices, pretty=True)]
+
+def test_canonical_indices_keep_legacy_spaces():
+    codec = legacy_codec(' ', 6)
+    indices, reasons = codec.encode_batch(['a b', 'ab', 'ab ', ' ab'])
+    # Only 'ab' and 'ab ' are the same string once padded with spaces
+    assert len(set(codec.decode_indices(indices, pretty=True))) == 3
+    assert len(set(map(tuple, codec.canonical_indices(indices)))) == 3
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_batch_mutagens(codec):
+    indices, reasons = codec.encode_batch(['abcde', 'vwxyz', 'fghij'])
+    rng = np.random.default_rng(0)
+    for mutagen in [codec.mutagen_nudge_batch, codec.mutagen_silhouettes_batch, codec.mutagen_noise_batch]:
+        mutated = mutagen(indices, rng)
+        assert mutated.shape == indices.shape
+        assert ((0 <= mutated) & (mutated < codec.nchars)).all()
@@ -0,0 +1,31 @@
+import copy
+
+import compare_models
+import ModelIO
+import Utils
+from ShortTextCodec import ShortTextCodec
+
+
+def test_results_are_stored_per_seed(model, names_fname, tmp_path, monkeypatch, capsys):
+    # Just enough of a row to tell which mutants a model was scored on
+    monkeypatch.setattr(compare_models, 'score_model',
+                        lambda model, data: {'name': model.name, 'grade': '?', 'noise': data['noise'].indices.tolist()})
+    fname = str(tmp_path / 'model.rbm')
+    ModelIO.save(model, fname)
+    store = compare_models.ResultStore(str(tmp_path / 'results.json'))
+    specs = [(fname, None)]
+    first = compare_models.eval_models_incremental(specs, names_fname, 200, store, seed=1)
+    assert compare_models.eval_models_incremental(specs, names_fname, 200, store, seed=1) == first
+    assert 'Found results for 1 of 1' in capsys.readouterr().out
+    other = compare_models.eval_models_incremental(specs, names_fname, 200, store, seed=2)
+    assert 'Found results for 0 of 1' in capsys.readouterr().out
+    assert other != first
+    assert store.rows(Utils.file_digest(names_fname), 200, 1) == first
+    # The mutants a model gets don't depend on what else is being evaluated
+    store = compare_models.ResultStore(str(tmp_path / 'other.json'))
+    other_codec = str(tmp_path / 'other.rbm')
+    other_model = copy.copy(model)
+    other_model.codec = ShortTextCodec('', 10, 1)
+    ModelIO.save(other_model, other_codec)
+    both = compare_models.eval_models_incremental([(other_codec, None)] + specs, names_fname, 200, store, seed=1)
+    assert both[1] == first[0]
@@ -0,0 +1,76 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import ModelIO
+import RBM
+import Sampling
+import Utils
+from ShortTextCodec import BinomialShortTextCodec
+
+
+def sample(model, seed):
+    results = []
+    Sampling.sample_model(model, 10, 20, [19], callback=lambda strings, i: results.append(strings), rng=seed)
+    return results[-1]
+
+@pytest.mark.parametrize('mmap_mode', ['c', 'r', None])
+def test_save_load_roundtrip(model, tmp_path, mmap_mode):
+    fname = str(tmp_path / 'model.rbm')
+    ModelIO.save(model, fname)
+    assert ModelIO.is_model_file(fname)
+    loaded = ModelIO.load(fname, mmap_mode=mmap_mode)
+    assert type(loaded) is type(model)
+    assert loaded.codec.config() == model.codec.config()
+    assert ModelIO.model_params(loaded) == ModelIO.model_params(model)
+    assert loaded.history == ModelIO._jsonable(model.history)
+    for name in ModelIO.ARRAYS:
+        array = getattr(loaded, name)
+        assert array.dtype == getattr(model, name).dtype
+        assert np.isfortran(array) == np.isfortran(getattr(model, name))
+        assert np.array_equal(array, getattr(model, name))
+    assert sample(loaded, 3) == sample(model, 3)
+
+def test_load_codec(model, tmp_path):
+    fname = str(tmp_path / 'model.rbm')
+    ModelIO.save(model, fname)
+    assert ModelIO.load_codec(fname).config() == model.codec.config()
+
+def test_float32_roundtrip(make_model, train_data, tmp_path):
+    model = make_model(n_iter=1, dtype=np.float32).fit(train_data)
+    fname = str(tmp_path / 'model.rbm')
+    ModelIO.save(model, fname)
+    loaded = ModelIO.load(fname)
+    assert loaded.compute_dtype == np.float32
+    assert np.array_equal(loaded.components_, model.components_)
+
+def test_legacy_pickles_need_permission(model, tmp_path):
+    pickle_fname = str(tmp_path / 'model.pickle')
+    with open(pickle_fname, 'wb') as f:
+        pickle.dump(model, f)
+    with pytest.raises(ModelIO.ModelFormatException):
+        ModelIO.load(pickle_fname)
+    with pytest.raises(ModelIO.ModelFormatException):
+        ModelIO.load_codec(pickle_fname)
+    assert np.array_equal(ModelIO.load(pickle_fname, allow_pickle=True).components_, model.components_)
+    converted = ModelIO.load(ModelIO.convert(pickle_fname))
+    assert np.array_equal(converted.components_, model.components_)
+
+def test_binomial_codec_roundtrip(names_fname, tmp_path):
+    with open(names_fname) as f:
+        names = f.read().split()
+    # Two-part names, last name first
+    pairs_fname = str(tmp_path / 'pairs.txt')
+    with open(pairs_fname, 'w') as f:
+        f.write('\n'.join('{},{}'.format(last, first) for first, last in zip(names[::2], names[1::2])))
+    codec = BinomialShortTextCodec('', 12, 0)
+    model = RBM.CharBernoulliRBMSoftmax(codec, n_components=10, n_iter=1, random_state=3)
+    model.fit(Utils.vectors_from_txtfile(pairs_fname, codec))
+    fname = str(tmp_path / 'model.rbm')
+    ModelIO.save(model, fname)
+    for loaded_codec in [ModelIO.load(fname).codec, ModelIO.load_codec(fname)]:
+        assert type(loaded_codec) is BinomialShortTextCodec
+        assert loaded_codec.config() == codec.config()
+        assert np.array_equal(Utils.char_indices_from_txtfile(pairs_fname, loaded_codec)[0],
+                              Utils.char_indices_from_txtfile(pairs_fname, codec)[0])
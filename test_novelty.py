@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from NoveltyIndex import NoveltyIndex
+from ShortTextCodec import ShortTextCodec
+
+
+def levenshtein(a, b):
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+def corpus_and_queries(names_fname, codec, n_corpus=300, n_queries=60):
+    with open(names_fname) as f:
+        names = [line.strip() for line in f]
+    _, reasons = codec.encode_batch(names)
+    names = [name.lower() for name, reason in zip(names, reasons) if reason == '']
+    rng = np.random.RandomState(0)
+    corpus = names[:n_corpus]
+    queries = corpus[:10] + names[n_corpus:n_corpus + 10] + ['', 'a', 'zzzzzz']
+    # Mutants of names in the corpus: a few random edits each
+    alphabet = codec.non_special_char_alphabet
+    while len(queries) < n_queries:
+        s = list(corpus[rng.randint(len(corpus))])
+        for _ in range(rng.randint(1, 4)):
+            op = rng.randint(3)
+            posn = rng.randint(len(s) + 1)
+            if op == 0 and len(s) < codec.maxlen:
+                s.insert(posn, rng.choice(list(alphabet)))
+            elif op == 1 and posn < len(s):
+                del s[posn]
+            elif posn < len(s):
+                s[posn] = rng.choice(list(alphabet))
+        queries.append(''.join(s))
+    return corpus, queries
+
+@pytest.mark.parametrize('leftpad', [False, True])
+def test_nearest_matches_levenshtein(names_fname, leftpad):
+    codec = ShortTextCodec('', 10, 0, leftpad=leftpad)
+    corpus, queries = corpus_and_queries(names_fname, codec)
+    index = NoveltyIndex(codec, codec.encode_batch(corpus)[0])
+    distances, neighbours = index.nearest_strings(queries)
+    for query, distance, neighbour in zip(queries, distances, neighbours):
+        expected = min(levenshtein(query, s) for s in corpus)
+        assert distance == expected, query
+        # Ties can go either way, but the neighbour should be that far away
+        assert levenshtein(query, neighbour) == expected, query
+    assert list(index.contains_strings(queries)) == [q in set(corpus) for q in queries]
+
+def test_save_load(names_fname, tmp_path):
+    codec = ShortTextCodec('', 10, 0)
+    corpus, queries = corpus_and_queries(names_fname, codec)
+    index = NoveltyIndex(codec, codec.encode_batch(corpus)[0], sources=['names'])
+    fname = str(tmp_path / 'names.novelty.npz')
+    index.save(fname)
+    loaded = NoveltyIndex.load(fname)
+    assert loaded.sources == ['names']
+    assert len(loaded) == len(set(corpus))
+    distances, neighbours = loaded.nearest_strings(queries)
+    expected_distances, expected_neighbours = index.nearest_strings(queries)
+    assert np.array_equal(distances, expected_distances)
+    assert neighbours == expected_neighbours
+
+def test_without_filler():
+    codec = ShortTextCodec('', 5, 5)
+    corpus = ['abcde', 'vwxyz']
+    index = NoveltyIndex(codec, codec.encode_batch(corpus)[0])
+    distances, neighbours = index.nearest_strings(['abcde', 'abxxe', 'abc'])
+    assert list(distances) == [0, 2, -1]
+    assert neighbours == ['abcde', 'abcde', None]
+
+def test_empty_index():
+    codec = ShortTextCodec('', 10, 0)
+    index = NoveltyIndex(codec, np.zeros((0, codec.maxlen), dtype=int))
+    assert not index.contains_strings(['abc']).any()
+    distances, neighbours = index.nearest(codec.encode_batch(['abc'])[0])
+    assert list(neighbours) == [-1]
+
+def test_maxlen_limit():
+    codec = ShortTextCodec('', 65, 0)
+    with pytest.raises(AssertionError):
+        NoveltyIndex(codec, np.zeros((0, codec.maxlen), dtype=int))
+
+def test_legacy_spaces_arent_padding():
+    # Old codecs padded with ' ', and pretty decoding keeps it
+    codec = ShortTextCodec(' ', 6)
+    codec = ShortTextCodec.from_config(dict(codec.config(), alphabet=codec.alphabet.replace(codec.FILLER, '')))
+    corpus, _ = codec.encode_batch(['ab', 'abc d'])
+    index = NoveltyIndex(codec, corpus)
+    queries = ['ab', 'a b', 'abc d', 'abcd', 'b ab']
+    assert list(index.contains_strings(queries)) == [True, False, True, False, False]
+    distances, _ = index.nearest_strings(queries)
+    corpus = codec.decode_indices(corpus, pretty=True)
+    queries = codec.decode_indices(codec.encode_batch(queries)[0], pretty=True)
+    assert list(distances) == [min(levenshtein(q, s) for s in corpus) for q in queries]
@@ -0,0 +1,115 @@
+import copy
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from scipy.special import logsumexp
+
+import RBM
+import Utils
+
+
+def test_gibbs_indices_matches_gibbs(model, train_data):
+    shape = model.codec.shape()
+    vis = train_data[:50]
+    idx = Utils.onehot_to_indices(vis, shape)
+    temps = np.linspace(0.5, 2, 50)
+    for temperature in [1.0, temps]:
+        onehot = model.gibbs(vis, temperature, rng=np.random.default_rng(1))
+        indices = model.gibbs_indices(idx, temperature, rng=np.random.default_rng(1))
+        assert np.array_equal(Utils.onehot_to_indices(onehot, shape), indices)
+
+def test_exact_pseudolikelihood_matches_brute_force(model, train_data):
+    maxlen, nchars = model.codec.shape()
+    v = train_data[:5].toarray()
+    expected = np.zeros(len(v))
+    for row in range(len(v)):
+        for pos in range(maxlen):
+            # Every string which differs from this one at most at pos
+            candidates = np.repeat(v[row:row+1], nchars, axis=0)
+            candidates[:, pos*nchars:(pos+1)*nchars] = np.eye(nchars)
+            neg_energy = -model._free_energy(candidates)
+            actual = np.argmax(v[row, pos*nchars:(pos+1)*nchars])
+            expected[row] += neg_energy[actual] - logsumexp(neg_energy)
+    assert np.allclose(model._exact_pseudolikelihood(train_data[:5]), expected)
+    assert np.allclose(model.score_samples(train_data[:5], exact=True), expected)
+
+def test_bernoulli_exact_pseudolikelihood_matches_brute_force():
+    rng = np.random.RandomState(0)
+    model = RBM.BernoulliRBM(n_components=7)
+    model.components_ = np.asfortranarray(rng.normal(0, 1, (7, 12)))
+    model.intercept_hidden_ = rng.normal(0, 1, 7)
+    model.intercept_visible_ = rng.normal(0, 1, 12)
+    v = rng.randint(0, 2, (4, 12)).astype(float)
+    energy = model._free_energy(v)
+    expected = np.zeros(len(v))
+    for i in range(v.shape[1]):
+        flipped = v.copy()
+        flipped[:, i] = 1 - flipped[:, i]
+        # log P(v_i | v_-i) = log(1 / (1 + exp(F(v) - F(v_flipped))))
+        expected -= np.logaddexp(0, energy - model._free_energy(flipped))
+    assert np.allclose(model._exact_pseudolikelihood(v), expected)
+
+def test_unsorted_csr_scores_like_sorted(model, train_data):
+    v = train_data[:20].tocsr()
+    # The same matrix, with each row's column indices reversed
+    shuffled = sp.csr_matrix((v.data, v.indices.reshape(20, -1)[:, ::-1].ravel(), v.indptr), shape=v.shape)
+    assert not shuffled.has_sorted_indices
+    assert np.array_equal(model._softmax_columns(shuffled), model._softmax_columns(v))
+    assert np.allclose(model._exact_pseudolikelihood(shuffled), model._exact_pseudolikelihood(v))
+
+def test_training_doesnt_depend_on_score_threads(make_model, train_data, monkeypatch, capsys):
+    monkeypatch.setattr(RBM, 'SCORE_CHUNK_SIZE', 100)
+    weights = []
+    for threads in [1, 4]:
+        monkeypatch.setattr(RBM, 'SCORE_THREADS', threads)
+        model = make_model(verbose=1).fit(train_data, validation=train_data[:300])
+        weights.append(model.components_)
+    assert np.array_equal(*weights)
+
+def test_scores_dont_depend_on_score_threads(model, train_data, monkeypatch):
+    monkeypatch.setattr(RBM, 'SCORE_CHUNK_SIZE', 100)
+    scores = []
+    for threads in [1, 4]:
+        monkeypatch.setattr(RBM, 'SCORE_THREADS', threads)
+        scored = copy.deepcopy(model)
+        scores.append(scored.score_samples(train_data))
+    assert np.array_equal(*scores)
+
+def test_threads_get_distinct_workspace_streams(make_model):
+    model = make_model()
+    barrier = threading.Barrier(8)
+    def first_draws(_):
+        barrier.wait()
+        return model._get_workspace().rng.random(4).tolist()
+    with ThreadPoolExecutor(8) as pool:
+        draws = list(pool.map(first_draws, range(8)))
+    assert len(set(map(tuple, draws))) == 8
+
+def test_background_checks_dont_change_training(make_model, train_data, capsys):
+    quiet = make_model().fit(train_data)
+    monitor = RBM.Monitor(every_batches=40, background=True)
+    checked = make_model(verbose=1).fit(train_data, validation=train_data[:300], monitor=monitor)
+    assert np.array_equal(quiet.components_, checked.components_)
+
+def test_resumed_fit_matches_uninterrupted(make_model, train_data):
+    uninterrupted = make_model().fit(train_data)
+    batches = []
+    def stop(model):
+        batches.append(1)
+        return len(batches) == 130
+    interrupted = make_model().fit(train_data, callback=stop)
+    assert interrupted.fit_state_['batch'] == 130
+    # Resuming from a pickled checkpoint, as train.py --resume does
+    resumed = pickle.loads(pickle.dumps(interrupted)).fit(train_data, resume=True)
+    assert resumed.fit_state_ is None
+    for attr in ['components_', 'intercept_hidden_', 'intercept_visible_', 'h_samples_']:
+        assert np.array_equal(getattr(uninterrupted, attr), getattr(resumed, attr))
+
+def test_resume_rejects_different_data(make_model, train_data):
+    model = make_model().fit(train_data, callback=lambda model: True)
+    with pytest.raises(ValueError):
+        model.fit(train_data[:100], resume=True)
@@ -0,0 +1,116 @@
+import copy
+
+import numpy as np
+import pytest
+
+import Sampling
+import Utils
+from Sampling import KeySet
+from ShortTextCodec import ShortTextCodec
+
+
+def test_keyset_matches_set():
+    rng = np.random.default_rng(0)
+    keyset = KeySet()
+    seen = set()
+    for _ in range(50):
+        # Plenty of repeats, both within and across batches
+        keys = rng.integers(0, 2000, rng.integers(0, 100)).astype(np.uint64)
+        keys[:3] = np.iinfo(np.uint64).max - keys[:3]
+        queries = rng.integers(0, 2000, 50).astype(np.uint64)
+        assert list(keyset.contains(queries)) == [key in seen for key in queries.tolist()]
+        new = keyset.add(keys)
+        expected = []
+        for key in keys.tolist():
+            expected.append(key not in seen)
+            seen.add(key)
+        assert list(new) == expected
+        assert len(keyset) == len(seen)
+        assert len(keyset._runs) <= max(1, np.log2(len(keyset)) + 1)
+    assert KeySet(list(seen)).contains(list(seen)).all()
+
+def test_sample_keys_match_decoded_strings():
+    codec = ShortTextCodec(' ', 6, 0, leftpad=True)
+    strings = ['ab', 'ab ', 'a b', 'b', 'abcdef']
+    indices, _ = codec.encode_batch(strings)
+    keys = Sampling.sample_keys(codec, indices)
+    assert len(set(keys.tolist())) == len(set(codec.decode_indices(indices, pretty=True)))
+
+@pytest.mark.parametrize('maxlen', [6, 20, 40])
+def test_sample_keys_are_exact(maxlen):
+    codec = ShortTextCodec('', maxlen, 0)
+    rng = np.random.default_rng(0)
+    indices = rng.integers(0, codec.nchars, (5000, maxlen))
+    # Plenty of rows differing in just one position
+    indices[::2, :] = indices[0]
+    indices[::2, rng.integers(0, maxlen, 2500)] = rng.integers(0, codec.nchars, 2500)
+    keys = Sampling.sample_keys(codec, indices)
+    assert len(np.unique(keys)) == len(np.unique(codec.canonical_indices(indices), axis=0))
+    keyset = KeySet()
+    assert keyset.add(keys[:3000]).sum() + keyset.add(keys[3000:]).sum() == len(np.unique(keys))
+    assert keyset.contains(keys).all()
+
+@pytest.mark.parametrize('min_length,max_length', [(4, 0), (0, 5), (3, 6), (7, 7)])
+def test_length_bias_matches_deprecated_shrink_model(model, train_data, min_length, max_length):
+    idx = Utils.onehot_to_indices(train_data[:40], model.codec.shape())
+    bias = Sampling.length_bias(model.codec, len(idx), min_length, max_length)
+    assert bias.shape == (model.codec.maxlen * model.codec.nchars,)
+    shrunk = copy.deepcopy(model)
+    rng_old, rng_new = np.random.default_rng(5), np.random.default_rng(5)
+    old, new = idx, idx
+    with pytest.warns(DeprecationWarning):
+        shrink = Sampling.shrink_model(shrunk, min_length, max_length or model.codec.maxlen)
+    assert np.array_equal(shrink.visible_bias, bias)
+    with shrink:
+        for _ in range(20):
+            old = shrunk.gibbs_indices(old, rng=rng_old)
+            new = model.gibbs_indices(new, visible_bias=bias, rng=rng_new)
+    assert np.array_equal(old, new)
+    # shrink_model put the model's own biases back afterwards
+    assert np.array_equal(shrunk.intercept_visible_, model.intercept_visible_)
+
+def test_length_bias_per_particle(codec):
+    mins, maxes = np.array([0, 2, 2]), np.array([0, 5, 8])
+    bias = Sampling.length_bias(codec, 3, mins, maxes)
+    assert bias.shape == (3, codec.maxlen * codec.nchars)
+    for row, (lo, hi) in enumerate(zip(mins, maxes)):
+        assert np.array_equal(bias[row], Sampling.length_bias(codec, 1, lo, hi))
+
+def test_length_bias_leftpad():
+    codec = ShortTextCodec('', 6, 0, leftpad=True)
+    bias = Sampling.length_bias(codec, 1, 2, 4).reshape(codec.shape())
+    filler = codec.char_lookup[codec.filler]
+    # The string ends at the last position, so its first chars are at the end
+    assert list(bias[:, filler]) == [Sampling.BIG_NUMBER] * 2 + [0] * 2 + [-Sampling.BIG_NUMBER] * 2
+
+def test_length_bias_without_filler():
+    codec = ShortTextCodec('', 5, 5)
+    assert not Sampling.length_bias(codec, 3, 5, 5).any()
+
+def test_sample_model_respects_lengths(model):
+    results = []
+    Sampling.sample_model(model, 100, 50, [49], callback=lambda strings, i: results.append(strings),
+                          min_length=4, max_length=6, rng=0)
+    lengths = [len(s) for s in results[-1]]
+    assert np.mean([4 <= n <= 6 for n in lengths]) > 0.9
+
+def test_sample_model_reproducible_given_rng(model):
+    def sample(rng):
+        results = []
+        Sampling.sample_model(model, 20, 30, [29], callback=lambda strings, i: results.append(strings), rng=rng)
+        return results[-1]
+    assert sample(7) == sample(np.random.default_rng(7))
+    rngs = Sampling.spawn_rngs(1, 2)
+    assert sample(rngs[0]) != sample(rngs[1])
+
+def test_chain_pool(model):
+    pool = Sampling.ChainPool(model, 30, burn_in=10, decorrelation=3, background=False, rng=0)
+    assert pool.ready() == 0
+    assert len(pool.sample(30)) == 30
+    assert pool.sweeps == 10
+    strings, energy = pool.sample(10, sample_energy=True)
+    assert len(strings) == len(energy) == 10
+    # Every chain had to rest for decorrelation sweeps before being handed out again
+    assert pool.sweeps == 13
+    assert sorted(pool.ages) == [0] * 10 + [3] * 20
+    assert pool.ready() == 20
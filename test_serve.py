@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import ModelIO
+import Sampling
+import Utils
+import serve
+
+
+@pytest.fixture
+def server(model, tmp_path):
+    fname = str(tmp_path / 'model.rbm')
+    ModelIO.save(model, fname)
+    server = serve.SampleServer(fname, jobs=1, pool_kwargs=dict(n_chains=10, burn_in=5, decorrelation=2))
+    yield server
+    server.shutdown()
+
+@pytest.mark.parametrize('field,value', [('iters', 5), ('start_temp', 2.0), ('final_temp', 0.5),
+                                         ('init', 'zeros'), ('min_length', 3), ('max_length', 5),
+                                         ('seed', 1)])
+def test_pooled_requests_cant_change_settings(server, field, value):
+    response = json.loads(server.handle_line(json.dumps({'id': 1, 'pool': True, field: value})))
+    assert response['id'] == 1
+    assert field in response['error']
+
+def test_bad_requests(server):
+    for line in ['not json', '[]', '{"n": -1}', '{"iters": 0}', '{"init": "nope"}', '{"bogus": 1}',
+                 '{"min_length": 99}']:
+        assert 'error' in json.loads(server.handle_line(line))
+
+def test_chunks_start_from_their_own_examples(model, names_fname, monkeypatch):
+    monkeypatch.setattr(serve, '_MODEL', model)
+    monkeypatch.setattr(serve, '_TRAINING_EXAMPLES', names_fname)
+    monkeypatch.setattr(serve, '_TRAINING_INDICES', None)
+    # Hand back the strings the chains start from, rather than sampling
+    def starting_strings(model, n, iters, sample_iter_indices, callback=None, starting_vis=None, **kwargs):
+        callback(model.codec.decode_batch(starting_vis, pretty=True), iters - 1)
+    monkeypatch.setattr(Sampling, 'sample_model', starting_strings)
+    request = serve.parse_request('{"init": "train"}')
+    strings = sum((serve._sample_chunk(5, offset, request, None)[0] for offset in [0, 5, 10]), [])
+    expected = Utils.load_char_indices(names_fname, model.codec)[:15]
+    assert strings == model.codec.decode_indices(expected, pretty=True)
@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+
+import Utils
+
+
+def test_cached_char_indices(names_fname, codec, tmp_path, monkeypatch):
+    monkeypatch.setattr(Utils, 'VECTOR_CACHE_DIR', str(tmp_path / 'cache'))
+    expected, skipped = Utils.char_indices_from_txtfile(names_fname, codec)
+    # Reading a few lines shouldn't encode (or cache) the whole file
+    assert np.array_equal(Utils.load_char_indices(names_fname, codec, limit=10), expected[:10])
+    assert not os.path.exists(Utils.VECTOR_CACHE_DIR)
+    for _ in range(2):
+        indices, cached_skipped = Utils.cached_char_indices(names_fname, codec)
+        assert np.array_equal(indices, expected)
+        assert cached_skipped == skipped
+    assert isinstance(Utils.cached_char_indices(names_fname, codec)[0], np.memmap)
+
+def test_file_digest_notices_changes(tmp_path):
+    fname = str(tmp_path / 'names.txt')
+    with open(fname, 'w') as f:
+        f.write('bob\n')
+    first = Utils.file_digest(fname)
+    assert Utils.file_digest(fname) == first
+    with open(fname, 'a') as f:
+        f.write('alice\n')
+    assert Utils.file_digest(fname) != first
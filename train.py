@@ -1,11 +1,18 @@
 import argparse
+import os
 import pickle
+import signal
+import sys
+import time
+
+import numpy as np
 
 from sklearn.model_selection import train_test_split
 from GridEncoder import GridEncoder
 import Utils
+import ModelIO
 from ShortTextCodec import ShortTextCodec, BinomialShortTextCodec
-from RBM import CharBernoulliRBM, CharBernoulliRBMSoftmax
+from RBM import CharBernoulliRBM, CharBernoulliRBMSoftmax, Monitor
 
 def stringify_param(name, value):
     if name == 'tag':
@@ -18,31 +25,50 @@ def stringify_param(name, value):
     elif isinstance(value, float):
         # e.g. 1E-03
         value = '{:.0E}'.format(value)
-    elif not isinstance(value, int) and not isinstance(value, basestring):
+    elif not isinstance(value, int) and not isinstance(value, str):
         raise ValueError("Don't know how to format {}".format(type(value)))
     return prefix + str(value)
 
-def pickle_name(args, parser):
+def model_fname(args, parser):
     fname = args.input_fname.split('.')[0].split('/')[-1]
     fname += '_'
-    for arg in ['tag', 'batch_size', 'n_hidden', 'softmax', 'learning_rate_backoff', 'preserve_case', 'epochs', 'learning_rate', 'weight_cost', 'left']:
+    for arg in ['tag', 'batch_size', 'n_hidden', 'softmax', 'learning_rate_backoff', 'preserve_case', 'epochs', 'learning_rate', 'weight_cost', 'left', 'dtype']:
         value = getattr(args, arg)
+        # No --dtype means float64 for new models, so that doesn't need a mention either
+        if arg == 'dtype' and value == 'float64':
+            continue
         if value != parser.get_default(arg):
             fname += '_' + stringify_param(arg, value)
 
-    return fname + '.pickle'
+    return fname + ModelIO.EXTENSION
+
+def save_checkpoint(fname, args, rbm, input_digest):
+    """Save everything needed to pick up training where it is now (see --resume).
+    input_digest is the Utils.file_digest of the training file, so we can tell
+    if it's changed in the meantime."""
+    checkpoint = {'args': vars(args),
+                  'model': rbm,
+                  'input_digest': input_digest,
+                  # Training only draws from the model's own RNGs now, but restore the
+                  # global one too, in case anything else uses it
+                  'np_random_state': np.random.get_state(),
+                  }
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(checkpoint, f)
+    os.replace(tmp_fname, fname)
 
 
 if __name__ == '__main__':
-    # TODO: An option for checkpointing model every n epochs
     # TODO: Should maybe separate out vectorization and training? They're sort of
     # orthogonal (options like maxlen, preserve-case etc. don't even do anything
     # when starting from a pretrained model), and the options here are getting
     # bloated. 
     parser = argparse.ArgumentParser(description='Train a character-level RBM on short texts',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('input_fname', metavar='txtfile',
-                        help='A text file to train on, with one instance per line')
+    parser.add_argument('input_fname', metavar='txtfile', nargs='?',
+                        help='A text file to train on, with one instance per line. Optional with --resume,'
+                        + ' which defaults to the file the checkpoint was trained on.')
     parser.add_argument('--test-ratio', dest='test_ratio', type=float, default=0.05,
                         help='The ratio of data to hold out to monitor for overfitting')
     parser.add_argument('--no-softmax', dest='softmax', action='store_false',
@@ -71,28 +97,72 @@ if __name__ == '__main__':
     parser.add_argument('--left', action='store_true', help='Pad strings shorter than maxlen from the left rather than the right.')
     parser.add_argument('-m', '--model', dest='model', default=None,
                         help="Start from a previously trained model. Options affecting network topology will be ignored.")
+    parser.add_argument('--allow-pickle', dest='allow_pickle', action='store_true',
+                        help='Allow -m to be a legacy pickled model. Unpickling can run arbitrary code, so only'
+                        + ' use this with files you trust.')
+    parser.add_argument('--dtype', default=None, choices=['float64', 'float32'],
+                        help='Floating point precision for weights and computations. float32 is faster and uses'
+                        + ' half the memory, at the cost of some precision. Defaults to float64 for new models,'
+                        + ' and the model\'s own precision with -m.')
+    parser.add_argument('--check-every', dest='check_every', default=1, type=int,
+                        help='Report on how training is going every this many epochs (0 to never)')
+    parser.add_argument('--check-every-batches', dest='check_every_batches', default=0, type=int,
+                        help='Also report on how training is going every this many minibatches')
+    parser.add_argument('--check-sample', dest='check_sample', default=10**5, type=int,
+                        help='Max number of training examples to score when reporting')
+    parser.add_argument('--fixed-check-sample', dest='fixed_check_sample', action='store_true',
+                        help='Score the same training examples each time, rather than a fresh slice of each shuffle')
+    parser.add_argument('--background-checks', dest='background_checks', action='store_true',
+                        help='Score a snapshot of the model in a background thread, rather than pausing training')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed (for the train/validation split, weight initialization and sampling).'
+                        + ' Chosen at random if not given.')
+    parser.add_argument('--checkpoint-every', dest='checkpoint_every', default=10.0, type=float,
+                        help='Save a checkpoint every this many minutes (0 to never). A checkpoint is'
+                        + ' also saved on ctrl+c.')
+    parser.add_argument('--resume', default=None, metavar='CHECKPOINT',
+                        help='Resume training from the given checkpoint. All other options are taken from the'
+                        + ' checkpoint. The training file must be unchanged.')
     parser.add_argument('--tag', dest='tag', default='',
-                        help='A name for this run. The model will be pickled to ' +
+                        help='A name for this run. The model will be saved to ' +
                         'a corresponding filename. That name will already encode ' +
                         'important hyperparams.')
 
     args = parser.parse_args()
+    if args.input_fname is None and not args.resume:
+        parser.error('txtfile is required (unless resuming from a checkpoint)')
 
-    # TODO: trap ctrl+c and pickle the model before bailing
+    if args.seed is None and not args.resume:
+        args.seed = np.random.randint(np.iinfo(np.int32).max)
+        print ("Using seed {}".format(args.seed))
+    np.random.seed(args.seed)
 
-    # If the path to a pretrained, pickled model was provided, resurrect it, and
+    if args.resume:
+        with open(args.resume, 'rb') as f:
+            checkpoint = pickle.load(f)
+        resume, input_fname = args.resume, args.input_fname
+        args = argparse.Namespace(**checkpoint['args'])
+        args.resume = resume
+        # The training file may have moved, but its contents mustn't have changed (see below)
+        if input_fname is not None:
+            args.input_fname = input_fname
+        rbm = checkpoint['model']
+        np.random.set_state(checkpoint['np_random_state'])
+        codec = rbm.codec
+    # If the path to a pretrained model was provided, resurrect it, and
     # update the attributes that make sense to change (stuff like #hidden units,
     # or max string length of course can't be changed)
-    if args.model:
-        f = open(args.model)
-        rbm = pickle.load(f)
-        f.close()
+    elif args.model:
+        # Read it all into memory, since we're going to be updating it
+        rbm = ModelIO.load(args.model, mmap_mode=None, allow_pickle=args.allow_pickle)
         rbm.learning_rate = args.learning_rate
         rbm.base_learning_rate = args.learning_rate
         rbm.lr_backoff = args.learning_rate_backoff
         rbm.n_iter = args.epochs
         rbm.batch_size = args.batch_size
         rbm.weight_cost = args.weight_cost
+        if args.dtype is not None:
+            rbm.dtype = args.dtype
         codec = rbm.codec
     else:
         codec_kls = BinomialShortTextCodec if args.binomial else ShortTextCodec
@@ -107,21 +177,51 @@ if __name__ == '__main__':
                         'verbose': 1,
                         'batch_size': args.batch_size,
                         'weight_cost': args.weight_cost,
+                        'dtype': args.dtype or 'float64',
+                        'random_state': args.seed,
                         }
         kls = CharBernoulliRBMSoftmax if args.softmax else CharBernoulliRBM
         rbm = kls(**model_kwargs)
-    print(model_kwargs)
+        print(model_kwargs)
+    input_digest = Utils.file_digest(args.input_fname)
+    # (Checkpoints from before we kept track of this can't be checked)
+    if args.resume and checkpoint.get('input_digest', input_digest) != input_digest:
+        parser.error("{} has changed since the checkpoint was saved, so training can't be resumed".format(args.input_fname))
     vecs = Utils.vectors_from_txtfile(args.input_fname, codec)
     # gridEncoder = GridEncoder()
     # data = gridEncoder.generate_data_fake()
     # vecs1 = gridEncoder.generate_one_hot_vector(data)
     # print(vecs1.shape)
     # print(vecs.shape)
-    train, validation = train_test_split(vecs, test_size=args.test_ratio)
+    train, validation = train_test_split(vecs, test_size=args.test_ratio, random_state=args.seed)
     print ("Training data shape : " + str(train.shape))
-    rbm.fit(train, validation)
-    out_fname = pickle_name(args, parser)
-    f = open(out_fname, 'wb')
-    pickle.dump(rbm, f)
-    f.close()
+    monitor = Monitor(args.check_every, args.check_every_batches, args.check_sample,
+                      args.fixed_check_sample, args.background_checks)
+    out_fname = model_fname(args, parser)
+    checkpoint_fname = os.path.splitext(out_fname)[0] + '.ckpt'
+
+    # On ctrl+c, finish the current minibatch and checkpoint before bailing
+    interrupted = []
+    def on_sigint(signum, frame):
+        print ("Caught ctrl+c. Saving a checkpoint after this minibatch (ctrl+c again to bail right away)")
+        interrupted.append(True)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, on_sigint)
+
+    last_checkpoint = [time.time()]
+    def checkpoint_callback(model):
+        due = args.checkpoint_every and time.time() - last_checkpoint[0] >= 60 * args.checkpoint_every
+        if interrupted or due:
+            save_checkpoint(checkpoint_fname, args, model, input_digest)
+            last_checkpoint[0] = time.time()
+            print ("Wrote checkpoint to " + checkpoint_fname)
+        return bool(interrupted)
+
+    rbm.fit(train, validation, monitor, callback=checkpoint_callback, resume=bool(args.resume))
+    if interrupted:
+        print ("Interrupted. Continue with --resume " + checkpoint_fname)
+        sys.exit(1)
+    ModelIO.save(rbm, out_fname)
     print ("Wrote model to " + out_fname)
+    if os.path.exists(checkpoint_fname):
+        os.remove(checkpoint_fname)